@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Run the obs_comCam benchmarks on synthetic data, optionally checking them against a baseline."""
+from __future__ import print_function
+
+import argparse
+import shutil
+import sys
+import tempfile
+
+from lsst.obs.comCam.benchmark import findRegressions, loadBaseline, runBenchmarkSuite, saveBaseline
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--dir", help="Directory for the synthetic data (default: a temporary directory)")
+parser.add_argument("--nVisit", type=int, default=2, help="Number of visits of synthetic data")
+parser.add_argument("--ccds", nargs="+", default=["S00", "S11"], help="CCDs in each visit")
+parser.add_argument("--nRepeat", type=int, default=3, help="Number of times to repeat each measurement")
+parser.add_argument("--baseline", help="JSON baseline to check the results against")
+parser.add_argument("--save", help="Write the results to this JSON file, for use as a baseline")
+parser.add_argument("--timeTolerance", type=float, default=0.25,
+                    help="Fractional increase in time considered a regression")
+parser.add_argument("--memoryTolerance", type=float, default=0.1,
+                    help="Fractional increase in peak memory considered a regression")
+args = parser.parse_args()
+
+root = args.dir if args.dir is not None else tempfile.mkdtemp(prefix="benchmarkComCam")
+try:
+    results = runBenchmarkSuite(root, nVisit=args.nVisit, ccds=args.ccds, nRepeat=args.nRepeat)
+finally:
+    if args.dir is None:
+        shutil.rmtree(root, ignore_errors=True)
+
+for name in sorted(results):
+    peak = results[name]["peakMemory"]
+    print("%-24s %10.4f s %12s" % (name, results[name]["time"],
+                                   "-" if peak is None else "%.1f MB" % (peak/2**20)))
+
+if args.save:
+    saveBaseline(results, args.save)
+
+if args.baseline:
+    regressions = findRegressions(results, loadBaseline(args.baseline),
+                                  timeTolerance=args.timeTolerance, memoryTolerance=args.memoryTolerance)
+    for name, quantity, old, new in regressions:
+        print("REGRESSION %s %s: %g -> %g" % (name, quantity, old, new))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Make a binned quick-look image of the ComCam focal plane from the raws of an exposure."""
+from __future__ import print_function
+
+import argparse
+import time
+
+from lsst.obs.comCam.mosaic import makeMosaic, writeMosaicFits, writeMosaicPng
+from lsst.obs.comCam.rawReader import readPrimaryHeader
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("files", nargs="+", help="The raws, one per CCD")
+parser.add_argument("--fits", help="Write the mosaic to this FITS file")
+parser.add_argument("--png", help="Write the mosaic to this PNG file")
+parser.add_argument("--binning", type=int, default=8, help="Number of pixels binned in each direction")
+parser.add_argument("-j", "--threads", type=int, default=1, help="Number of amplifiers read at once")
+args = parser.parse_args()
+
+if not (args.fits or args.png):
+    parser.error("Please specify --fits and/or --png")
+
+t0 = time.time()
+mosaic = makeMosaic(args.files, binning=args.binning, numThreads=args.threads)
+if args.fits:
+    header = readPrimaryHeader(args.files[0])
+    cards = [(key, header[key]) for key in ("RUNNUM", "DATE-OBS", "MJD-OBS", "EXPTIME", "IMGTYPE",
+                                            "TESTTYPE", "FILTER") if key in header]
+    writeMosaicFits(args.fits, mosaic, cards)
+if args.png:
+    writeMosaicPng(args.png, mosaic)
+print("Made a mosaic of %d CCDs, binned %dx%d, in %.2f s" %
+      (len(args.files), args.binning, args.binning, time.time() - t0))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Write a tree of synthetic ComCam raws, laid out as the test stands write them."""
+from __future__ import print_function
+
+import argparse
+import time
+
+from lsst.obs.comCam.synthetic import ACQUISITION_TYPES, generateRawTree
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("root", help="Top of the tree, e.g. .../raw")
+parser.add_argument("--nRun", type=int, default=1, help="Number of runs")
+parser.add_argument("--nVisit", type=int, default=10, help="Number of visits of each type in each run")
+parser.add_argument("--ccds", nargs="+", help="CCDs in each visit (default: all)")
+parser.add_argument("--acqTypes", nargs="+", default=["bias", "dark", "flat"],
+                    choices=sorted(ACQUISITION_TYPES), help="Acquisition types taken in each run")
+parser.add_argument("--compression", choices=["gz", "fz"], help="Compress the files")
+parser.add_argument("--ampShape", type=int, nargs=2, metavar=("HEIGHT", "WIDTH"),
+                    help="Cut the amplifiers to this size (e.g. for ingest tests)")
+parser.add_argument("-j", "--processes", type=int, default=1, help="Number of processes writing files")
+parser.add_argument("--firstRun", type=int, default=5000, help="Number of the first run")
+args = parser.parse_args()
+
+t0 = time.time()
+fileNames = generateRawTree(args.root, nRun=args.nRun, nVisit=args.nVisit, ccds=args.ccds,
+                            acquisitionTypes=args.acqTypes, compression=args.compression,
+                            numProcesses=args.processes, firstRun=args.firstRun, ampShape=args.ampShape)
+dt = time.time() - t0
+print("Wrote %d files in %.1f s (%.1f files/s)" % (len(fileNames), dt, len(fileNames)/dt if dt > 0 else 0.0))
@@ -2,3 +2,6 @@ config.isr.doLinearize = False
 config.isr.doDefect = False
 config.isr.doAddDistortionModel = False
 config.repair.cosmicray.nCrPixelMax = 100000
+
+from lsst.obs.comCam.calibCombine import ComCamCalibCombineTask
+config.combination.retarget(ComCamCalibCombineTask)
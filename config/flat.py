@@ -1,3 +1,6 @@
 config.isr.doLinearize = False
 config.isr.doDefect = False
 config.isr.doAddDistortionModel = False
+
+from lsst.obs.comCam.calibCombine import ComCamCalibCombineTask
+config.combination.retarget(ComCamCalibCombineTask)
@@ -6,3 +6,10 @@ config.isr.doUseOpticsTransmission = False
 config.isr.doUseFilterTransmission = False
 config.isr.doUseSensorTransmission = False
 config.isr.doUseAtmosphereTransmission = False
+
+# makeComCamBrighterFatterKernel.py runs obs_comCam's ComCamMakeBrighterFatterKernelTask, which measures
+# all the amplifiers of each flat pair at once (without ISR) and spreads the pairs over a pool of processes
+from lsst.obs.comCam.makeBrighterFatterKernel import ComCamMakeBrighterFatterKernelConfig
+if isinstance(config, ComCamMakeBrighterFatterKernelConfig):
+    config.covariances.maxLag = 8
+    config.covariances.numProcesses = 4
@@ -0,0 +1,534 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Time and memory benchmarks of the obs_comCam hot paths."""
+
+from __future__ import division, print_function
+
+import json
+import os
+import sqlite3
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import tracemalloc
+except ImportError:                     # python 2
+    tracemalloc = None
+
+import numpy as np
+
+from lsst.afw.fits import readMetadata
+import lsst.daf.persistence as dafPersist
+from lsst.utils import getPackageDir
+from lsst.obs.comCam.calibIndex import CalibIntervalIndex
+from lsst.obs.comCam.comCam import _cameraCache, makeCamera
+from lsst.obs.comCam.comCamMapper import ComCamMapper
+from lsst.obs.comCam.crosstalk import applyCrosstalk, applyCrosstalkPairwise
+from lsst.obs.comCam.ingest import ComCamIngestTask, createRegistryIndexes
+from lsst.obs.comCam.rawReader import readPrimaryHeader, readRawCcd
+from lsst.obs.comCam.synthetic import (MJD_2010, getAmpGeometry, getRawPath, makeAmpArrays,
+                                       makePrimaryCards, writeRawMef)
+
+__all__ = ["timeCall", "benchmarkRawRead", "benchmarkHeaderScan", "benchmarkRegistryQuery",
+           "benchmarkRawVisit", "benchmarkRawCcdRead", "measure", "makeSyntheticRepo", "benchmarkCalibLookup",
+           "benchmarkCrosstalk", "runBenchmarkSuite", "saveBaseline", "loadBaseline", "findRegressions"]
+
+
+def timeCall(func, args=(), nRepeat=3):
+    """Time a function call.
+
+    Parameters
+    ----------
+    func : callable
+        The function to time.
+    args : `tuple`
+        Positional arguments for ``func``.
+    nRepeat : `int`
+        Number of times to call ``func``.
+
+    Returns
+    -------
+    seconds : `float`
+        The fastest of the ``nRepeat`` wall-clock times, in seconds.
+    """
+    best = None
+    for i in range(nRepeat):
+        t0 = time.time()
+        func(*args)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def benchmarkRawRead(butler, dataId, nRepeat=3):
+    """Compare reading a raw CCD one HDU at a time with the single-pass reader.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.persistence.Butler`
+        Butler for a repository containing ComCam raw data.
+    dataId : `dict`
+        Data ID of a single raw CCD.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    times : `dict`
+        Fastest wall-clock time in seconds for ``perHdu`` (the "raw_amp" and "raw_hdu"
+        components) and ``singlePass`` (the "raw_mef" dataset).
+    """
+    def readPerHdu():
+        butler.get("raw_hdu", dataId)
+        for channel in range(1, 17):
+            butler.get("raw_amp", dataId, channel=channel)
+
+    def readSinglePass():
+        butler.get("raw_mef", dataId)
+
+    return dict(perHdu=timeCall(readPerHdu, nRepeat=nRepeat),
+                singlePass=timeCall(readSinglePass, nRepeat=nRepeat))
+
+
+def benchmarkHeaderScan(fileNames, keys, nRepeat=3):
+    """Compare reading primary headers with afw and with the minimal card scanner.
+
+    Parameters
+    ----------
+    fileNames : `list` of `str`
+        The FITS files whose primary headers are read (e.g. thousands of raws).
+    keys : iterable of `str`
+        The keywords kept by the card scanner.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    times : `dict`
+        Fastest wall-clock time in seconds to read all the headers with ``readMetadata``
+        and with ``readPrimaryHeader``.
+    """
+    keys = set(keys)
+
+    def readAfw():
+        for fileName in fileNames:
+            readMetadata(fileName, 0)
+
+    def readScanner():
+        for fileName in fileNames:
+            readPrimaryHeader(fileName).toPropertyList(keys)
+
+    return dict(readMetadata=timeCall(readAfw, nRepeat=nRepeat),
+                readPrimaryHeader=timeCall(readScanner, nRepeat=nRepeat))
+
+
+def _makeRegistry(nRow, indexes):
+    """Make an in-memory raw registry of ``nRow`` synthetic rows, 9 CCDs per visit."""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE raw (id INTEGER PRIMARY KEY AUTOINCREMENT, run TEXT, visit INT, ccd TEXT, "
+                 "imageType TEXT, testType TEXT, dateObs TEXT, filter TEXT)")
+    imageTypes = ["BIAS", "DARK", "FLAT", "FE55"]
+    rows = []
+    for i in range(nRow):
+        visit = i//9
+        rows.append(("%05d" % (visit//500), visit, "S%d%d" % divmod(i % 9, 3), imageTypes[visit % 4],
+                     imageTypes[(visit//4) % 4], "2018-01-01T%08d" % visit, "NONE"))
+    conn.executemany("INSERT INTO raw (run, visit, ccd, imageType, testType, dateObs, filter) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    if indexes:
+        createRegistryIndexes(conn, "raw", indexes)
+    conn.commit()
+    return conn
+
+
+def benchmarkRegistryQuery(nRowList=(10000, 100000, 1000000),
+                           indexes=("run,ccd", "visit,ccd", "imageType,testType", "dateObs"), nRepeat=3):
+    """Measure the latency of partial-dataId raw registry queries with and without indexes.
+
+    Parameters
+    ----------
+    nRowList : iterable of `int`
+        The registry sizes to measure.
+    indexes : iterable of `str`
+        The indexes to create, as for ``ComCamIngestConfig.registryIndexes``.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    times : `dict`
+        For each registry size, the fastest time in seconds for each kind of query,
+        as ``{nRow: {"indexed": {query: seconds}, "unindexed": {query: seconds}}}``.
+    """
+    queries = dict(
+        runCcd="SELECT DISTINCT visit FROM raw WHERE run = '00001' AND ccd = 'S11'",
+        visit="SELECT DISTINCT ccd, run FROM raw WHERE visit = 1234",
+        type="SELECT DISTINCT visit FROM raw WHERE imageType = 'FLAT' AND testType = 'DARK'",
+        dateObs="SELECT DISTINCT visit FROM raw WHERE dateObs = '2018-01-01T00001234'",
+    )
+    times = {}
+    for nRow in nRowList:
+        times[nRow] = {}
+        for label, indexList in (("unindexed", ()), ("indexed", indexes)):
+            conn = _makeRegistry(nRow, indexList)
+            times[nRow][label] = {}
+            for name, sql in queries.items():
+                times[nRow][label][name] = timeCall(lambda: conn.execute(sql).fetchall(), nRepeat=nRepeat)
+            conn.close()
+    return times
+
+
+def benchmarkRawVisit(butler, mapper, dataId, nRepeat=1):
+    """Compare reading a visit CCD by CCD through the butler with `ComCamMapper.readRawVisit`.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.persistence.Butler`
+        Butler for a repository containing ComCam raw data.
+    mapper : `lsst.obs.comCam.ComCamMapper`
+        Mapper for the same repository.
+    dataId : `dict`
+        Data ID of the visit.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    times : `dict`
+        Fastest wall-clock time in seconds per visit for ``serial`` and ``parallel`` reads.
+    """
+    ccds = butler.queryMetadata("raw", "ccd", dataId)
+
+    def readSerial():
+        for ccd in ccds:
+            butler.get("raw", dataId, ccd=ccd)
+
+    return dict(serial=timeCall(readSerial, nRepeat=nRepeat),
+                parallel=timeCall(mapper.readRawVisit, (dataId,), nRepeat=nRepeat))
+
+
+def benchmarkRawCcdRead(fileNames, numThreads=None, nRepeat=3):
+    """Compare reading the raw CCDs of a visit one after another with reading them in threads.
+
+    This is the file reading done by `ComCamMapper.readRawVisit` (without assembly), so it
+    can be measured without a butler repository.
+
+    Parameters
+    ----------
+    fileNames : `list` of `str`
+        The raw files of a visit, one per CCD.
+    numThreads : `int`, optional
+        Number of threads; defaults to one per file, as in ``readRawVisit``.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    times : `dict`
+        Fastest wall-clock time in seconds to read all the files ``serial`` and ``threaded``.
+    """
+    def readSerial():
+        for fileName in fileNames:
+            readRawCcd(fileName)
+
+    def readThreaded():
+        pool = ThreadPool(numThreads or len(fileNames))
+        try:
+            pool.map(readRawCcd, fileNames)
+        finally:
+            pool.close()
+            pool.join()
+
+    return dict(serial=timeCall(readSerial, nRepeat=nRepeat),
+                threaded=timeCall(readThreaded, nRepeat=nRepeat))
+
+
+def measure(func, args=(), nRepeat=3):
+    """Measure the time and peak memory of a function call.
+
+    The peak memory is that allocated through Python (including numpy arrays) during
+    one further call made with `tracemalloc` running; it doesn't include C++ allocations
+    made by afw, and is `None` if `tracemalloc` is unavailable.
+
+    Parameters
+    ----------
+    func : callable
+        The function to measure.
+    args : `tuple`
+        Positional arguments for ``func``.
+    nRepeat : `int`
+        Number of times to call ``func`` to measure its time.
+
+    Returns
+    -------
+    result : `dict`
+        The fastest wall-clock ``time`` in seconds, and ``peakMemory`` in bytes.
+    """
+    result = dict(time=timeCall(func, args, nRepeat=nRepeat), peakMemory=None)
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        try:
+            func(*args)
+            result["peakMemory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def makeSyntheticRepo(root, nVisit=2, ccds=("S00", "S11"), run="5000", signal=1000.0):
+    """Write synthetic raws to the camera.yaml geometry and ingest them into a new repository.
+
+    Parameters
+    ----------
+    root : `str`
+        Directory to hold the test-stand tree (``root/stand``) and repository (``root/repo``).
+    nVisit : `int`
+        Number of visits.
+    ccds : iterable of `str`
+        The CCDs read in each visit.
+    run : `str`
+        The run number.
+    signal : `float`
+        The mean signal in the imaging region, DN.
+
+    Returns
+    -------
+    repoDir : `str`
+        The repository.
+    fileNames : `list` of `str`
+        The raws, in the test-stand tree.
+    """
+    fileNames = []
+    for ccd in ccds:
+        geometries = getAmpGeometry(ccd=ccd)
+        for visit in range(nVisit):
+            mjd = MJD_2010 + 3000 + visit/86400.0
+            fileName = getRawPath(os.path.join(root, "stand"), "LCA-11021_RTM-005-Dev", run, "flat",
+                                  "v0", 1000, ccd, "%s_flat_%03d.fits" % (ccd, visit))
+            writeRawMef(fileName, makePrimaryCards(run, mjd),
+                        makeAmpArrays(geometries, signal=signal, seed=visit))
+            fileNames.append(fileName)
+
+    repoDir = os.path.join(root, "repo")
+    if not os.path.isdir(repoDir):
+        os.makedirs(repoDir)
+    with open(os.path.join(repoDir, "_mapper"), "w") as fd:
+        print("lsst.obs.comCam.ComCamMapper", file=fd)
+
+    config = ComCamIngestTask.ConfigClass()
+    parser = ComCamIngestTask.ArgumentParser(name=ComCamIngestTask._DefaultName)
+    args = parser.parse_args(config, args=[repoDir, "--mode", "link"] + fileNames)
+    ComCamIngestTask(config=args.config).run(args)
+    return repoDir, fileNames
+
+
+def _makeCalibRegistry(nCalib, ccds):
+    """Make an in-memory calib registry of ``nCalib`` daily biases per CCD, each valid for a day."""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE bias (id INTEGER PRIMARY KEY AUTOINCREMENT, ccd TEXT, filter TEXT, "
+                 "calibDate TEXT, validStart TEXT, validEnd TEXT)")
+    rows = []
+    for ccd in ccds:
+        for i in range(nCalib):
+            day = str(np.datetime64("2018-01-01") + i)
+            rows.append((ccd, "NONE", day, day, day))
+    conn.executemany("INSERT INTO bias (ccd, filter, calibDate, validStart, validEnd) "
+                     "VALUES (?, ?, ?, ?, ?)", rows)
+    createRegistryIndexes(conn, "bias", ["ccd,filter,calibDate"])
+    conn.commit()
+    return conn
+
+
+def benchmarkCalibLookup(nCalib=1000, nLookup=1000, ccds=("S00", "S11"), nRepeat=3):
+    """Compare finding the valid calib with a registry query and with a `CalibIntervalIndex`.
+
+    Parameters
+    ----------
+    nCalib : `int`
+        Number of biases per CCD in the registry.
+    nLookup : `int`
+        Number of lookups timed.
+    ccds : iterable of `str`
+        The CCDs in the registry.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    results : `dict`
+        `measure` results for ``sql`` and ``index`` lookups, and for ``indexLoad``.
+    """
+    conn = _makeCalibRegistry(nCalib, ccds)
+    dates = [str(np.datetime64("2018-01-01") + (i*7919) % nCalib) for i in range(nLookup)]
+    lookups = [(ccds[i % len(ccds)], date) for i, date in enumerate(dates)]
+    sql = "SELECT calibDate FROM bias WHERE ccd = ? AND validStart <= ? AND validEnd >= ?"
+
+    def lookupSql():
+        for ccd, date in lookups:
+            conn.execute(sql, (ccd, date, date)).fetchall()
+
+    index = CalibIntervalIndex.fromRegistry(conn, ["bias"])
+
+    def lookupIndex():
+        for ccd, date in lookups:
+            index.lookup("bias", ccd, date)
+
+    try:
+        return dict(indexLoad=measure(CalibIntervalIndex.fromRegistry, (conn, ["bias"]), nRepeat=nRepeat),
+                    sql=measure(lookupSql, nRepeat=nRepeat),
+                    index=measure(lookupIndex, nRepeat=nRepeat))
+    finally:
+        conn.close()
+
+
+def benchmarkCrosstalk(shape=(2048, 576), nAmp=16, nRepeat=3):
+    """Compare correcting the crosstalk of a CCD in one matrix product and one pair of amps at a time.
+
+    Parameters
+    ----------
+    shape : `tuple` of `int`
+        The ``(height, width)`` of each amplifier's pixels.
+    nAmp : `int`
+        Number of amplifiers.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    results : `dict`
+        `measure` results for the ``vectorized`` and ``pairwise`` corrections.
+    """
+    rng = np.random.RandomState(0)
+    coeffs = rng.uniform(-1e-4, 1e-4, size=(nAmp, nAmp)).astype(np.float32)
+    stack = rng.normal(1000.0, 10.0, size=(nAmp,) + tuple(shape)).astype(np.float32)
+    arrays = list(stack.copy())
+
+    return dict(vectorized=measure(applyCrosstalk, (stack, coeffs), nRepeat=nRepeat),
+                pairwise=measure(applyCrosstalkPairwise, (arrays, coeffs), nRepeat=nRepeat))
+
+
+def runBenchmarkSuite(root, nVisit=2, ccds=("S00", "S11"), run="5000", nRepeat=3):
+    """Run the obs_comCam benchmarks against a freshly generated synthetic repository.
+
+    Parameters
+    ----------
+    root : `str`
+        Directory in which to write the synthetic data (see `makeSyntheticRepo`).
+    nVisit : `int`
+        Number of visits written.
+    ccds : iterable of `str`
+        The CCDs written for each visit.
+    run : `str`
+        The run number of the synthetic data.
+    nRepeat : `int`
+        Number of times to repeat each measurement.
+
+    Returns
+    -------
+    results : `dict`
+        `measure` results for each benchmark, indexed by name.
+    """
+    repoDir, fileNames = makeSyntheticRepo(root, nVisit=nVisit, ccds=ccds, run=run)
+    butler = dafPersist.Butler(repoDir)
+    mapper = ComCamMapper(root=repoDir)
+    visits = sorted(set(butler.queryMetadata("raw", "visit")))
+    dataId = dict(visit=visits[0], ccd=ccds[0])
+
+    def makeCameraUncached():
+        _cameraCache.clear()
+        makeCamera()
+
+    config = ComCamIngestTask.ConfigClass()
+    config.load(os.path.join(getPackageDir("obs_comCam"), "config", "ingest.py"))
+    parseTask = ComCamIngestTask(config=config).parse
+
+    def parseHeaders():
+        for fileName in fileNames:
+            parseTask.getInfo(fileName)
+
+    def readVisitInfoUncached():
+        ComCamMapper.visitInfoCache.clear()
+        butler.get("raw_visitInfo", dataId)
+
+    def readVisitSerial():
+        for ccd in ccds:
+            butler.get("raw", dataId, ccd=ccd)
+
+    results = dict(
+        makeCamera=measure(makeCameraUncached, nRepeat=nRepeat),
+        makeCameraCached=measure(makeCamera, nRepeat=nRepeat),
+        getInfo=measure(parseHeaders, nRepeat=nRepeat),
+        queryRawAmp=measure(mapper.query_raw_amp, (["visit", "ccd", "channel"], dict(run=run)),
+                            nRepeat=nRepeat),
+        rawVisitInfo=measure(readVisitInfoUncached, nRepeat=nRepeat),
+        rawVisitInfoCached=measure(butler.get, ("raw_visitInfo", dataId), nRepeat=nRepeat),
+        assembleRaw=measure(butler.get, ("raw", dataId), nRepeat=nRepeat),
+        rawVisitSerial=measure(readVisitSerial, nRepeat=nRepeat),
+        rawVisitParallel=measure(mapper.readRawVisit, (dataId,), nRepeat=nRepeat),
+    )
+    for name, result in benchmarkCalibLookup(ccds=ccds, nRepeat=nRepeat).items():
+        results["calibLookup_" + name] = result
+    for name, result in benchmarkCrosstalk(nRepeat=nRepeat).items():
+        results["crosstalk_" + name] = result
+    return results
+
+
+def saveBaseline(results, fileName):
+    """Write benchmark results as a JSON baseline for `findRegressions`."""
+    with open(fileName, "w") as fd:
+        json.dump(results, fd, indent=2, sort_keys=True)
+
+
+def loadBaseline(fileName):
+    """Read a baseline written by `saveBaseline`."""
+    with open(fileName) as fd:
+        return json.load(fd)
+
+
+def findRegressions(results, baseline, timeTolerance=0.25, memoryTolerance=0.1):
+    """Compare benchmark results with a baseline.
+
+    Parameters
+    ----------
+    results : `dict`
+        Results from `runBenchmarkSuite`.
+    baseline : `dict`
+        Earlier results, e.g. from `loadBaseline`.
+    timeTolerance : `float`
+        Fractional increase in time considered a regression.
+    memoryTolerance : `float`
+        Fractional increase in peak memory considered a regression.
+
+    Returns
+    -------
+    regressions : `list` of `tuple`
+        ``(benchmark, quantity, baselineValue, value)`` for each regression; benchmarks
+        missing from either set of results are ignored.
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        for quantity, tolerance in (("time", timeTolerance), ("peakMemory", memoryTolerance)):
+            old, new = baseline[name].get(quantity), results[name].get(quantity)
+            if old is not None and new is not None and new > old*(1 + tolerance):
+                regressions.append((name, quantity, old, new))
+    return regressions
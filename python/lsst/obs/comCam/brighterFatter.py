@@ -0,0 +1,400 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Brighter-fatter kernels from the pixel covariances of flat pairs, measured for all amplifiers at once.
+
+`measureCovariances` measures the pairs and `makeKernel` solves for a CCD's kernel; they are
+run by `lsst.obs.comCam.makeBrighterFatterKernel.ComCamMakeBrighterFatterKernelTask`.
+"""
+
+from __future__ import division, print_function
+
+import multiprocessing
+
+import numpy as np
+
+from lsst.obs.comCam.overscan import groupAmpsByGeometry, subtractOverscan
+from lsst.obs.comCam.rawReader import readRawCcd
+
+__all__ = ["computeCovariances", "foldCovariances", "measureFlatPair", "CovarianceAccumulator",
+           "measureCovariances", "tileQuadrant", "solveKernel", "makeKernel"]
+
+
+def _fftSize(n):
+    """Return the smallest integer >= n with no prime factors other than 2, 3 and 5."""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def computeCovariances(images, maxLag, weights=None):
+    """Compute the pixel covariances of a stack of images with one batched FFT.
+
+    Parameters
+    ----------
+    images : `numpy.ndarray`
+        The images, as ``(nAmp, height, width)``, e.g. the difference images of a flat pair.
+    maxLag : `int`
+        The largest lag, in pixels, in each direction.
+    weights : `numpy.ndarray`, optional
+        Weights of the same shape as ``images``: 1 for good pixels and 0 for rejected ones.
+
+    Returns
+    -------
+    cov : `numpy.ndarray`
+        The covariances, as ``(nAmp, maxLag + 1, 2*maxLag + 1)``; ``cov[:, dy, maxLag + dx]``
+        is the covariance of pixels separated by ``(dx, dy)`` for ``0 <= dy <= maxLag`` and
+        ``-maxLag <= dx <= maxLag`` (the other lags follow by symmetry).
+    """
+    nAmp, height, width = images.shape
+    shape = (_fftSize(height + maxLag), _fftSize(width + maxLag))  # padding avoids wrapping the lags
+    lagCols = np.arange(-maxLag, maxLag + 1) % shape[1]
+
+    if weights is None:
+        weights = np.ones(images.shape[1:])
+        nPair = np.outer(height - np.arange(maxLag + 1), width - np.abs(np.arange(-maxLag, maxLag + 1)))
+    else:
+        fw = np.fft.rfft2(weights, s=shape)
+        nPair = np.rint(np.fft.irfft2(fw*np.conj(fw), s=shape)[..., :maxLag + 1, lagCols])
+
+    means = (images*weights).sum(axis=(-2, -1))/weights.sum(axis=(-2, -1))
+    residuals = (images - np.reshape(means, (-1, 1, 1)))*weights
+
+    f = np.fft.rfft2(residuals, s=shape)
+    acf = np.fft.irfft2(f*np.conj(f), s=shape)[:, :maxLag + 1, lagCols]
+    return acf/np.maximum(nPair, 1)
+
+
+def foldCovariances(cov):
+    """Average the covariances at ``(dx, dy)`` and ``(-dx, dy)``.
+
+    Parameters
+    ----------
+    cov : `numpy.ndarray`
+        Covariances as returned by `computeCovariances`.
+
+    Returns
+    -------
+    folded : `numpy.ndarray`
+        The covariances for ``0 <= dx, dy <= maxLag``, as ``(nAmp, maxLag + 1, maxLag + 1)``
+        indexed by ``[amp, dy, dx]``.
+    """
+    maxLag = cov.shape[-2] - 1
+    return 0.5*(cov[..., maxLag:] + cov[..., maxLag::-1])
+
+
+def _readTrimmed(fileName, groups, nAmp):
+    """Read a raw and return its overscan-subtracted, trimmed amplifiers as ``(nAmp, height, width)``."""
+    pixels = readRawCcd(fileName, nAmp=nAmp).pixels
+    trimmed = None
+    for geometry, indices in groups:
+        result = subtractOverscan(pixels[indices], geometry, trim=True)
+        if trimmed is None:
+            trimmed = np.empty((nAmp,) + result.shape[1:], dtype=np.float64)
+        if result.shape[1:] != trimmed.shape[1:]:
+            raise RuntimeError("Amplifiers of %s have differing imaging regions" % fileName)
+        trimmed[indices] = result
+    return trimmed
+
+
+def measureFlatPair(args):
+    """Measure the mean signal and pixel covariances of each amplifier of a flat pair.
+
+    The flats are overscan-subtracted and trimmed; the second is scaled to the first's
+    median and subtracted, and pixels more than ``nSigma`` robust standard deviations
+    from the difference's median are rejected.  The covariances of the difference are
+    halved to give those of a single flat.
+
+    Parameters
+    ----------
+    args : `tuple`
+        ``(fileName1, fileName2, groups, maxLag, nSigma)``, where ``groups`` is as returned
+        by `lsst.obs.comCam.overscan.groupAmpsByGeometry`.
+
+    Returns
+    -------
+    mean : `numpy.ndarray`
+        The mean signal of each amplifier, DN.
+    cov : `numpy.ndarray`
+        The covariances of each amplifier, as returned by `computeCovariances`.
+    """
+    fileName1, fileName2, groups, maxLag, nSigma = args
+    nAmp = sum(len(indices) for geometry, indices in groups)
+    flat1 = _readTrimmed(fileName1, groups, nAmp)
+    flat2 = _readTrimmed(fileName2, groups, nAmp)
+
+    median1 = np.median(flat1, axis=(1, 2))
+    median2 = np.median(flat2, axis=(1, 2))
+    flat2 *= (median1/median2)[:, np.newaxis, np.newaxis]
+    flat1 -= flat2
+    diff = flat1
+
+    q25, median, q75 = np.percentile(diff, [25, 50, 75], axis=(1, 2))
+    limit = nSigma*0.741*(q75 - q25)
+    weights = (np.abs(diff - median[:, np.newaxis, np.newaxis]) <= limit[:, np.newaxis, np.newaxis])
+
+    cov = computeCovariances(diff, maxLag, weights.astype(np.float64))
+    return 0.5*(median1 + median2), 0.5*cov
+
+
+class CovarianceAccumulator(object):
+    """Running totals of the per-amplifier covariances of many flat pairs.
+
+    Parameters
+    ----------
+    ampNames : `list` of `str`
+        The names of the amplifiers, in the order of the measurements.
+    maxLag : `int`
+        The largest lag measured.
+    """
+
+    def __init__(self, ampNames, maxLag):
+        self.ampNames = list(ampNames)
+        self.maxLag = maxLag
+        self.nPair = 0
+        self.means = []                 # mean signal of each amplifier, for each pair
+        self.variances = []             # variance of each amplifier, for each pair
+        self.covariances = []           # folded covariances of each amplifier, for each pair
+        self._sumNormalized = np.zeros((len(self.ampNames), maxLag + 1, maxLag + 1))
+
+    def add(self, mean, cov):
+        """Add the measurements of one flat pair, as returned by `measureFlatPair`."""
+        folded = foldCovariances(cov)
+        self._sumNormalized += folded/mean[:, np.newaxis, np.newaxis]
+        self.means.append(mean)
+        self.variances.append(folded[:, 0, 0])
+        self.covariances.append(folded)
+        self.nPair += 1
+
+    def getNormalizedCovariances(self):
+        """Return the average over pairs of each amplifier's covariances divided by its mean signal.
+
+        Returns
+        -------
+        xcorr : `dict` of `numpy.ndarray`
+            The ``(maxLag + 1, maxLag + 1)`` normalized covariances, indexed by ``[dy, dx]``,
+            for each amplifier name.
+        """
+        if self.nPair == 0:
+            raise RuntimeError("No flat pairs have been measured")
+        average = self._sumNormalized/self.nPair
+        return dict(zip(self.ampNames, average))
+
+    def getPhotonTransfer(self):
+        """Return the mean signal and variance of each amplifier for each pair, indexed by amplifier name."""
+        means = np.array(self.means).T
+        variances = np.array(self.variances).T
+        return dict((name, (mean, variance)) for name, mean, variance in zip(self.ampNames, means, variances))
+
+    def getGains(self):
+        """Return the gain of each amplifier, e-/DN, indexed by amplifier name.
+
+        The gain is the inverse slope of a straight line fitted to the amplifier's photon
+        transfer curve; with a single pair it is simply the mean signal over the variance.
+        """
+        gains = {}
+        for name, (mean, variance) in self.getPhotonTransfer().items():
+            if len(mean) > 1 and np.ptp(mean) > 0:
+                gains[name] = 1.0/np.polyfit(mean, variance, 1)[0]
+            else:
+                gains[name] = mean.mean()/variance.mean()
+        return gains
+
+
+def measureCovariances(pairs, detector, maxLag=8, nSigma=5.0, numProcesses=1):
+    """Measure the covariances of all the amplifiers of a CCD from many flat pairs.
+
+    Each pair is measured, all sixteen amplifiers at once, by `measureFlatPair`; the pairs
+    are spread over a pool of processes and the results added to a `CovarianceAccumulator`
+    as they arrive, so only the pairs being measured are ever in memory.
+
+    Parameters
+    ----------
+    pairs : `list` of `tuple`
+        ``(fileName1, fileName2)`` of each pair of raw flats of the CCD.
+    detector : `lsst.afw.cameraGeom.Detector`
+        The CCD.
+    maxLag : `int`
+        The largest lag to measure, pixels.
+    nSigma : `float`
+        Rejection threshold for pixels of the difference images.
+    numProcesses : `int`
+        Number of processes measuring pairs.
+
+    Returns
+    -------
+    accumulator : `CovarianceAccumulator`
+        The accumulated measurements.
+    """
+    amps = list(detector)
+    groups = groupAmpsByGeometry(amps)
+    accumulator = CovarianceAccumulator([amp.getName() for amp in amps], maxLag)
+    args = [(fileName1, fileName2, groups, maxLag, nSigma) for fileName1, fileName2 in pairs]
+
+    if numProcesses == 1:
+        results = map(measureFlatPair, args)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(numProcesses)
+        results = pool.imap_unordered(measureFlatPair, args)
+    try:
+        for mean, cov in results:
+            accumulator.add(mean, cov)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return accumulator
+
+
+def tileQuadrant(quadrant):
+    """Reflect a quadrant of a symmetric array about both axes.
+
+    Parameters
+    ----------
+    quadrant : `numpy.ndarray`
+        The values for ``0 <= dx, dy <= maxLag``, as ``(maxLag + 1, maxLag + 1)`` indexed by ``[dy, dx]``.
+
+    Returns
+    -------
+    full : `numpy.ndarray`
+        The values for ``-maxLag <= dx, dy <= maxLag``, as ``(2*maxLag + 1, 2*maxLag + 1)``
+        with ``(dx, dy) = (0, 0)`` at the centre.
+    """
+    rows = np.concatenate([quadrant[:, :0:-1], quadrant], axis=1)
+    return np.concatenate([rows[:0:-1], rows], axis=0)
+
+
+def solveKernel(source, maxIter=10000, eLevel=5.0e-14):
+    """Solve Poisson's equation for a brighter-fatter kernel by successive over-relaxation.
+
+    The kernel ``K`` satisfies ``del^2 K = source`` (with the five-point Laplacian) and
+    vanishes just outside the array.  Each iteration updates all the "red" and then all the
+    "black" pixels of a checkerboard at once, with Chebyshev acceleration.
+
+    Parameters
+    ----------
+    source : `numpy.ndarray`
+        The source term, e.g. as computed by `makeKernel`.
+    maxIter : `int`
+        The maximum number of iterations.
+    eLevel : `float`
+        The iteration stops when the summed absolute residual has fallen by this factor.
+
+    Returns
+    -------
+    kernel : `numpy.ndarray`
+        The kernel, of the same shape as ``source``.
+    converged : `bool`
+        Did the residual fall by ``eLevel`` within ``maxIter`` iterations?
+    """
+    height, width = source.shape
+    func = np.zeros((height + 2, width + 2))
+    interior = func[1:-1, 1:-1]
+    parity = np.add.outer(np.arange(height), np.arange(width)) % 2
+    colors = [parity == 0, parity == 1]
+    rhoSpe = np.cos(np.pi/height)       # spectral radius of the Jacobi iteration (for a square array)
+
+    def getResidual():
+        return func[1:-1, :-2] + func[1:-1, 2:] + func[:-2, 1:-1] + func[2:, 1:-1] - 4.0*interior - source
+
+    inError = np.abs(getResidual()).sum()
+    omega = 1.0
+    for i in range(2*maxIter):
+        residual = getResidual()
+        if np.abs(residual).sum() <= inError*eLevel:
+            return interior.copy(), True
+        color = colors[i % 2]
+        interior[color] += 0.25*omega*residual[color]
+        omega = 1.0/(1.0 - 0.5*rhoSpe**2) if i == 0 else 1.0/(1.0 - 0.25*rhoSpe**2*omega)
+
+    return interior.copy(), False
+
+
+def _clippedMean(stack, nSigma, nIter=3):
+    """Return the iteratively sigma-clipped mean along the first axis of a stack."""
+    stack = np.array(stack, dtype=np.float64)
+    for i in range(nIter):
+        mean = np.nanmean(stack, axis=0)
+        limit = nSigma*np.nanstd(stack, axis=0)
+        with np.errstate(invalid="ignore"):
+            reject = np.abs(stack - mean) > limit
+        if not reject.any():
+            break
+        stack[reject] = np.nan
+    return np.nanmean(stack, axis=0)
+
+
+def makeKernel(accumulator, gains, rejectLevel=0.2, nSigma=3.0, maxIter=10000, eLevel=5.0e-14):
+    """Solve for the brighter-fatter kernel of a CCD from the covariances of its flat pairs.
+
+    For each pair and amplifier the source term ``(mean*delta/gain - cov)/mean**2`` (i.e. the
+    deficit of the variance with respect to Poisson statistics and the covariances of the
+    neighbouring pixels, in electrons, normalized by the squared signal) is reflected into
+    a full array.  Sources whose sum is more than ``rejectLevel`` of the sum of their absolute
+    values (charge isn't conserved) are rejected; the others are averaged with clipping, and
+    the kernel is solved for with `solveKernel`.
+
+    Parameters
+    ----------
+    accumulator : `CovarianceAccumulator`
+        The measurements of the flat pairs, as returned by `measureCovariances`.
+    gains : `dict` of `float`
+        The gain of each amplifier, e-/DN, indexed by amplifier name.
+    rejectLevel : `float`
+        The largest allowed ratio of the sum of a source term to the sum of its absolute values.
+    nSigma : `float`
+        The clipping threshold when averaging the source terms, standard deviations.
+    maxIter : `int`
+        The maximum number of iterations of `solveKernel`.
+    eLevel : `float`
+        The fall in the residual at which `solveKernel` has converged.
+
+    Returns
+    -------
+    kernel : `numpy.ndarray`
+        The kernel, as ``(2*maxLag + 1, 2*maxLag + 1)``.
+    converged : `bool`
+        Did `solveKernel` converge?
+    nSource : `int`
+        The number of (pair, amplifier) source terms used.
+    """
+    gain = np.array([gains[name] for name in accumulator.ampNames])
+    sources = []
+    for mean, folded in zip(accumulator.means, accumulator.covariances):
+        ampSources = -folded
+        ampSources[:, 0, 0] += mean/gain
+        ampSources /= (mean**2)[:, np.newaxis, np.newaxis]
+        for ampSource in ampSources:
+            full = tileQuadrant(ampSource)
+            if np.abs(full.sum()) <= rejectLevel*np.abs(full).sum():
+                sources.append(full)
+    if len(sources) == 0:
+        raise RuntimeError("The covariances of all %d flat pairs were rejected" % accumulator.nPair)
+
+    kernel, converged = solveKernel(_clippedMean(sources, nSigma), maxIter=maxIter, eLevel=eLevel)
+    return kernel, converged, len(sources)
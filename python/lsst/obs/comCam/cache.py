@@ -0,0 +1,185 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Process-wide caches of expensive obs_comCam objects."""
+
+from __future__ import division, print_function
+
+import collections
+import os
+import threading
+
+__all__ = ["ObjectCache", "fileSignature", "getCacheStats"]
+
+_caches = {}                            # all ObjectCaches, indexed by name
+
+
+def fileSignature(*fileNames):
+    """Return a value that changes whenever any of the files is modified.
+
+    Parameters
+    ----------
+    *fileNames : `str`
+        The files to check.
+
+    Returns
+    -------
+    signature : `tuple`
+        The name, modification time and size of each file.
+    """
+    signature = []
+    for fileName in fileNames:
+        st = os.stat(fileName)
+        signature.append((fileName, st.st_mtime, st.st_size))
+    return tuple(signature)
+
+
+class _PendingValue(object):
+    """A value being built by one thread, for which other threads may wait."""
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.event = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class ObjectCache(object):
+    """A thread-safe cache of objects that are built on first use.
+
+    Values are built without holding the cache's lock, so different keys are built
+    concurrently; threads wanting a key that is being built wait for it rather than
+    building it again.
+
+    Parameters
+    ----------
+    name : `str`
+        Name under which the cache's statistics are reported by `getCacheStats`.
+    maxSize : `int`, optional
+        Maximum number of values to hold; when full, the least recently used value
+        is evicted.  If `None` the cache is unbounded.
+    """
+
+    def __init__(self, name, maxSize=None):
+        self.name = name
+        self.maxSize = maxSize
+        self._lock = threading.RLock()
+        self._items = collections.OrderedDict()  # key: (signature, value), least recently used first
+        self._pending = {}              # key: _PendingValue, for values being built
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _caches[name] = self
+
+    def get(self, key, factory, signature=None):
+        """Return the cached value for ``key``, building it if needed.
+
+        Parameters
+        ----------
+        key : hashable
+            The key of the value.
+        factory : callable
+            Called with no arguments to build the value on a miss.
+        signature : hashable, optional
+            If this differs from the signature the value was cached with (e.g. because
+            a file it was built from has changed) the value is rebuilt.
+
+        Returns
+        -------
+        value : `object`
+            The cached value.
+        """
+        while True:
+            with self._lock:
+                item = self._items.pop(key, None)
+                if item is not None and item[0] == signature:
+                    self.hits += 1
+                    self._items[key] = item
+                    return item[1]
+
+                pending = self._pending.get(key)
+                isBuilder = pending is None
+                if isBuilder:
+                    pending = self._pending[key] = _PendingValue(signature)
+                    self.misses += 1
+
+            if isBuilder:
+                break
+
+            pending.event.wait()        # another thread is building the value
+            if not pending.failed and pending.signature == signature:
+                with self._lock:
+                    self.hits += 1
+                return pending.value
+            # the build failed or was for a different signature; try again
+
+        try:
+            value = factory()
+        except Exception:
+            pending.failed = True
+            raise
+        else:
+            pending.value = value
+            with self._lock:
+                if self._pending.get(key) is pending:  # i.e. not cleared or invalidated meanwhile
+                    self._items[key] = (signature, value)
+                    self._evict()
+            return value
+        finally:
+            with self._lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+            pending.event.set()
+
+    def _evict(self):
+        """Evict least recently used values until there are no more than maxSize."""
+        if self.maxSize is not None:
+            while len(self._items) > self.maxSize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def setMaxSize(self, maxSize):
+        """Change the maximum number of values held, evicting values if needed."""
+        with self._lock:
+            self.maxSize = maxSize
+            self._evict()
+
+    def invalidate(self, key):
+        """Remove the value for ``key``, if it is cached."""
+        with self._lock:
+            self._items.pop(key, None)
+            self._pending.pop(key, None)
+
+    def clear(self):
+        """Remove all cached values."""
+        with self._lock:
+            self._items.clear()
+            self._pending.clear()
+
+    def getStats(self):
+        """Return a `dict` of the number of hits, misses, evictions and cached values."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size=len(self._items))
+
+
+def getCacheStats():
+    """Return the statistics of every `ObjectCache`, indexed by cache name."""
+    return dict((name, cache.getStats()) for name, cache in _caches.items())
@@ -0,0 +1,112 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""A CalibCombineTask that combines the inputs of constructBias/Dark/Flat with `combineMaskedFiles`."""
+
+from __future__ import division, print_function
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.pex.config import Field
+from lsst.pipe.drivers.constructCalibs import CalibCombineConfig, CalibCombineTask
+from lsst.obs.comCam.combine import combineMaskedFiles
+
+__all__ = ["ComCamCalibCombineConfig", "ComCamCalibCombineTask"]
+
+_METHODS = {                            # combineMaskedFiles' method for each afwMath statistic
+    afwMath.MEAN: "mean",
+    afwMath.MEDIAN: "median",
+    afwMath.MEANCLIP: "clippedMean",
+}
+
+
+class ComCamCalibCombineConfig(CalibCombineConfig):
+    memoryBudget = Field(dtype=int, default=1 << 30,
+                         doc="Memory used for the bands of rows being combined, bytes")
+    numProcesses = Field(dtype=int, default=1, doc="Number of processes combining bands in parallel")
+    minSigma = Field(dtype=float, default=None, optional=True,
+                     doc="Floor on the robust sigma used for clipping (meanclip); if None, the "
+                     "median robust sigma of each band's pixels")
+
+    def validate(self):
+        CalibCombineConfig.validate(self)
+        if self.combine not in _METHODS:
+            raise ValueError("combine must be one of afwMath.MEAN, MEDIAN or MEANCLIP; saw %s" % self.combine)
+
+
+class ComCamCalibCombineTask(CalibCombineTask):
+    """Combine calib inputs from their files, one band of rows at a time, with `combineMaskedFiles`.
+
+    Retarget ``config.combination`` of constructBias/Dark/Flat to use it.  The inputs'
+    images, masks and variances are combined directly from the files written by the ISR
+    stage, without going through the butler for each band.  As for `CalibCombineTask`,
+    pixels with any of ``config.mask`` set are ignored (and for meanclip, so are those
+    clipped with ``config.clip`` and ``config.nIter``); pixels with no good inputs are
+    flagged NO_DATA in the combined mask.
+    """
+    ConfigClass = ComCamCalibCombineConfig
+
+    def run(self, sensorRefList, expScales=None, finalScale=None, inputName="postISRCCD"):
+        """Combine the calib inputs of a single sensor.
+
+        Parameters
+        ----------
+        sensorRefList : `list` of `lsst.daf.persistence.ButlerDataRef`
+            The inputs to combine; `None` entries are skipped.
+        expScales : `list` of `float`, optional
+            The scale of each input, by which it is divided before combination.
+        finalScale : `float`, optional
+            The desired background level of the combined image.
+        inputName : `str`
+            The dataset type of the inputs.
+
+        Returns
+        -------
+        combined : `lsst.afw.image.MaskedImageF`
+            The combined image.
+        """
+        if expScales is None:
+            expScales = [1.0]*len(sensorRefList)
+        fileNames = []
+        scales = []
+        for sensorRef, scale in zip(sensorRefList, expScales):
+            if sensorRef is not None:
+                fileNames.append(sensorRef.get(inputName + "_filename")[0])
+                scales.append(scale)
+        if len(fileNames) == 0:
+            raise RuntimeError("No valid input data")
+
+        image, variance, nGood = combineMaskedFiles(fileNames, method=_METHODS[self.config.combine],
+                                                    scales=scales, maskPlanes=self.config.mask,
+                                                    nSigma=self.config.clip, nIter=self.config.nIter,
+                                                    minSigma=self.config.minSigma,
+                                                    memoryBudget=self.config.memoryBudget,
+                                                    numProcesses=self.config.numProcesses)
+
+        combined = afwImage.MaskedImageF(afwImage.ImageF(image), None, afwImage.ImageF(variance))
+        combined.getMask().getArray()[nGood == 0] |= afwImage.Mask.getPlaneBitMask("NO_DATA")
+
+        if finalScale is not None:
+            background = self.stats.run(combined)
+            self.log.info("Measured background of stack is %f; adjusting to %f" % (background, finalScale))
+            combined *= finalScale/background
+
+        return combined
@@ -0,0 +1,165 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""In-memory index of the validity ranges of ComCam calibration products."""
+
+from __future__ import division, print_function
+
+import bisect
+import sqlite3
+
+from lsst.obs.comCam.cache import fileSignature
+
+__all__ = ["CalibIntervalIndex", "registrySignature"]
+
+
+def _toDate(date):
+    """Reduce an ISO date or date-time to its YYYY-MM-DD part, as used by calib validity ranges."""
+    return str(date)[:10]
+
+
+def registrySignature(conn):
+    """Return a value that changes whenever a registry's database file is modified.
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+        Connection to the registry.
+
+    Returns
+    -------
+    signature : `tuple` or `None`
+        The `~lsst.obs.comCam.cache.fileSignature` of the main database file,
+        or `None` for an in-memory database.
+    """
+    for seq, name, fileName in conn.execute("PRAGMA database_list"):
+        if name == "main":
+            return fileSignature(fileName) if fileName else None
+    return None
+
+
+class CalibIntervalIndex(object):
+    """The validity ranges of calibration products, searchable in O(log n).
+
+    Within each calib type, CCD and filter the ranges are assumed not to overlap, as
+    ensured by the validity-range update done when calibs are ingested; ranges for
+    different filters are indexed separately, as they may overlap.
+
+    Parameters
+    ----------
+    rows : `dict`
+        For each calib type (e.g. "bias"), a list of
+        ``(ccd, filter, calibDate, validStart, validEnd)`` tuples.
+    """
+
+    def __init__(self, rows):
+        self._intervals = {}            # (calibType, ccd, filter): ([validStart], [(validEnd, calibDate)])
+        self._filters = {}              # (calibType, ccd): [filter]
+        self._size = 0
+        for calibType, calibRows in rows.items():
+            groups = {}
+            for ccd, filterName, calibDate, validStart, validEnd in calibRows:
+                interval = (_toDate(validStart), _toDate(validEnd), calibDate)
+                groups.setdefault((calibType, ccd, filterName), []).append(interval)
+                self._size += 1
+            for key, intervals in groups.items():
+                intervals.sort()
+                self._intervals[key] = ([start for start, end, calibDate in intervals],
+                                        [(end, calibDate) for start, end, calibDate in intervals])
+                self._filters.setdefault(key[:2], []).append(key[2])
+
+    @classmethod
+    def fromRegistry(cls, conn, calibTypes=("bias", "dark", "flat", "fringe")):
+        """Load the index from a calibration registry.
+
+        Parameters
+        ----------
+        conn : `sqlite3.Connection`
+            Connection to the calib registry written by `ComCamCalibsParseTask` ingestion.
+        calibTypes : iterable of `str`
+            The calib tables to load; tables that don't exist are skipped.
+        """
+        rows = {}
+        for calibType in calibTypes:
+            try:
+                rows[calibType] = conn.execute("SELECT ccd, filter, calibDate, validStart, validEnd FROM %s" %
+                                               calibType).fetchall()
+            except sqlite3.OperationalError:
+                continue                # no such table
+        return cls(rows)
+
+    def __len__(self):
+        return self._size
+
+    def lookup(self, calibType, ccd, date, filterName=None):
+        """Find the calibDate of the calib valid at a given date.
+
+        Parameters
+        ----------
+        calibType : `str`
+            The type of calib, e.g. "flat".
+        ccd : `str`
+            The CCD name.
+        date : `str`
+            The ISO date (or date-time) of the observation.
+        filterName : `str`, optional
+            The filter; `None` for calibs that don't depend on the filter, in which case
+            the calib for any filter is accepted.
+
+        Returns
+        -------
+        calibDate : `str` or `None`
+            The calibDate of the valid calib, or `None` if there is none.
+        """
+        date = _toDate(date)
+        if filterName is not None:
+            return self._lookup((calibType, ccd, filterName), date)
+        #
+        # Accept a calib for any filter; if several are valid, take the one that became valid last
+        #
+        best = None
+        for filterName in self._filters.get((calibType, ccd), []):
+            key = (calibType, ccd, filterName)
+            calibDate = self._lookup(key, date)
+            if calibDate is not None:
+                start = self._getStart(key, date)
+                if best is None or start > best[0]:
+                    best = (start, calibDate)
+        return None if best is None else best[1]
+
+    def _find(self, key, date):
+        """Return the index of the last range of a group starting on or before a date, or -1."""
+        intervals = self._intervals.get(key)
+        if intervals is None:
+            return -1
+        return bisect.bisect_right(intervals[0], date) - 1
+
+    def _getStart(self, key, date):
+        """Return the start of the range of a group found by `_find`."""
+        return self._intervals[key][0][self._find(key, date)]
+
+    def _lookup(self, key, date):
+        """Return the calibDate of a group's range containing a YYYY-MM-DD date, or `None`."""
+        i = self._find(key, date)
+        if i < 0:
+            return None
+        end, calibDate = self._intervals[key][1][i]
+        return calibDate if date <= end else None
@@ -20,17 +20,144 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 from __future__ import division, print_function
+import copy
+import hashlib
 import os.path
+import pickle
+import tempfile
+import yaml
+import lsst.afw.cameraGeom as cameraGeom
+import lsst.afw.geom as afwGeom
+import lsst.log as lsstLog
 import lsst.utils as utils
 import lsst.obs.base.yamlCamera as yamlCamera
+from lsst.obs.comCam.cache import ObjectCache, fileSignature
+
+__all__ = ["makeCamera", "getCameraCacheDir", "loadCameraDescription"]
+
+_cameraCache = ObjectCache("camera")
+_descriptionCache = ObjectCache("cameraDescription")  # parsed camera.yaml files, by filename
+
+
+def getCameraCacheDir():
+    """Return the directory holding compiled camera descriptions, or `None` if they are disabled.
+
+    The directory is $OBS_COMCAM_CACHE_DIR; compiled descriptions are only used if it is
+    set (and not empty).
+    """
+    return os.environ.get("OBS_COMCAM_CACHE_DIR") or None
+
+
+def _parseCameraDescription(cameraYamlFile):
+    """Parse a camera's YAML description, going via a compiled (pickled) copy if possible.
+
+    The compiled copy holds only the parsed YAML (i.e. `dict`, `list` and scalars), and is
+    named for the SHA-1 of the YAML file's contents, so any change to the file causes it to
+    be parsed and compiled again.
+    """
+    cacheDir = getCameraCacheDir()
+    if cacheDir is None:
+        with open(cameraYamlFile) as fd:
+            return yaml.safe_load(fd)
+
+    log = lsstLog.Log.getLogger('obs.comCam.makeCamera')
+
+    with open(cameraYamlFile, "rb") as fd:
+        contents = fd.read()
+    digest = hashlib.sha1(contents).hexdigest()
+    baseName = os.path.splitext(os.path.basename(cameraYamlFile))[0]
+    compiledFile = os.path.join(cacheDir, "%s-%s.pickle" % (baseName, digest))
+
+    if os.path.exists(compiledFile):
+        try:
+            with open(compiledFile, "rb") as fd:
+                return pickle.load(fd)
+        except Exception as e:
+            log.warn("Unable to read compiled camera description %s (%s); reparsing it", compiledFile, e)
+
+    description = yaml.safe_load(contents)
+
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        fd, tmpFile = tempfile.mkstemp(dir=cacheDir, prefix=baseName, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                pickle.dump(description, fout, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, compiledFile)
+        finally:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+    except Exception as e:
+        log.warn("Unable to write compiled camera description %s (%s); it will be reparsed in every process",
+                 compiledFile, e)
+
+    return description
+
+
+def _makeCameraFromDescription(description):
+    """Build a camera from a parsed camera description, as `lsst.obs.base.yamlCamera.makeCamera` does.
+
+    Parameters
+    ----------
+    description : `dict`
+        The parsed YAML, as returned by `loadCameraDescription`; it is not modified.
+    """
+    cameraParams = copy.deepcopy(description)  # makeCamera pops values from the description
+    plateScale = afwGeom.Angle(cameraParams["plateScale"], afwGeom.arcseconds)
+    nativeSys = cameraGeom.CameraSys(cameraParams["transforms"].pop("nativeSys"))
+    transforms = yamlCamera.makeTransformDict(nativeSys, cameraParams["transforms"], plateScale)
+
+    ccdParams = cameraParams["CCDs"]
+    detectorConfigList = yamlCamera.makeDetectorConfigList(ccdParams)
+    amplifierDict = dict((ccdName, yamlCamera.makeAmpInfoCatalog(ccdValues))
+                         for ccdName, ccdValues in ccdParams.items())
+
+    return cameraGeom.makeCameraFromCatalogs(cameraParams["name"], detectorConfigList, nativeSys, transforms,
+                                             amplifierDict)
+
+
+def _readCamera(cameraYamlFile):
+    """Build a camera from its YAML description, using the compiled description if enabled."""
+    if getCameraCacheDir() is None:
+        return yamlCamera.makeCamera(cameraYamlFile)
+    return _makeCameraFromDescription(loadCameraDescription(cameraYamlFile))
 
 
 def makeCamera(cameraYamlFile=None):
     """Make a camera for the Commissioning Camera (comCam)
+
+    The camera is built once per process and reused until the YAML file changes.  If
+    `getCameraCacheDir` is set, new processes build it from the compiled description
+    there (when that is up to date) rather than parsing the YAML.
     """
     packageName = 'obs_comCam'
 
     if not cameraYamlFile:
         cameraYamlFile = os.path.join(utils.getPackageDir(packageName), "policy", "camera.yaml")
 
-    return yamlCamera.makeCamera(cameraYamlFile)
+    return _cameraCache.get(cameraYamlFile, lambda: _readCamera(cameraYamlFile),
+                            signature=fileSignature(cameraYamlFile))
+
+
+def loadCameraDescription(cameraYamlFile=None):
+    """Read a camera description, without building a camera from it.
+
+    This is for code that only needs the CCDs' and amplifiers' entries (e.g. serial numbers
+    or readout corners) and so need not pay for `makeCamera`.
+
+    Parameters
+    ----------
+    cameraYamlFile : `str`, optional
+        The camera description; defaults to obs_comCam's policy/camera.yaml.
+
+    Returns
+    -------
+    description : `dict`
+        The parsed YAML; it is cached until the file changes, so must not be modified.
+    """
+    if cameraYamlFile is None:
+        cameraYamlFile = os.path.join(utils.getPackageDir("obs_comCam"), "policy", "camera.yaml")
+
+    return _descriptionCache.get(cameraYamlFile, lambda: _parseCameraDescription(cameraYamlFile),
+                                 signature=fileSignature(cameraYamlFile))
@@ -24,18 +24,30 @@
 from __future__ import division, print_function
 
 import os
+import re
+from multiprocessing.pool import ThreadPool
 
 import lsst.afw.image.utils as afwImageUtils
-import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 from lsst.afw.fits import readMetadata
 from lsst.obs.base import CameraMapper, MakeRawVisitInfo
 import lsst.daf.persistence as dafPersist
 
-from lsst.obs.comCam import makeCamera
+from lsst.obs.comCam import instrument, makeCamera
+from lsst.obs.comCam.cache import ObjectCache, fileSignature
+from lsst.obs.comCam.calibIndex import CalibIntervalIndex, registrySignature
+from lsst.obs.comCam.crosstalk import applyCrosstalk, loadCrosstalk
+from lsst.obs.comCam.defects import DefectIndex, DefectSet
+from lsst.obs.comCam.headerSidecar import HeaderSidecar, getSidecarLocation
+from lsst.obs.comCam.overscan import subtractCcdOverscan
+from lsst.obs.comCam.rawReader import LazyRawCcd, findRawFile, findRawLocation, readLazyRawCcd, readRawCcd
 
 
-__all__ = ["ComCamMapper"]
+__all__ = ["ComCamMapper", "RawVisit"]
+
+_mapperCache = ObjectCache("mapper")
+_assembleTaskCache = ObjectCache("assembleCcdTask")
+_hduSuffixRe = re.compile(r"\[(\d+)\]$")
 
 
 class ComCamMakeRawVisitInfo(MakeRawVisitInfo):
@@ -71,11 +83,164 @@ class ComCamMakeRawVisitInfo(MakeRawVisitInfo):
         return self.offsetDate(dateObs, 0.5*exposureTime)
 
 
+def _makeAssembleTask(doTrim=False):
+    """Make the task used by assemble_raw to assemble amplifiers into a CCD."""
+    from lsst.ip.isr import AssembleCcdTask
+
+    config = AssembleCcdTask.ConfigClass()
+    config.doTrim = doTrim
+
+    return AssembleCcdTask(config=config)
+
+
+def _getMapper():
+    """Return a process-wide ComCamMapper, rebuilt only if its policy or camera description changes."""
+    policyFile = dafPersist.Policy.defaultPolicyFile(ComCamMapper.packageName, "comCamMapper.yaml", "policy")
+    cameraFile = os.path.join(os.path.dirname(policyFile), "camera.yaml")
+
+    return _mapperCache.get(policyFile, ComCamMapper, signature=fileSignature(policyFile, cameraFile))
+
+
+def makeAmpExposures(rawCcd, overscanMode=None, crosstalk=None):
+    """Wrap the pixels of a `~lsst.obs.comCam.rawReader.RawCcd` as per-amplifier exposures.
+
+    The exposures share the pixels of ``rawCcd``; no copies are made.
+
+    Parameters
+    ----------
+    rawCcd : `lsst.obs.comCam.rawReader.RawCcd`
+        The raw CCD, with its detector set
+    overscanMode : `str`, optional
+        If not `None` ("subtract" or "trim"), subtract the serial and parallel overscans of all
+        the amplifiers in one pass with `~lsst.obs.comCam.overscan.subtractCcdOverscan`, returning
+        float exposures; see `ComCamMapper`
+    crosstalk : `lsst.obs.comCam.crosstalk.CrosstalkModel`, optional
+        If not `None`, subtract the crosstalk of all the amplifiers in one matrix product
+        once the overscan is subtracted; requires ``overscanMode``
+
+    Returns
+    -------
+    ampDict : `dict` of `lsst.afw.image.ExposureI` or `lsst.afw.image.ExposureF`
+        The amplifier exposures, indexed by amplifier name
+    """
+    if overscanMode is None:
+        if crosstalk is not None:
+            raise RuntimeError("Crosstalk can only be corrected once the overscan is subtracted")
+        arrays = [rawCcd.getAmpArray(i) for i in range(len(rawCcd))]
+        makeImage = afwImage.ImageI
+    else:
+        pixels = rawCcd.pixels
+        if pixels is None:
+            pixels = [rawCcd.getAmpArray(i) for i in range(len(rawCcd))]
+        arrays = subtractCcdOverscan(list(rawCcd.detector), pixels)
+        if crosstalk is not None:
+            applyCrosstalk(arrays, crosstalk.coeffs, crosstalk.flips)
+        makeImage = afwImage.ImageF
+
+    ampDict = {}
+    for amp, array in zip(rawCcd.detector, arrays):
+        ampDict[amp.getName()] = _wrapAmpArray(array, rawCcd.detector, makeImage)
+
+    return ampDict
+
+
+def _wrapAmpArray(array, detector, makeImage=afwImage.ImageI):
+    """Wrap an amplifier's pixels, without copying them, as an exposure of the detector."""
+    ampExp = afwImage.makeExposure(afwImage.makeMaskedImage(makeImage(array, deep=False)))
+    ampExp.setDetector(detector)
+    return ampExp
+
+
+def makeAmpExposure(rawCcd, ampName):
+    """Wrap the pixels of one amplifier of a `~lsst.obs.comCam.rawReader.RawCcd` as an exposure.
+
+    For a `~lsst.obs.comCam.rawReader.LazyRawCcd` (the "raw_lazy" dataset) only that
+    amplifier's pixels are read.
+
+    Parameters
+    ----------
+    rawCcd : `lsst.obs.comCam.rawReader.RawCcd`
+        The raw CCD, with its detector set
+    ampName : `str`
+        The name of the amplifier, e.g. "10"
+
+    Returns
+    -------
+    ampExp : `lsst.afw.image.ExposureI`
+        The untrimmed amplifier, sharing the pixels of ``rawCcd``
+    """
+    return _wrapAmpArray(rawCcd.getAmpArray(rawCcd.getAmpIndex(ampName)), rawCcd.detector)
+
+
+def assembleRawCcd(ampDict, md, dataId, mapper=None, doTrim=False):
+    """Assemble amplifier exposures into a standardized raw CCD exposure.
+
+    Parameters
+    ----------
+    ampDict : `dict` of `lsst.afw.image.Exposure`
+        The amplifier exposures, indexed by amplifier name
+    md : `lsst.daf.base.PropertyList`
+        The primary header
+    dataId : `dict`
+        The data ID of the CCD
+    mapper : `ComCamMapper`, optional
+        The mapper used to standardize the exposure; defaults to a process-wide instance
+    doTrim : `bool`
+        Trim the overscan regions while assembling?
+
+    Returns
+    -------
+    exposure : `lsst.afw.image.exposure.exposure`
+        The assembled exposure
+    """
+    assembleTask = _assembleTaskCache.get("trimmed" if doTrim else "raw", lambda: _makeAssembleTask(doTrim))
+
+    exposure = assembleTask.assembleCcd(ampDict)
+    exposure.setMetadata(md)
+    #
+    # We need to standardize, but have no legal way to call std_raw.  The butler should do this for us.
+    #
+    if mapper is None:
+        mapper = _getMapper()
+
+    return mapper.std_raw(exposure, dataId)
+
+
+class RawVisit(object):
+    """The assembled raw exposures of all the CCDs of a visit.
+
+    Parameters
+    ----------
+    exposures : `dict` of `lsst.afw.image.Exposure`
+        The assembled CCDs, indexed by CCD name
+    metadata : `lsst.daf.base.PropertyList`
+        The primary header of one of the CCDs, taken as the visit's header
+    visitInfo : `lsst.afw.image.VisitInfo`
+        The VisitInfo of the same CCD, taken as the visit's; each exposure keeps its own
+        VisitInfo, as the CCDs' exposure times and dates may differ slightly
+    """
+
+    def __init__(self, exposures, metadata, visitInfo):
+        self.exposures = exposures
+        self.metadata = metadata
+        self.visitInfo = visitInfo
+
+    def __len__(self):
+        return len(self.exposures)
+
+    def __getitem__(self, ccd):
+        return self.exposures[ccd]
+
+
+@instrument.timed()
 def assemble_raw(dataId, componentInfo, cls):
     """Called by the butler to construct the composite type "raw".
 
     Note that we still need to define "_raw" and copy various fields over.
 
+    The components are either "raw_mef" (the whole CCD, read in a single pass) or
+    the per-amplifier "raw_amp" together with the primary header "raw_hdu".
+
     Parameters
     ----------
     dataId : `lsst.daf.persistence.dataId.DataId`
@@ -90,12 +255,11 @@ def assemble_raw(dataId, componentInfo, cls):
     exposure : `lsst.afw.image.exposure.exposure`
         The assembled exposure
     """
-    from lsst.ip.isr import AssembleCcdTask
+    if 'raw_mef' in componentInfo:
+        rawCcd = componentInfo['raw_mef'].obj
+        mapper = rawCcd.mapper if rawCcd.mapper is not None else _getMapper()  # i.e. the butler's mapper
 
-    config = AssembleCcdTask.ConfigClass()
-    config.doTrim = False
-
-    assembleTask = AssembleCcdTask(config=config)
+        return mapper.assembleRawMef(rawCcd, dataId)
 
     ampExps = componentInfo['raw_amp'].obj
     if len(ampExps) == 0:
@@ -107,17 +271,9 @@ def assemble_raw(dataId, componentInfo, cls):
     for amp, ampExp in zip(ccd, ampExps):
         ampDict[amp.getName()] = ampExp
 
-    exposure = assembleTask.assembleCcd(ampDict)
-
     md = componentInfo['raw_hdu'].obj
-    exposure.setMetadata(md)
-    #
-    # We need to standardize, but have no legal way to call std_raw.  The butler should do this for us.
-    #
-    ccm = ComCamMapper()
-    exposure = ccm.std_raw(exposure, dataId)
 
-    return exposure
+    return assembleRawCcd(ampDict, md, dataId)
 
 
 class ComCamMapper(CameraMapper):
@@ -125,9 +281,67 @@ class ComCamMapper(CameraMapper):
 
     packageName = 'obs_comCam'
     MakeRawVisitInfoClass = ComCamMakeRawVisitInfo
+    visitInfoCache = ObjectCache("visitInfo", maxSize=4096)  # VisitInfos, by (fileName, hdu)
+    sidecarCache = ObjectCache("headerSidecar", maxSize=8)  # HeaderSidecars, by filename
+    cachedCalibs = ("bias", "dark", "flat", "fringe")  # calibs read through calibCache
+    filteredCalibs = ("flat", "fringe")  # calibs whose lookup depends on the filter
+    defectCache = ObjectCache("defects", maxSize=9)  # recently read DefectSets, by filename
+    defectMaskCache = ObjectCache("defectMask", maxSize=9)  # their rasterized (read-only) masks
+    mappedRawCache = ObjectCache("mappedRaw", maxSize=9)  # memory-mapped raws read by raw_amp, by filename
+
+    overscanModes = (None, "subtract", "trim")  # the allowed values of overscanMode
+
+    def __init__(self, inputPolicy=None, overscanMode=None, doCrosstalk=False, crosstalkFile=None,
+                 rawDecompressProcesses=1, useHeaderSidecar=True, calibCacheSize=None, useMmapForRaw=False,
+                 **kwargs):
+        """Initialization for the ComCam Mapper.
+
+        The options may be given as the ``mapperArgs`` of the butler's repository arguments, and
+        are held by this instance (so that ``butler.get("raw")`` and `readRawVisit` agree).
+
+        Parameters
+        ----------
+        inputPolicy : `lsst.daf.persistence.Policy`, optional
+            Unused; the policy is always obs_comCam's comCamMapper.yaml
+        overscanMode : `str`, optional
+            How to treat the overscan when assembling raw_mef into raw:
+
+            - `None`: leave it (the assembled raw is untrimmed ints, for ISR to process)
+            - "subtract": subtract the serial and parallel overscan of all amps in one vectorized pass
+            - "trim": as "subtract", and also trim the overscan while assembling
+
+            When set, ISR's own overscan correction (and, for "trim", assembly) should be disabled.
+        doCrosstalk : `bool`
+            Subtract the inter-amplifier crosstalk of each CCD while assembling raw_mef into raw?
+            Requires overscanMode; when set, ISR's doCrosstalk should be False.
+        crosstalkFile : `str`, optional
+            The crosstalk coefficients; defaults to obs_comCam's policy/crosstalk.yaml
+        rawDecompressProcesses : `int`
+            Number of processes used to decompress tile-compressed (.fz) raws
+        useHeaderSidecar : `bool`
+            Serve raw_md and raw_visitInfo from the ingest header sidecars, when present?
+        calibCacheSize : `int`, optional
+            Number of calib exposures to keep in memory; defaults to one of each of
+            `cachedCalibs` for every CCD, so that processing a whole visit rereads none.
+            Each full-frame calib is ~160MB, so reduce this if memory is short.
+        useMmapForRaw : `bool`
+            Memory-map uncompressed raws read as raw_lazy or raw_amp, rather than reading them?
+            Each amplifier's pixels are then paged in from the file only when used, and the
+            mapping of a CCD is shared by the reads of all its raw_amps.
+        **kwargs
+            Passed to `lsst.obs.base.CameraMapper`
+        """
+        if overscanMode not in self.overscanModes:
+            raise ValueError("overscanMode must be one of %s; saw %r" % (self.overscanModes, overscanMode))
+        if doCrosstalk and overscanMode is None:
+            raise ValueError("doCrosstalk requires an overscanMode")
+        self.overscanMode = overscanMode
+        self.doCrosstalk = doCrosstalk
+        self.crosstalkFile = crosstalkFile
+        self.rawDecompressProcesses = rawDecompressProcesses
+        self.useHeaderSidecar = useHeaderSidecar
+        self.useMmapForRaw = useMmapForRaw
 
-    def __init__(self, inputPolicy=None, **kwargs):
-        """Initialization for the ComCam Mapper."""
         policyFile = dafPersist.Policy.defaultPolicyFile(self.packageName, "comCamMapper.yaml", "policy")
         policy = dafPersist.Policy(policyFile)
 
@@ -140,6 +354,14 @@ class ComCamMapper(CameraMapper):
 
         # self.filterIdMap = {}           # where is this used?  Generating objIds??
 
+        if calibCacheSize is None:
+            calibCacheSize = len(self.camera)*len(self.cachedCalibs)
+        self.calibCache = ObjectCache("calib", maxSize=calibCacheSize)  # calib exposures, by filename
+
+        self._calibIndex = None         # CalibIntervalIndex, loaded on first use
+        self._calibIndexSignature = None  # the calib registry's signature when _calibIndex was loaded
+        self._defectIndex = None        # DefectIndex, loaded on first use
+
         afwImageUtils.defineFilter('NONE', 0.0, alias=['no_filter', "OPEN"])
         afwImageUtils.defineFilter('275CutOn', 0.0, alias=[])
         afwImageUtils.defineFilter('550CutOn', 0.0, alias=[])
@@ -159,6 +381,7 @@ class ComCamMapper(CameraMapper):
         visit = dataId['visit']
         return int(visit)
 
+    @instrument.timed()
     def query_raw_amp(self, format, dataId):
         """!Return a list of tuples of values of the fields specified in format, in order.
 
@@ -180,17 +403,13 @@ class ComCamMapper(CameraMapper):
         else:
             channelIndex = None
 
-        dids = []                       # returned list of dataIds
-        for value in self.query_raw(format, dataId):
-            if channelIndex is None:
-                dids.append(value)
-            else:
-                for c in channels:
-                    did = list(value)
-                    did.insert(channelIndex, c)
-                    dids.append(tuple(did))
-
-        return dids
+        values = self.query_raw(format, dataId)
+        if channelIndex is None:
+            return list(values)
+
+        channels = [(c,) for c in channels]
+        return [value[:channelIndex] + c + value[channelIndex:]
+                for value in map(tuple, values) for c in channels]
     #
     # The composite type "raw" doesn't provide e.g. query_raw, so we defined type _raw in the .paf file
     # with the same template, and forward requests as necessary
@@ -208,14 +427,14 @@ class ComCamMapper(CameraMapper):
 
         This code redirects the call to the right place, necessary because of leading underscore on _raw.
         """
-        return self.map__raw_md(*args, **kwargs)
+        return self._findCompressedRaw(self.map__raw_md(*args, **kwargs))
 
     def map_raw_filename(self, *args, **kwargs):
         """Magic method that is called automatically if it exists.
 
         This code redirects the call to the right place, necessary because of leading underscore on _raw.
         """
-        return self.map__raw_filename(*args, **kwargs)
+        return self._findCompressedRaw(self.map__raw_filename(*args, **kwargs))
 
     def bypass_raw_filename(self, *args, **kwargs):
         """Magic method that is called automatically if it exists.
@@ -229,8 +448,110 @@ class ComCamMapper(CameraMapper):
 
         This code redirects the call to the right place, necessary because of leading underscore on _raw.
         """
-        return self.map__raw_visitInfo(*args, **kwargs)
+        return self._findCompressedRaw(self.map__raw_visitInfo(*args, **kwargs))
+    #
+    # Raws may be stored tile-compressed (.fits.fz) or gzipped (.fits.gz) without the templates saying so,
+    # so the locations of all the raw dataset types are pointed at whichever version exists
+    #
 
+    @staticmethod
+    def _findCompressedRaw(location):
+        """Point a raw's location at its compressed version, if only that exists.
+
+        Parameters
+        ----------
+        location : `lsst.daf.persistence.ButlerLocation`
+            The location returned by the raw's mapping; modified in place.
+
+        Returns
+        -------
+        location : `lsst.daf.persistence.ButlerLocation`
+            The location, so that ``butler.get``, ``butler.datasetExists`` and the bypass
+            functions all see the file that actually exists.
+        """
+        for i, fileName in enumerate(location.getLocationsWithRoot()):
+            found = findRawLocation(fileName)
+            if found != fileName:
+                path = location.locationList[i]  # relative to the repository's root
+                location.locationList[i] = found[len(fileName) - len(path):]
+        return location
+
+    def _mapRaw(self, datasetType, dataId, write):
+        """Map a raw dataset type, allowing for compressed raws when reading."""
+        location = self.exposures[datasetType].map(self, dataId, write)
+        return location if write else self._findCompressedRaw(location)
+
+    def map__raw(self, dataId, write=False):
+        return self._mapRaw("_raw", dataId, write)
+
+    def map_raw_mef(self, dataId, write=False):
+        return self._mapRaw("raw_mef", dataId, write)
+
+    def map_raw_lazy(self, dataId, write=False):
+        return self._mapRaw("raw_lazy", dataId, write)
+
+    def map_raw_amp(self, dataId, write=False):
+        return self._mapRaw("raw_amp", dataId, write)
+
+    @staticmethod
+    def _getRawFile(location):
+        """Return the file and HDU of a raw location, allowing for compressed (.fz or .gz) raws.
+
+        Returns
+        -------
+        fileName : `str`
+            The file, with any [hdu] suffix removed.
+        hdu : `int` or `None`
+            The HDU given by the suffix, if any.
+        """
+        fileName = location.getLocationsWithRoot()[0]
+        mat = _hduSuffixRe.search(fileName)
+        if mat:
+            fileName = fileName[:mat.start()]
+            hdu = int(mat.group(1))
+        else:
+            hdu = None
+        return findRawFile(fileName), hdu
+
+    def _readSidecarMetadata(self, fileName, hdu):
+        """Return a raw's header from its run's header sidecar, or `None` if it isn't available.
+
+        The sidecar is only used if it was written after the raw was last modified.  Each
+        sidecar (holding the headers of a whole run) is read once and cached until it changes,
+        so the headers of the other CCDs and visits of the run are then served from memory.
+
+        Parameters
+        ----------
+        fileName : `str`
+            The raw, as returned by `_getRawFile`.
+        hdu : `int` or `None`
+            The HDU; `None` means the primary HDU.
+        """
+        if not self.useHeaderSidecar:
+            return None
+        sidecarFile, key = getSidecarLocation(fileName)
+        try:
+            signature = fileSignature(sidecarFile)
+            if os.stat(fileName).st_mtime > signature[0][1]:
+                return None
+        except OSError:
+            return None
+        sidecar = self.sidecarCache.get(sidecarFile, lambda: HeaderSidecar.read(sidecarFile),
+                                        signature=signature)
+        return sidecar.getMetadata(key, 0 if hdu is None else hdu)
+
+    def _readRawMetadata(self, fileName, hdu):
+        """Return a raw's header, from its run's header sidecar if possible."""
+        md = self._readSidecarMetadata(fileName, hdu)
+        if md is None:
+            instrument.addIo(nFiles=1)
+            md = readMetadata(fileName, hdu=0 if hdu is None else hdu)
+        return md
+
+    def bypass_raw_md(self, datasetType, pythonType, location, dataId):
+        return self._readRawMetadata(*self._getRawFile(location))
+
+    @instrument.timed()
     def bypass_raw_visitInfo(self, datasetType, pythonType, location, dataId):
         if False:
             # lsst.afw.fits.readMetadata() doesn't honour [hdu] suffixes in filenames
@@ -240,18 +561,290 @@ class ComCamMapper(CameraMapper):
             #
             return self.bypass__raw_visitInfo(datasetType, pythonType, location, dataId)
         else:
-            import re
-            import lsst.afw.image as afwImage
+            fileName, hdu = self._getRawFile(location)
+
+            def readVisitInfo():
+                md = self._readSidecarMetadata(fileName, hdu)
+                if md is None:
+                    instrument.addIo(nFiles=1)
+                    if hdu is None:
+                        md = readMetadata(fileName)  # or hdu = INT_MIN; -(1 << 31)
+                    else:
+                        md = readMetadata(fileName, hdu=hdu)
+                return afwImage.VisitInfo(md)
+            #
+            # VisitInfos are immutable, so the cached value can be shared; it is reread if the file changes
+            #
+            return self.visitInfoCache.get((fileName, hdu), readVisitInfo,
+                                           signature=os.stat(fileName).st_mtime)
+
+    def bypass_raw_mef(self, datasetType, pythonType, location, dataId):
+        """Read the primary header and all the amplifiers of a raw CCD in a single pass.
+
+        This replaces the sixteen per-amplifier reads (plus one for the primary header)
+        that the "raw_amp" and "raw_hdu" components of "raw" would otherwise require.
+        """
+        fileName = self._getRawFile(location)[0]
+        detector = self.camera[self._extractDetectorName(dataId)]
+
+        rawCcd = readRawCcd(fileName, nAmp=len(detector), numProcesses=self.rawDecompressProcesses)
+        rawCcd.detector = detector
+        rawCcd.mapper = self            # so that assemble_raw uses this mapper's options
+
+        return rawCcd
+
+    def assembleRawMef(self, rawCcd, dataId):
+        """Assemble and standardize a raw CCD read by `bypass_raw_mef`, as for the "raw" dataset.
+
+        The overscan and crosstalk are corrected as configured by this mapper's options.
+
+        Parameters
+        ----------
+        rawCcd : `lsst.obs.comCam.rawReader.RawCcd`
+            The raw CCD, with its detector set
+        dataId : `dict`
+            The data ID of the CCD
+
+        Returns
+        -------
+        exposure : `lsst.afw.image.Exposure`
+            The assembled exposure
+        """
+        md = rawCcd.metadata.toPropertyList()
+        crosstalk = self.getCrosstalk(rawCcd.detector.getName())
+        ampDict = makeAmpExposures(rawCcd, self.overscanMode, crosstalk)
+        return assembleRawCcd(ampDict, md, dataId, self, doTrim=(self.overscanMode == "trim"))
+
+    def bypass_raw_lazy(self, datasetType, pythonType, location, dataId):
+        """Read the headers of a raw CCD, leaving its amplifiers to be read when first used.
+
+        The primary header and detector are available at once; use `makeAmpExposure` (or
+        ``getAmpArray``) to read individual amplifiers.  If ``useMmapForRaw`` is set an
+        uncompressed raw is returned as a `~lsst.obs.comCam.rawReader.MappedRawCcd`, whose
+        ``getAmpData`` also gives each amplifier's data unit without copying it.
+        """
+        fileName = self._getRawFile(location)[0]
+        detector = self.camera[self._extractDetectorName(dataId)]
+
+        rawCcd = readLazyRawCcd(fileName, nAmp=len(detector), useMmap=self.useMmapForRaw)
+        rawCcd.detector = detector
+
+        return rawCcd
+
+    def bypass_raw_amp(self, datasetType, pythonType, location, dataId):
+        """Read one amplifier of a raw CCD.
+
+        If ``useMmapForRaw`` is set the CCD's file is memory-mapped once (and cached) and
+        only this amplifier's pixels are paged in and converted to int32, rather than the
+        file being opened and its headers scanned again for each of the CCD's amplifiers.
+        """
+        if not self.useMmapForRaw:
+            instrument.addIo(nFiles=1)
+            return afwImage.DecoratedImageI(location.getLocationsWithRoot()[0])
+
+        fileName, hdu = self._getRawFile(location)
+        detector = self.camera[self._extractDetectorName(dataId)]
+        rawCcd = self.mappedRawCache.get(fileName,
+                                         lambda: readLazyRawCcd(fileName, nAmp=len(detector), useMmap=True),
+                                         signature=os.stat(fileName).st_mtime)
+        i = hdu - 1                     # HDU 0 is the primary
+        image = afwImage.DecoratedImageI(afwImage.ImageI(rawCcd.getAmpArray(i), deep=False))
+        image.setMetadata(rawCcd.ampHeaders[i].toPropertyList())
+        if isinstance(rawCcd, LazyRawCcd):
+            rawCcd.unload(i)            # the image holds the pixels; the cache need only hold the mapping
+
+        return image
+
+    def readRawVisit(self, dataId, numThreads=None):
+        """Read and assemble all the CCDs of a visit concurrently.
+
+        Each CCD is read with `bypass_raw_mef` in its own thread (the file reads release
+        the GIL) and then assembled and standardized as for the "raw" dataset.
+
+        Parameters
+        ----------
+        dataId : `dict`
+            Data ID identifying the visit; any "ccd" is ignored
+        numThreads : `int`, optional
+            Number of threads to use; defaults to one per CCD
+
+        Returns
+        -------
+        rawVisit : `RawVisit`
+            The assembled CCDs (each with its own VisitInfo), with the header and VisitInfo
+            of the first CCD as those of the visit
+        """
+        visitId = dict(dataId)
+        visitId.pop("ccd", None)
+
+        ccdIds = [dict(visitId, ccd=ccd, run=run) for ccd, run in self.query_raw(["ccd", "run"], visitId)]
+        if len(ccdIds) == 0:
+            raise RuntimeError("No raw data found for %s" % (visitId,))
+
+        def readCcd(ccdId):
+            location = self.map("raw_mef", ccdId)
+            rawCcd = self.bypass_raw_mef("raw_mef", None, location, ccdId)
+            return self.assembleRawMef(rawCcd, ccdId), rawCcd.metadata.toPropertyList()
+
+        pool = ThreadPool(numThreads or len(ccdIds))
+        try:
+            results = pool.map(instrument.inheritStages(readCcd), ccdIds)
+        finally:
+            pool.close()
+            pool.join()
+
+        exposures = dict((ccdId["ccd"], exposure) for ccdId, (exposure, md) in zip(ccdIds, results))
+        visitExposure, visitMd = results[0]
+
+        return RawVisit(exposures, visitMd, visitExposure.getInfo().getVisitInfo())
+
+    def getCalibIndex(self):
+        """Return the interval index of the calib registry's validity ranges, loading it on first use.
+
+        The index is reloaded if the calib registry has been modified (e.g. by ingesting
+        new calibs) since it was loaded.  Returns `None` if there is no calib registry.
+        """
+        conn = getattr(getattr(self, "calibRegistry", None), "conn", None)
+        if conn is None:
+            return None
+        signature = registrySignature(conn)
+        if self._calibIndex is None or signature != self._calibIndexSignature:
+            self._calibIndex = CalibIntervalIndex.fromRegistry(conn, self.calibrations.keys())
+            self._calibIndexSignature = signature
+        return self._calibIndex
+
+    def _mapCalib(self, datasetType, dataId, write=False):
+        """Map a calib, resolving its calibDate from the interval index rather than the calib registry.
+
+        If the calibDate can't be found in the index the mapping's own (SQL) lookup is used.
+        """
+        mapping = self.calibrations[datasetType]
+        if not write and "calibDate" not in dataId:
+            calibDate = self._lookupCalibDate(datasetType, dataId)
+            if calibDate is not None:
+                dataId = dict(dataId, calibDate=calibDate)
+        return mapping.map(self, dataId, write)
+
+    def _lookupCalibDate(self, datasetType, dataId):
+        """Return the calibDate valid for a dataId from the interval index, or `None`."""
+        index = self.getCalibIndex()
+        if index is None or "ccd" not in dataId:
+            return None
+
+        date = dataId.get("date")
+        filterName = dataId.get("filter")
+        if date is None or filterName is None:
+            rawId = dict((k, v) for k, v in dataId.items() if k in ("visit", "ccd", "run"))
+            rows = self.query_raw(["date", "filter"], rawId)
+            if len(rows) != 1:
+                return None
+            date, rawFilter = rows[0]
+            filterName = filterName if filterName is not None else rawFilter
+
+        return index.lookup(datasetType, dataId["ccd"], date,
+                            filterName if datasetType in self.filteredCalibs else None)
+
+    def _readCalib(self, datasetType, location, dataId):
+        """Read and standardize a calib exposure, returning a copy of a cached one if it was read recently.
+
+        The exposure is standardized with ``std_<datasetType>`` (setting its detector, filter
+        and so on, as the butler's normal read path would) when it is read, so the cached
+        copy is standardized once; standardizing it again is harmless.  The file is read
+        without holding the cache's lock, so different calibs are read concurrently.
+        """
+        fileName = location.getLocationsWithRoot()[0]
+        standardize = getattr(self, "std_" + datasetType)
+        exposure = self.calibCache.get(fileName, lambda: standardize(afwImage.ExposureF(fileName), dataId),
+                                       signature=os.stat(fileName).st_mtime)
+        return afwImage.ExposureF(exposure, True)
 
-            fileName = location.getLocationsWithRoot()[0]
-            mat = re.search(r"\[(\d+)\]$", fileName)
-            if mat:
-                hdu = int(mat.group(1))
-                md = readMetadata(fileName, hdu=hdu)
-            else:
-                md = readMetadata(fileName)  # or hdu = INT_MIN; -(1 << 31)
+    def map_bias(self, dataId, write=False):
+        return self._mapCalib("bias", dataId, write)
 
-            return afwImage.VisitInfo(md)
+    def map_dark(self, dataId, write=False):
+        return self._mapCalib("dark", dataId, write)
+
+    def map_flat(self, dataId, write=False):
+        return self._mapCalib("flat", dataId, write)
+
+    def map_fringe(self, dataId, write=False):
+        return self._mapCalib("fringe", dataId, write)
+
+    def bypass_bias(self, datasetType, pythonType, location, dataId):
+        return self._readCalib("bias", location, dataId)
+
+    def bypass_dark(self, datasetType, pythonType, location, dataId):
+        return self._readCalib("dark", location, dataId)
+
+    def bypass_flat(self, datasetType, pythonType, location, dataId):
+        return self._readCalib("flat", location, dataId)
+
+    def bypass_fringe(self, datasetType, pythonType, location, dataId):
+        return self._readCalib("fringe", location, dataId)
+
+    def getCrosstalk(self, ccd):
+        """Return the crosstalk model to apply when assembling a CCD, or `None`.
+
+        This is `None` unless `doCrosstalk` is set, or if all the CCD's coefficients are zero.
+        """
+        if not self.doCrosstalk:
+            return None
+        model = loadCrosstalk(self.crosstalkFile).get(ccd)
+        return None if model is None or model.isNull() else model
+
+    def getDefectIndex(self):
+        """Return the index of the defect files' validity ranges, loading it on first use.
+
+        Returns `None` if the mapper has no defect directory.
+        """
+        if self._defectIndex is None:
+            defectPath = getattr(self, "defectPath", None)
+            if defectPath is None or not os.path.isdir(defectPath):
+                return None
+            self._defectIndex = DefectIndex(defectPath)
+        return self._defectIndex
+
+    def _defectLookup(self, dataId):
+        """Return the defect file valid for a dataId, or `None`; used by `map_defects`."""
+        index = self.getDefectIndex()
+        if index is None or "ccd" not in dataId:
+            return None
+
+        date = dataId.get("date")
+        if date is None:
+            rawId = dict((k, v) for k, v in dataId.items() if k in ("visit", "ccd", "run"))
+            rows = self.query_raw(["date"], rawId)
+            if len(rows) != 1:
+                return None
+            date = rows[0][0]
+
+        return index.lookup(dataId["ccd"], date)
+
+    def _readDefects(self, fileName):
+        """Read a defect file, or return it from the cache."""
+        return self.defectCache.get(fileName, lambda: DefectSet.read(fileName),
+                                    signature=os.stat(fileName).st_mtime)
+
+    def bypass_defects(self, datasetType, pythonType, location, dataId):
+        """Return the defects of a CCD as a list of `lsst.afw.image.DefectBase`, as used by ISR."""
+        return self._readDefects(location.locationList[0]).toDefectList()
+
+    def map_defectMask(self, dataId, write=False):
+        return self.map_defects(dataId, write)
+
+    def bypass_defectMask(self, datasetType, pythonType, location, dataId):
+        """Return the defects of a CCD as a read-only boolean mask, shared with other callers.
+
+        Use `lsst.obs.comCam.defects.maskDefects` to apply it to an exposure's mask.
+        """
+        fileName = location.locationList[0]
+
+        def makeMask():
+            mask = self._readDefects(fileName).getMask()
+            mask.flags.writeable = False
+            return mask
+
+        return self.defectMaskCache.get(fileName, makeMask, signature=os.stat(fileName).st_mtime)
 
     def std_raw_amp(self, item, dataId):
         return self._standardizeExposure(self.exposures['raw_amp'], item, dataId,
@@ -269,28 +862,6 @@ class ComCamMapper(CameraMapper):
         propertyList.set("Computed_ccdExposureId", self._computeCcdExposureId(dataId))
         return propertyList
 
-    def X_bypass_defects(self, datasetType, pythonType, location, dataId):
-        """Method has X_ prepended and thus not currently live.
-
-        Since we have no defects, return an empty list. Fix this when defects exist.
-        """
-        return [afwImage.DefectBase(afwGeom.Box2I(afwGeom.Point2I(x0, y0), afwGeom.Point2I(x1, y1))) for
-                x0, y0, x1, y1 in (
-                    # These may be hot pixels, but we'll treat them as bad until we can get more data
-                    (3801, 666, 3805, 669),
-                    (3934, 582, 3936, 589),
-        )]
-
-    def X__defectLookup(self, dataId):
-        """Method has X_ prepended and thus not currently live.
-
-        Also, method is hacky method and should not exist.
-        This function needs to return a non-None value otherwise the mapper gives up
-        on trying to find the defects.  I wanted to be able to return a list of defects constructed
-        in code rather than reconstituted from persisted files, so I return a dummy value.
-        """
-        return "this_is_a_hack"
-
     def X_standardizeCalib(self, dataset, item, dataId):
         """Standardize a calibration image read in by the butler.
 
@@ -0,0 +1,355 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Combine stacks of calibration frames in row bands with bounded memory."""
+
+from __future__ import division, print_function
+
+import io
+import multiprocessing
+import warnings
+
+import numpy as np
+
+from lsst.obs.comCam.rawReader import readImageRows, scanHeaders
+
+__all__ = ["COMBINE_METHODS", "combineStack", "combineFiles", "combineMaskedFiles", "getBandRows"]
+
+COMBINE_METHODS = ("mean", "median", "clippedMean")
+
+_BYTES_PER_VALUE = 4*3                  # float32 stack plus temporaries used by the clipping
+_MASKED_BYTES_PER_VALUE = _BYTES_PER_VALUE + 4*2  # ... plus the float32 variance and int32 mask stacks
+
+
+def combineStack(stack, method="mean", nSigma=3.0, nIter=3, minSigma=None):
+    """Combine a stack of images pixel by pixel.
+
+    Parameters
+    ----------
+    stack : `numpy.ndarray`
+        The images, as ``(nImage, height, width)``; modified if ``method`` is "clippedMean".
+    method : `str`
+        One of "mean", "median" or "clippedMean".
+    nSigma : `float`
+        Clipping threshold for "clippedMean", in units of the robust (interquartile) sigma.
+    nIter : `int`
+        Number of clipping iterations for "clippedMean".
+    minSigma : `float`, optional
+        Floor on each pixel's robust sigma for "clippedMean", so that pixels whose quartiles
+        coincide (e.g. in constant columns) don't reject every value that differs from the
+        median; defaults to the median of the pixels' robust sigmas.
+
+    Returns
+    -------
+    combined : `numpy.ndarray`
+        The combined image, as ``(height, width)``.
+    """
+    if method == "mean":
+        return stack.mean(axis=0)
+    if method == "median":
+        return np.median(stack, axis=0)
+    if method != "clippedMean":
+        raise ValueError("Unknown combination method %s; expected one of %s" % (method, COMBINE_METHODS))
+
+    _clipStack(stack, nSigma, nIter, minSigma)
+    return np.nanmean(stack, axis=0)
+
+
+def _clipStack(stack, nSigma, nIter, minSigma):
+    """Set the values of a stack rejected by iterative clipping to NaN; see `combineStack`.
+
+    Values that are already NaN are ignored.
+    """
+    for i in range(nIter):
+        q25, median, q75 = np.nanpercentile(stack, [25, 50, 75], axis=0)
+        sigma = 0.741*(q75 - q25)
+        if minSigma is None:
+            minSigma = np.nanmedian(sigma)  # the typical noise
+        limit = nSigma*np.maximum(sigma, minSigma)
+        with np.errstate(invalid="ignore"):
+            reject = np.abs(stack - median) > limit
+        if not reject.any():
+            break
+        stack[reject] = np.nan
+
+
+def getBandRows(nImage, width, memoryBudget, bytesPerValue=_BYTES_PER_VALUE):
+    """Return the number of rows per band that keep a combination within a memory budget.
+
+    Parameters
+    ----------
+    nImage : `int`
+        Number of images combined.
+    width : `int`
+        Width of the images, pixels.
+    memoryBudget : `int`
+        Memory available to combine one band, bytes.
+    bytesPerValue : `int`
+        Memory needed for each input pixel, bytes.
+
+    Returns
+    -------
+    bandRows : `int`
+        The number of rows in each band (at least 1).
+    """
+    return max(1, memoryBudget//(nImage*width*bytesPerValue))
+
+
+def _findImageHdu(fileName, hdu):
+    """Return the header and data offset of the given HDU of a file."""
+    hdus = scanHeaders(fileName)
+    if hdu >= len(hdus):
+        raise RuntimeError("%s has no HDU %d" % (fileName, hdu))
+    return hdus[hdu]
+
+
+def _combineBand(args):
+    """Read one band of rows from every input and combine them; used by `combineFiles`."""
+    inputs, y0, y1, scales, method, nSigma, nIter, minSigma = args
+    width = inputs[0][1]["NAXIS1"]
+    if method == "mean":
+        # A running sum only ever needs one input's band in memory
+        total = np.zeros((y1 - y0, width), dtype=np.float64)
+        for (fileName, header, offset), scale in zip(inputs, scales):
+            with io.open(fileName, "rb") as fd:
+                total += readImageRows(fd, header, offset, y0, y1)/scale
+        return (total/len(inputs)).astype(np.float32)
+
+    stack = np.empty((len(inputs), y1 - y0, width), dtype=np.float32)
+    for i, ((fileName, header, offset), scale) in enumerate(zip(inputs, scales)):
+        with io.open(fileName, "rb") as fd:
+            stack[i] = readImageRows(fd, header, offset, y0, y1)
+        if scale != 1:
+            stack[i] /= scale
+    return combineStack(stack, method, nSigma=nSigma, nIter=nIter, minSigma=minSigma)
+
+
+def combineFiles(fileNames, hdu=1, method="mean", scales=None, nSigma=3.0, nIter=3, minSigma=None,
+                 memoryBudget=1 << 30, numProcesses=1):
+    """Combine an image HDU of many uncompressed FITS files, one band of rows at a time.
+
+    Only one band of each input is in memory at once (for "mean", only one band of one
+    input), so the memory needed is set by ``memoryBudget`` rather than by the number of
+    inputs; the bands are distributed over ``numProcesses`` processes, each of which is
+    given an equal share of the budget.  Every method is exact: a pixel's values from all
+    the inputs are always in the same band.
+
+    Parameters
+    ----------
+    fileNames : `list` of `str`
+        The input files, e.g. ISR-processed frames written by constructBias/Dark/Flat.
+    hdu : `int`
+        Index of the HDU holding the image (1 for the image plane of an Exposure).
+    method : `str`
+        One of "mean", "median" or "clippedMean".
+    scales : `list` of `float`, optional
+        Each input is divided by its scale before combination (e.g. exposure time for
+        darks, or the background level for flats).
+    nSigma : `float`
+        Clipping threshold for "clippedMean".
+    nIter : `int`
+        Number of clipping iterations for "clippedMean".
+    minSigma : `float`, optional
+        Floor on the robust sigma for "clippedMean"; see `combineStack`.  If `None`,
+        each band uses the median robust sigma of its pixels.
+    memoryBudget : `int`
+        Total memory to use for the bands being combined, bytes.
+    numProcesses : `int`
+        Number of processes combining bands in parallel.
+
+    Returns
+    -------
+    combined : `numpy.ndarray`
+        The combined float32 image.
+    """
+    if method not in COMBINE_METHODS:
+        raise ValueError("Unknown combination method %s; expected one of %s" % (method, COMBINE_METHODS))
+    if len(fileNames) == 0:
+        raise ValueError("No images to combine")
+    if scales is None:
+        scales = [1.0]*len(fileNames)
+    if len(scales) != len(fileNames):
+        raise ValueError("Saw %d scales for %d images" % (len(scales), len(fileNames)))
+
+    inputs = []
+    for fileName in fileNames:
+        header, offset = _findImageHdu(fileName, hdu)
+        inputs.append((fileName, header, offset))
+    height, width = inputs[0][1]["NAXIS2"], inputs[0][1]["NAXIS1"]
+    for fileName, header, offset in inputs:
+        if (header["NAXIS2"], header["NAXIS1"]) != (height, width):
+            raise RuntimeError("%s is %dx%d; expected %dx%d" %
+                               (fileName, header["NAXIS1"], header["NAXIS2"], width, height))
+
+    bandRows = getBandRows(len(inputs), width, memoryBudget//numProcesses)
+    bands = [(inputs, y0, min(y0 + bandRows, height), scales, method, nSigma, nIter, minSigma)
+             for y0 in range(0, height, bandRows)]
+
+    combined = np.empty((height, width), dtype=np.float32)
+    for y0, y1, band in _mapBands(_combineBand, bands, numProcesses):
+        combined[y0:y1] = band
+
+    return combined
+
+
+def _mapBands(func, bands, numProcesses):
+    """Apply ``func`` to each band, in ``numProcesses`` processes, yielding ``(y0, y1, result)``.
+
+    Each band is a tuple of arguments ``(inputs, y0, y1, ...)``.
+    """
+    if numProcesses == 1:
+        results = map(func, bands)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(numProcesses)
+        results = pool.imap(func, bands)
+    try:
+        for band, result in zip(bands, results):
+            yield band[1], band[2], result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _getMaskBits(header, maskPlanes):
+    """Return the bitmask of the named planes, as numbered by a mask HDU's MP_ keywords.
+
+    Planes that the mask doesn't define are ignored.
+    """
+    bits = 0
+    for plane in maskPlanes:
+        if "MP_" + plane in header:
+            bits |= 1 << header["MP_" + plane]
+    return bits
+
+
+def _combineMaskedBand(args):
+    """Read one band of rows from every input's planes and combine them; used by `combineMaskedFiles`."""
+    inputs, y0, y1, scales, method, nSigma, nIter, minSigma = args
+    width = inputs[0][1][0]["NAXIS1"]
+    stack = np.empty((len(inputs), y1 - y0, width), dtype=np.float32)
+    variances = np.empty_like(stack)
+    for i, ((fileName, image, mask, variance, badBits), scale) in enumerate(zip(inputs, scales)):
+        with io.open(fileName, "rb") as fd:
+            stack[i] = readImageRows(fd, image[0], image[1], y0, y1)
+            variances[i] = readImageRows(fd, variance[0], variance[1], y0, y1)
+            if badBits != 0:
+                bad = (readImageRows(fd, mask[0], mask[1], y0, y1, dtype=np.int64) & badBits) != 0
+                stack[i][bad] = np.nan
+        if scale != 1:
+            stack[i] /= scale
+            variances[i] /= scale**2
+
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # pixels with no good values are NaN
+        if method == "clippedMean":
+            _clipStack(stack, nSigma, nIter, minSigma)
+        good = np.isfinite(stack)
+        nGood = good.sum(axis=0)
+        variances[~good] = 0.0
+        combined = np.nanmedian(stack, axis=0) if method == "median" else np.nanmean(stack, axis=0)
+        variance = variances.sum(axis=0)/nGood**2
+    if method == "median":
+        variance *= np.pi/2             # the variance of the median of normal deviates, for large N
+    return combined, variance.astype(np.float32), nGood
+
+
+def combineMaskedFiles(fileNames, method="mean", scales=None, maskPlanes=(), nSigma=3.0, nIter=3,
+                       minSigma=None, memoryBudget=1 << 30, numProcesses=1):
+    """Combine the masked images of many uncompressed FITS files, one band of rows at a time.
+
+    As `combineFiles`, but the inputs are Exposures or MaskedImages (with the image, mask
+    and variance in HDUs 1, 2 and 3).  Pixels with any of ``maskPlanes`` set are ignored
+    (as are any rejected by "clippedMean"), and the variance of the result is computed
+    from the variances of the pixels that were used.
+
+    Parameters
+    ----------
+    fileNames : `list` of `str`
+        The input files, e.g. ISR-processed frames written by constructBias/Dark/Flat.
+    method : `str`
+        One of "mean", "median" or "clippedMean".
+    scales : `list` of `float`, optional
+        Each input is divided by its scale (and its variance by the scale squared) before
+        combination.
+    maskPlanes : iterable of `str`
+        Names of the mask planes of pixels to ignore, e.g. ``["SAT", "INTRP"]``; they are
+        looked up in each input's mask header, and those it doesn't define are ignored.
+    nSigma : `float`
+        Clipping threshold for "clippedMean".
+    nIter : `int`
+        Number of clipping iterations for "clippedMean".
+    minSigma : `float`, optional
+        Floor on the robust sigma for "clippedMean"; see `combineStack`.
+    memoryBudget : `int`
+        Total memory to use for the bands being combined, bytes.
+    numProcesses : `int`
+        Number of processes combining bands in parallel.
+
+    Returns
+    -------
+    combined : `numpy.ndarray`
+        The combined float32 image; NaN where no input had a good value.
+    variance : `numpy.ndarray`
+        The float32 variance of ``combined``: the sum of the used pixels' variances over
+        the square of their number, multiplied by pi/2 for "median".
+    nGood : `numpy.ndarray`
+        The number of inputs used for each pixel.
+    """
+    if method not in COMBINE_METHODS:
+        raise ValueError("Unknown combination method %s; expected one of %s" % (method, COMBINE_METHODS))
+    if len(fileNames) == 0:
+        raise ValueError("No images to combine")
+    if scales is None:
+        scales = [1.0]*len(fileNames)
+    if len(scales) != len(fileNames):
+        raise ValueError("Saw %d scales for %d images" % (len(scales), len(fileNames)))
+
+    inputs = []
+    for fileName in fileNames:
+        hdus = scanHeaders(fileName)
+        if len(hdus) < 4:
+            raise RuntimeError("%s has no variance HDU" % (fileName,))
+        image, mask, variance = hdus[1:4]
+        for header, offset in (image, mask, variance):
+            if (header["NAXIS2"], header["NAXIS1"]) != (image[0]["NAXIS2"], image[0]["NAXIS1"]):
+                raise RuntimeError("The planes of %s differ in size" % (fileName,))
+        inputs.append((fileName, image, mask, variance, _getMaskBits(mask[0], maskPlanes)))
+    height, width = inputs[0][1][0]["NAXIS2"], inputs[0][1][0]["NAXIS1"]
+    for fileName, (header, offset), _, _, _ in inputs:
+        if (header["NAXIS2"], header["NAXIS1"]) != (height, width):
+            raise RuntimeError("%s is %dx%d; expected %dx%d" %
+                               (fileName, header["NAXIS1"], header["NAXIS2"], width, height))
+
+    bandRows = getBandRows(len(inputs), width, memoryBudget//numProcesses, _MASKED_BYTES_PER_VALUE)
+    bands = [(inputs, y0, min(y0 + bandRows, height), scales, method, nSigma, nIter, minSigma)
+             for y0 in range(0, height, bandRows)]
+
+    combined = np.empty((height, width), dtype=np.float32)
+    variance = np.empty((height, width), dtype=np.float32)
+    nGood = np.empty((height, width), dtype=np.int32)
+    for y0, y1, (bandImage, bandVariance, bandGood) in _mapBands(_combineMaskedBand, bands, numProcesses):
+        combined[y0:y1] = bandImage
+        variance[y0:y1] = bandVariance
+        nGood[y0:y1] = bandGood
+
+    return combined, variance, nGood
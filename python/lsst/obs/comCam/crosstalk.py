@@ -0,0 +1,253 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Inter-amplifier crosstalk correction of all the amplifiers of a ComCam CCD at once."""
+
+from __future__ import division, print_function
+
+import collections
+import os
+
+import numpy as np
+import yaml
+
+import lsst.pex.config as pexConfig
+from lsst.ip.isr.crosstalk import CrosstalkConfig, CrosstalkTask
+from lsst.utils import getPackageDir
+from lsst.obs.comCam.cache import ObjectCache, fileSignature
+from lsst.obs.comCam.comCam import loadCameraDescription
+
+__all__ = ["CrosstalkModel", "getReadoutFlips", "loadCrosstalk", "applyCrosstalk", "applyCrosstalkPairwise",
+           "ComCamCrosstalkConfig", "ComCamCrosstalkTask"]
+
+_READOUT_FLIPS = {                      # (flipX, flipY) that move each readCorner to the lower left
+    "LL": (False, False),
+    "LR": (True, False),
+    "UL": (False, True),
+    "UR": (True, True),
+}
+_crosstalkCache = ObjectCache("crosstalk")  # parsed crosstalk files, by filename
+
+
+class CrosstalkModel(collections.namedtuple("CrosstalkModel", ["coeffs", "flips"])):
+    """The crosstalk of a CCD.
+
+    Parameters
+    ----------
+    coeffs : `numpy.ndarray`
+        The ``(nAmp, nAmp)`` float32 coefficients: ``coeffs[i, j]`` is the fraction of the
+        signal in amplifier ``j`` that appears in amplifier ``i``.  The diagonal is zero.
+    flips : `list` of `tuple`
+        ``(flipX, flipY)`` for each amplifier that puts its first pixel read at the lower left.
+    """
+    __slots__ = ()
+
+    def isNull(self):
+        """Are all the coefficients zero, so there is nothing to correct?"""
+        return not self.coeffs.any()
+
+
+def getReadoutFlips(ccd="S00", cameraFile=None):
+    """Return the flips that bring each amplifier of a CCD to a common readout orientation.
+
+    Parameters
+    ----------
+    ccd : `str`
+        The CCD.
+    cameraFile : `str`, optional
+        The camera description; defaults to obs_comCam's policy/camera.yaml.
+
+    Returns
+    -------
+    flips : `list` of `tuple`
+        ``(flipX, flipY)`` of each amplifier, in HDU order, as given by its readCorner.
+    """
+    amps = sorted(loadCameraDescription(cameraFile)["CCDs"][ccd]["amplifiers"].values(),
+                  key=lambda amp: amp["hdu"])
+    return [_READOUT_FLIPS[amp["readCorner"]] for amp in amps]
+
+
+def _readCrosstalk(fileName, cameraFile):
+    """Parse a crosstalk file; used by `loadCrosstalk`."""
+    with open(fileName) as fd:
+        description = yaml.safe_load(fd)
+    models = {}
+    for ccd, ccdDescription in description["CCDs"].items():
+        coeffs = np.array(ccdDescription["coeffs"], dtype=np.float32)
+        flips = getReadoutFlips(ccd, cameraFile)
+        if coeffs.shape != (len(flips), len(flips)):
+            raise RuntimeError("Crosstalk coefficients of %s in %s have shape %s; expected %s" %
+                               (ccd, fileName, coeffs.shape, (len(flips), len(flips))))
+        np.fill_diagonal(coeffs, 0.0)
+        models[ccd] = CrosstalkModel(coeffs, flips)
+    return models
+
+
+def loadCrosstalk(fileName=None, cameraFile=None):
+    """Read the crosstalk of each CCD; the result is cached until the file changes.
+
+    Parameters
+    ----------
+    fileName : `str`, optional
+        The crosstalk file; defaults to obs_comCam's policy/crosstalk.yaml.
+    cameraFile : `str`, optional
+        The camera description giving the amplifiers' readCorners; defaults to obs_comCam's.
+
+    Returns
+    -------
+    models : `dict` of `CrosstalkModel`
+        The crosstalk of each CCD, indexed by CCD name.
+    """
+    if fileName is None:
+        fileName = os.path.join(getPackageDir("obs_comCam"), "policy", "crosstalk.yaml")
+    return _crosstalkCache.get((fileName, cameraFile), lambda: _readCrosstalk(fileName, cameraFile),
+                               signature=fileSignature(fileName))
+
+
+def _flip(array, flipX, flipY):
+    """Return a flipped view of an array."""
+    return array[::-1 if flipY else 1, ::-1 if flipX else 1]
+
+
+def applyCrosstalk(stack, coeffs, flips=None):
+    """Subtract the crosstalk from all the amplifiers of a CCD in one matrix product.
+
+    Parameters
+    ----------
+    stack : `numpy.ndarray` or `list` of `numpy.ndarray`
+        The bias-subtracted pixels of each amplifier, all of the same shape (e.g. as returned by
+        `lsst.obs.comCam.overscan.subtractCcdOverscan`); corrected in place.
+    coeffs : `numpy.ndarray`
+        The crosstalk coefficients, as for `CrosstalkModel`; the diagonal is ignored.
+    flips : `list` of `tuple`, optional
+        The readout flips of each amplifier, as returned by `getReadoutFlips`; none if omitted.
+
+    Returns
+    -------
+    stack : `numpy.ndarray` or `list` of `numpy.ndarray`
+        ``stack``, for convenience.
+    """
+    nAmp = len(stack)
+    coeffs = np.array(coeffs, dtype=np.float32)
+    np.fill_diagonal(coeffs, 0.0)
+    flipped = flips is not None and any(flipX or flipY for flipX, flipY in flips)
+
+    if flipped:
+        sources = np.stack([_flip(array, flipX, flipY) for array, (flipX, flipY) in zip(stack, flips)])
+    elif isinstance(stack, np.ndarray):
+        sources = stack                 # the corrections are computed before any are subtracted
+    else:
+        sources = np.stack(stack)
+
+    corrections = np.dot(coeffs, sources.reshape(nAmp, -1)).reshape(sources.shape)
+
+    if isinstance(stack, np.ndarray) and not flipped:
+        stack -= corrections.astype(stack.dtype, copy=False)
+    else:
+        for i, array in enumerate(stack):
+            flipX, flipY = flips[i] if flipped else (False, False)
+            array -= _flip(corrections[i], flipX, flipY)
+    return stack
+
+
+def applyCrosstalkPairwise(arrays, coeffs, flips=None):
+    """Subtract the crosstalk one pair of amplifiers at a time, flipping a copy of each source.
+
+    This is how a generic per-amplifier correction proceeds; it gives the same result as
+    `applyCrosstalk`, which should be used instead, and is kept as a reference for tests
+    and benchmarks.
+    """
+    nAmp = len(arrays)
+    if flips is None:
+        flips = [(False, False)]*nAmp
+    sources = [array.copy() for array in arrays]
+    for i in range(nAmp):
+        for j in range(nAmp):
+            if i == j:
+                continue
+            source = _flip(_flip(sources[j], *flips[j]), *flips[i]).copy()  # into i's orientation
+            arrays[i] -= coeffs[i][j]*source
+    return arrays
+
+
+class ComCamCrosstalkConfig(CrosstalkConfig):
+    crosstalkFile = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Crosstalk coefficients file; if empty, use obs_comCam's policy/crosstalk.yaml",
+    )
+
+
+class ComCamCrosstalkTask(CrosstalkTask):
+    """Crosstalk correction of an assembled ComCam CCD, using `applyCrosstalk`.
+
+    Use by retargeting ``config.isr.crosstalk`` and setting ``config.isr.doCrosstalk``.
+    The correction must be made after the overscan is subtracted; if it was already made
+    when the raw was assembled (the mapper's ``doCrosstalk``), ISR's should be disabled.
+    """
+    ConfigClass = ComCamCrosstalkConfig
+
+    def run(self, exposure, crosstalkSources=None, isTrimmed=True):
+        """Subtract the crosstalk of an assembled exposure, and mask the pixels affected by bright sources.
+
+        Parameters
+        ----------
+        exposure : `lsst.afw.image.Exposure`
+            The overscan-subtracted exposure; corrected in place.
+        crosstalkSources : `None`
+            Unused; the CCD's own amplifiers are the only sources.
+        isTrimmed : `bool`
+            Has the exposure been trimmed?
+        """
+        detector = exposure.getDetector()
+        model = loadCrosstalk(self.config.crosstalkFile or None).get(detector.getName())
+        if model is None or model.isNull():
+            self.log.info("No crosstalk correction for %s" % detector.getName())
+            return
+
+        maskedImage = exposure.getMaskedImage()
+        image = maskedImage.getImage().getArray()
+        mask = maskedImage.getMask()
+        amps = list(detector)
+        slices = []
+        for amp in amps:
+            bbox = amp.getBBox() if isTrimmed else amp.getRawBBox()
+            slices.append((slice(bbox.getMinY(), bbox.getMaxY() + 1),
+                           slice(bbox.getMinX(), bbox.getMaxX() + 1)))
+        #
+        # Undo the flips made when assembling, to return each amplifier to the orientation it was read in
+        #
+        rawFlips = [(amp.getRawFlipX(), amp.getRawFlipY()) for amp in amps]
+        stack = np.stack([_flip(image[s], *flip) for s, flip in zip(slices, rawFlips)]).astype(np.float32)
+
+        bright = stack > self.config.minPixelToMask
+        bright = np.stack([_flip(b, *flip) for b, flip in zip(bright, model.flips)])
+        affected = np.dot((model.coeffs != 0).astype(np.float32), bright.reshape(len(amps), -1)) > 0
+
+        applyCrosstalk(stack, model.coeffs, model.flips)
+
+        mask.addMaskPlane(self.config.crosstalkMaskPlane)
+        bitmask = mask.getPlaneBitMask(self.config.crosstalkMaskPlane)
+        maskArray = mask.getArray()
+        for i, (s, (flipX, flipY)) in enumerate(zip(slices, rawFlips)):
+            image[s] = _flip(stack[i], flipX, flipY)
+            ampAffected = _flip(affected[i].reshape(stack.shape[1:]), *model.flips[i])
+            maskArray[s] |= np.where(_flip(ampAffected, flipX, flipY), bitmask, 0).astype(maskArray.dtype)
@@ -0,0 +1,233 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Compact per-CCD defect files and the masks rasterized from them."""
+
+from __future__ import division, print_function
+
+import gzip
+import json
+import os
+
+import numpy as np
+
+from lsst.obs.comCam.calibIndex import CalibIntervalIndex
+
+__all__ = ["DEFECT_SUFFIX", "encodeRuns", "decodeRuns", "DefectSet", "DefectIndex", "maskDefects"]
+
+DEFECT_SUFFIX = ".json.gz"              # suffix of defect files
+_VERSION = 1
+
+
+def encodeRuns(mask):
+    """Run-length encode the set pixels of a mask.
+
+    Parameters
+    ----------
+    mask : `numpy.ndarray`
+        The boolean mask.
+
+    Returns
+    -------
+    starts : `numpy.ndarray`
+        The index in the flattened (row-major) mask of the first pixel of each run of set pixels.
+    lengths : `numpy.ndarray`
+        The length of each run.
+    """
+    edges = np.diff(np.concatenate(([0], np.ravel(mask).astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    return starts, np.flatnonzero(edges == -1) - starts
+
+
+def decodeRuns(starts, lengths, shape):
+    """Rasterize runs of set pixels, as returned by `encodeRuns`, into a boolean mask of the given shape."""
+    starts = np.asarray(starts, dtype=np.int64)
+    delta = np.zeros(int(np.prod(shape)) + 1, dtype=np.int32)
+    np.add.at(delta, starts, 1)
+    np.add.at(delta, starts + np.asarray(lengths, dtype=np.int64), -1)
+    return (np.cumsum(delta[:-1]) > 0).reshape(shape)
+
+
+def _rasterizeBoxes(boxes, shape):
+    """Rasterize ``(x0, y0, width, height)`` boxes, clipped to the image, into a boolean mask."""
+    height, width = shape
+    x0 = np.clip(boxes[:, 0], 0, width)
+    y0 = np.clip(boxes[:, 1], 0, height)
+    x1 = np.clip(boxes[:, 0] + boxes[:, 2], 0, width)
+    y1 = np.clip(boxes[:, 1] + boxes[:, 3], 0, height)
+    delta = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.add.at(delta, (y0, x0), 1)
+    np.add.at(delta, (y0, x1), -1)
+    np.add.at(delta, (y1, x0), -1)
+    np.add.at(delta, (y1, x1), 1)
+    return np.cumsum(np.cumsum(delta, axis=0), axis=1)[:height, :width] > 0
+
+
+class DefectSet(object):
+    """The defects of a CCD over a range of dates.
+
+    Defects are stored as a list of boxes (for bad columns and regions) together with a
+    run-length encoded mask (for isolated or irregular bad pixels), in the trimmed pixel
+    coordinates of the assembled CCD.
+
+    Parameters
+    ----------
+    ccd : `str`
+        The CCD name, e.g. "S11".
+    shape : `tuple` of `int`
+        The ``(height, width)`` of the CCD.
+    boxes : sequence of `tuple`, optional
+        The ``(x0, y0, width, height)`` of each bad box.
+    runs : `tuple` of `numpy.ndarray`, optional
+        ``(starts, lengths)`` of runs of bad pixels, as returned by `encodeRuns`.
+    validStart, validEnd : `str`
+        The first and last dates (YYYY-MM-DD) for which the defects are valid.
+    """
+
+    def __init__(self, ccd, shape, boxes=(), runs=None, validStart="1970-01-01", validEnd="2037-12-31"):
+        self.ccd = ccd
+        self.shape = tuple(shape)
+        self.boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+        if runs is None:
+            runs = ([], [])
+        self.runStarts, self.runLengths = [np.array(r, dtype=np.int64) for r in runs]
+        self.validStart = validStart
+        self.validEnd = validEnd
+
+    @classmethod
+    def fromMask(cls, ccd, mask, boxes=(), **kwargs):
+        """Make a DefectSet from a mask of bad pixels, and optionally some boxes."""
+        return cls(ccd, mask.shape, boxes=boxes, runs=encodeRuns(mask), **kwargs)
+
+    def __len__(self):
+        """The number of boxes and runs."""
+        return len(self.boxes) + len(self.runStarts)
+
+    def getMask(self):
+        """Rasterize the defects.
+
+        Returns
+        -------
+        mask : `numpy.ndarray`
+            Boolean mask of the CCD, set for bad pixels.
+        """
+        mask = decodeRuns(self.runStarts, self.runLengths, self.shape)
+        if len(self.boxes) > 0:
+            mask |= _rasterizeBoxes(self.boxes, self.shape)
+        return mask
+
+    def getRowSegments(self):
+        """Return the defects as ``(x0, y0, width, height)`` boxes.
+
+        These are the boxes followed by the runs, split at the ends of rows.
+        """
+        mask = decodeRuns(self.runStarts, self.runLengths, self.shape)
+        padded = np.zeros((self.shape[0], self.shape[1] + 2), dtype=np.int8)
+        padded[:, 1:-1] = mask
+        edges = np.diff(padded, axis=1)
+        rows, x0 = np.nonzero(edges == 1)
+        x1 = np.nonzero(edges == -1)[1]  # row-major order, so paired with the starts
+        segments = np.column_stack((x0, rows, x1 - x0, np.ones_like(rows)))
+        return np.concatenate((self.boxes, segments.astype(np.int64)))
+
+    def toDefectList(self):
+        """Return the defects as a list of `lsst.afw.image.DefectBase`, as used by ISR."""
+        import lsst.afw.geom as afwGeom
+        import lsst.afw.image as afwImage
+
+        return [afwImage.DefectBase(afwGeom.Box2I(afwGeom.Point2I(int(x0), int(y0)),
+                                                  afwGeom.Extent2I(int(width), int(height))))
+                for x0, y0, width, height in self.getRowSegments()]
+
+    def write(self, fileName):
+        """Write the defects, replacing any existing file atomically."""
+        data = dict(version=_VERSION, ccd=self.ccd, shape=list(self.shape),
+                    validStart=self.validStart, validEnd=self.validEnd,
+                    boxes=self.boxes.tolist(), runStarts=self.runStarts.tolist(),
+                    runLengths=self.runLengths.tolist())
+        tmpFile = "%s.tmp%d" % (fileName, os.getpid())
+        with gzip.open(tmpFile, "wb") as fd:
+            fd.write(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        os.rename(tmpFile, fileName)
+
+    @classmethod
+    def read(cls, fileName):
+        """Read defects written by `write`."""
+        with gzip.open(fileName, "rb") as fd:
+            data = json.loads(fd.read().decode("utf-8"))
+        if data.get("version") != _VERSION:
+            raise RuntimeError("%s has unsupported version %s" % (fileName, data.get("version")))
+        return cls(data["ccd"], data["shape"], boxes=data["boxes"],
+                   runs=(data["runStarts"], data["runLengths"]),
+                   validStart=data["validStart"], validEnd=data["validEnd"])
+
+
+class DefectIndex(object):
+    """The validity ranges of all the defect files in a directory tree.
+
+    Parameters
+    ----------
+    defectPath : `str`
+        The top of the tree, which is searched for files ending in `DEFECT_SUFFIX`.
+    """
+
+    def __init__(self, defectPath):
+        self._files = {}                # (ccd, validStart): fileName
+        rows = []
+        for dirPath, dirNames, fileNames in os.walk(defectPath):
+            for name in fileNames:
+                if not name.endswith(DEFECT_SUFFIX):
+                    continue
+                fileName = os.path.join(dirPath, name)
+                defects = DefectSet.read(fileName)
+                # Defects don't depend on the filter, so each range is indexed once, under filter None
+                rows.append((defects.ccd, None, defects.validStart, defects.validStart, defects.validEnd))
+                self._files[(defects.ccd, defects.validStart)] = fileName
+        self._index = CalibIntervalIndex({"defects": rows})
+
+    def __len__(self):
+        return len(self._files)
+
+    def lookup(self, ccd, date):
+        """Return the defect file of a CCD valid at an ISO date (or date-time), or `None`."""
+        validStart = self._index.lookup("defects", ccd, date)
+        return None if validStart is None else self._files[(ccd, validStart)]
+
+
+def maskDefects(maskArray, defectMask, bitmask):
+    """Set a bit in a mask for all the bad pixels, in one vectorized operation.
+
+    Parameters
+    ----------
+    maskArray : `numpy.ndarray`
+        The mask, e.g. ``exposure.getMask().getArray()``; modified in place.
+    defectMask : `numpy.ndarray`
+        Boolean mask of the bad pixels, e.g. from `DefectSet.getMask`.
+    bitmask : `int`
+        The bits to set, e.g. ``mask.getPlaneBitMask("BAD")``.
+
+    Returns
+    -------
+    maskArray : `numpy.ndarray`
+        ``maskArray``, for convenience.
+    """
+    np.bitwise_or(maskArray, maskArray.dtype.type(bitmask), out=maskArray, where=defectMask)
+    return maskArray
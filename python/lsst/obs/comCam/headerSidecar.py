@@ -0,0 +1,167 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Per-run sidecar files holding the headers of every raw in the run."""
+
+from __future__ import division, print_function
+
+import gzip
+import json
+import os
+
+from lsst.obs.comCam.rawReader import COMPRESSED_SUFFIXES, FitsHeader
+
+__all__ = ["SIDECAR_NAME", "HeaderSidecar", "getSidecarLocation"]
+
+SIDECAR_NAME = "rawHeaders.json.gz"     # name of the sidecar in each run's directory
+_VERSION = 1
+
+
+def getSidecarLocation(rawFileName):
+    """Return where the headers of a raw are kept.
+
+    The sidecar is in the run directory, i.e. two levels above the raw
+    (``raw/<run>/<ccd>/<file>``).
+
+    Parameters
+    ----------
+    rawFileName : `str`
+        The raw's name in the repository; any compression suffix is ignored.
+
+    Returns
+    -------
+    sidecarFile : `str`
+        The sidecar file.
+    key : `str`
+        The raw's key within the sidecar: its path relative to the run directory,
+        without any compression suffix.
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+        if rawFileName.endswith(suffix):
+            rawFileName = rawFileName[:-len(suffix)]
+            break
+    runDir = os.path.dirname(os.path.dirname(rawFileName))
+    return os.path.join(runDir, SIDECAR_NAME), os.path.relpath(rawFileName, runDir)
+
+
+class HeaderSidecar(object):
+    """The headers of a set of raws, stored by column.
+
+    For each HDU there is a column per keyword holding its value in each file (`None`
+    where a file lacks the keyword), so that a whole run's headers are a single small
+    compressed file that is read in one sequential pass.  Card comments and commentary
+    (COMMENT and HISTORY) cards are not kept.
+    """
+
+    def __init__(self):
+        self.files = []                 # the keys of the files
+        self._rows = {}                 # index into files of each key
+        self._hdus = []                 # for each HDU, {keyword: column of values}
+        self._order = []                # for each HDU, the keywords in the order first seen
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def add(self, key, headers):
+        """Add (or replace) the headers of a file.
+
+        Parameters
+        ----------
+        key : `str`
+            The file's key, as returned by `getSidecarLocation`.
+        headers : `list` of `lsst.obs.comCam.rawReader.FitsHeader`
+            The header of each HDU.
+        """
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self.files)
+            self.files.append(key)
+            self._rows[key] = row
+            for columns in self._hdus:
+                for column in columns.values():
+                    column.append(None)
+        else:
+            for columns in self._hdus:
+                for column in columns.values():
+                    column[row] = None
+
+        while len(self._hdus) < len(headers):
+            self._hdus.append({})
+            self._order.append([])
+        for header, columns, order in zip(headers, self._hdus, self._order):
+            for keyword, value, comment in header.cards:
+                if keyword in ("COMMENT", "HISTORY", ""):
+                    continue
+                column = columns.get(keyword)
+                if column is None:
+                    column = columns[keyword] = [None]*len(self.files)
+                    order.append(keyword)
+                column[row] = value
+
+    def getHeader(self, key, hdu=0):
+        """Return a file's header for one HDU, or `None` if it isn't in the sidecar.
+
+        Returns
+        -------
+        header : `lsst.obs.comCam.rawReader.FitsHeader`
+            The header, without comments.
+        """
+        row = self._rows.get(key)
+        if row is None or hdu >= len(self._hdus):
+            return None
+        columns = self._hdus[hdu]
+        cards = [(keyword, columns[keyword][row], "") for keyword in self._order[hdu]
+                 if columns[keyword][row] is not None]
+        return FitsHeader(cards) if cards else None
+
+    def getMetadata(self, key, hdu=0):
+        """Return a file's header for one HDU as a `lsst.daf.base.PropertyList`, or `None`."""
+        header = self.getHeader(key, hdu)
+        return None if header is None else header.toPropertyList()
+
+    def write(self, fileName):
+        """Write the sidecar, replacing any existing file atomically."""
+        data = dict(version=_VERSION, files=self.files,
+                    hdus=[dict(keys=order, columns=[columns[keyword] for keyword in order])
+                          for columns, order in zip(self._hdus, self._order)])
+        tmpFile = "%s.tmp%d" % (fileName, os.getpid())
+        with gzip.open(tmpFile, "wb") as fd:
+            fd.write(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        os.rename(tmpFile, fileName)
+
+    @classmethod
+    def read(cls, fileName):
+        """Read a sidecar written by `write`."""
+        with gzip.open(fileName, "rb") as fd:
+            data = json.loads(fd.read().decode("utf-8"))
+        if data.get("version") != _VERSION:
+            raise RuntimeError("%s has unsupported version %s" % (fileName, data.get("version")))
+
+        self = cls()
+        self.files = data["files"]
+        self._rows = dict((key, row) for row, key in enumerate(self.files))
+        for hdu in data["hdus"]:
+            self._order.append(hdu["keys"])
+            self._hdus.append(dict(zip(hdu["keys"], hdu["columns"])))
+        return self
@@ -1,22 +1,73 @@
 from __future__ import division, print_function
+import functools
+import hashlib
+import multiprocessing
 import os
 import re
-from lsst.pipe.tasks.ingest import ParseTask
-from lsst.pipe.tasks.ingestCalibs import CalibsParseTask
+import sqlite3
+import time
+from lsst.pex.config import Field, ListField
+from lsst.pipe.tasks.ingest import IngestConfig, IngestTask, ParseConfig, ParseTask
+from lsst.pipe.tasks.ingestCalibs import CalibsParseTask, IngestCalibsConfig, IngestCalibsTask
 import lsst.log as lsstLog
+from lsst.obs.comCam import instrument
+from lsst.obs.comCam.cache import ObjectCache
+from lsst.obs.comCam.headerSidecar import HeaderSidecar, getSidecarLocation
+from lsst.obs.comCam.rawReader import COMPRESSED_SUFFIXES, readAllHeaders, readPrimaryHeader
 
 EXTENSIONS = ["fits", "gz", "fz"]  # Filename extensions to strip off
 
+_parseTask = None                       # the ParseTask used by _parseFile in worker processes
+
+
+class ComCamParseConfig(ParseConfig):
+    """Configuration for ComCamParseTask"""
+    fastHeaderScan = Field(dtype=bool, default=False,
+                           doc="Read the primary header with a minimal card scanner that reads only the "
+                           "header blocks and keeps only the keywords we need (requires hdu == 0)")
+    fastHeaderKeys = ListField(dtype=str, default=["MJD-OBS", "MONOWL"],
+                               doc="Keywords needed by the translators, kept by the fast header scan "
+                               "in addition to the values of the translation dict")
+
 
 class ComCamParseTask(ParseTask):
     """Parser suitable for comCam data
 
     See https://docushare.lsstcorp.org/docushare/dsweb/Get/Version-43119/FITS_Raft.pdf
     """
+    ConfigClass = ComCamParseConfig
 
     def __init__(self, config, *args, **kwargs):
         super(ParseTask, self).__init__(config, *args, **kwargs)
 
+    def readInfo(self, filename):
+        """Read the information for a file from its primary header
+
+        If ``config.fastHeaderScan`` is set only the primary header's blocks are read, and only
+        the keywords used by the translations are converted to a PropertyList.
+
+        Parameters
+        ----------
+        filename : `str`
+            The filename
+
+        Returns
+        -------
+        phuInfo : `dict`
+            Dictionary containing the header keys defined in the ingest config from the primary HDU
+        infoList : `list`
+            A list of dictionaries containing the phuInfo(s) for the various extensions in MEF files
+        """
+        if not self.config.fastHeaderScan or self.config.hdu != 0:
+            return ParseTask.getInfo(self, filename)
+
+        keys = set(self.config.translation.values())
+        keys.update(self.config.fastHeaderKeys)
+        md = readPrimaryHeader(filename).toPropertyList(keys)
+        phuInfo = self.getInfoFromMetadata(md)
+        return phuInfo, [phuInfo]
+
+    @instrument.timed()
     def getInfo(self, filename):
         """ Get the basename and other data which is only available from the filename/path.
 
@@ -35,7 +86,7 @@ class ComCamParseTask(ParseTask):
         infoList : `list`
             A list of dictionaries containing the phuInfo(s) for the various extensions in MEF files
         """
-        phuInfo, infoList = ParseTask.getInfo(self, filename)
+        phuInfo, infoList = self.readInfo(filename)
 
         pathname, basename = os.path.split(filename)
         basename = re.sub(r"\.(%s)$" % "|".join(EXTENSIONS), "", basename)
@@ -59,6 +110,18 @@ class ComCamParseTask(ParseTask):
 
         return phuInfo, infoList
 
+    def getDestination(self, butler, info, filename):
+        """Get destination for the file, keeping any compression suffix (e.g. ".fz") of the original
+
+        The raw templates end in ".fits"; the mapper finds the compressed file when reading.
+        """
+        destination = ParseTask.getDestination(self, butler, info, filename)
+        for suffix in COMPRESSED_SUFFIXES:
+            if filename.endswith(suffix) and not destination.endswith(suffix):
+                return destination + suffix
+        return destination
+
+    @instrument.timed()
     def translate_wavelength(self, md):
         """Translate wavelength provided by teststand readout.
 
@@ -90,6 +153,7 @@ class ComCamParseTask(ParseTask):
                 '%s is more than 0.1nm from an integer value', raw_wl)
         return wl
 
+    @instrument.timed()
     def translate_visit(self, md):
         """Generate a unique visit from the timestamp
 
@@ -110,20 +174,498 @@ class ComCamParseTask(ParseTask):
         return int(1e5*mmjd)            # 86400s per day, so we need this resolution
 
 
+_calibIdCache = ObjectCache("calibId", maxSize=1024)  # parsed CALIB_IDs, indexed by the CALIB_ID string
+
+
+def parseCalibId(calibId):
+    """Split a CALIB_ID written by constructCalibs into its fields
+
+    The result is memoized on the CALIB_ID string, so that translating each of a calib's
+    fields only parses its CALIB_ID once; only the most recently used CALIB_IDs are kept.
+
+    Parameters
+    ----------
+    calibId : `str`
+        The CALIB_ID, e.g. "ccd=S00 filter=NONE calibDate=2018-01-01"
+
+    Returns
+    -------
+    fields : `dict`
+        The value of each field; if a field appears more than once, its last value
+    """
+    return _calibIdCache.get(calibId, lambda: dict(item.split("=", 1) for item in calibId.split()
+                                                   if "=" in item))
+
+
 class ComCamCalibsParseTask(CalibsParseTask):
     """Parser for calibs"""
 
     def _translateFromCalibId(self, field, md):
         """Get a value from the CALIB_ID written by constructCalibs"""
-        data = md.getScalar("CALIB_ID")
-        match = re.search(r".*%s=(\S+)" % field, data)
-        return match.groups()[0]
+        return parseCalibId(md.getScalar("CALIB_ID"))[field]
 
+    @instrument.timed()
     def translate_ccd(self, md):
         return self._translateFromCalibId("ccd", md)
 
+    @instrument.timed()
     def translate_filter(self, md):
         return self._translateFromCalibId("filter", md)
 
+    @instrument.timed()
     def translate_calibDate(self, md):
         return self._translateFromCalibId("calibDate", md)
+
+
+def _parseFile(filename, parseTask=None):
+    """Parse a single file, returning the error message rather than raising.
+
+    Parameters
+    ----------
+    filename : `str`
+        The file to parse
+    parseTask : `lsst.pipe.tasks.ingest.ParseTask`, optional
+        The parser; defaults to the one inherited by worker processes
+
+    Returns
+    -------
+    result : `tuple`
+        ``(filename, phuInfo, infoList, error)``; ``error`` is `None` on success, in which
+        case ``phuInfo`` and ``infoList`` are as returned by ``parseTask.getInfo``
+    """
+    if parseTask is None:
+        parseTask = _parseTask
+    try:
+        phuInfo, infoList = parseTask.getInfo(filename)
+    except Exception as e:
+        return filename, None, None, "%s: %s" % (type(e).__name__, e)
+    return filename, phuInfo, infoList, None
+
+
+def _parseCalibFile(filename, parseTask=None):
+    """Parse a single calib file, returning the error message rather than raising.
+
+    Returns
+    -------
+    result : `tuple`
+        ``(filename, calibType, phuInfo, infoList, error)``; as for `_parseFile`, with
+        the calib type given by ``parseTask.getCalibType``
+    """
+    if parseTask is None:
+        parseTask = _parseTask
+    filename, phuInfo, infoList, error = _parseFile(filename, parseTask)
+    if error is not None:
+        return filename, None, None, None, error
+    try:
+        calibType = parseTask.getCalibType(filename)
+    except Exception as e:
+        return filename, None, None, None, "%s: %s" % (type(e).__name__, e)
+    return filename, calibType, phuInfo, infoList, None
+
+
+def _initWorker(parseTaskClass, parseConfig, instrumented=False):
+    """Construct the ParseTask used by a worker process; the Pool's initializer in `parseInPool`
+
+    The task is rebuilt from its class and config (which, unlike the task, can be pickled)
+    so that this works whether the workers are forked or spawned; it is named as it is in
+    IngestTask, as ParseTask has no default name.  Instrumentation is enabled in the worker
+    if it is in the parent.
+    """
+    global _parseTask
+    _parseTask = parseTaskClass(config=parseConfig, name="parse")
+    instrument.enable(instrumented)
+
+
+def _parseInWorker(parseFunc, filename):
+    """Call ``parseFunc(filename)`` in a worker, returning its result and the instrumentation statistics"""
+    return instrument.callAndSummarize(parseFunc, filename)
+
+
+def parseInPool(parseTask, filenameList, numProcesses, chunkSize, parseFunc=_parseFile):
+    """Parse files, in a pool of processes if ``numProcesses > 1``
+
+    Parameters
+    ----------
+    parseTask : `lsst.pipe.tasks.ingest.ParseTask`
+        The parser; each worker constructs its own from the task's class and config
+    filenameList : `list` of `str`
+        The files to parse
+    numProcesses : `int`
+        Number of processes to use
+    chunkSize : `int`
+        Number of files handed to a process at a time
+    parseFunc : callable
+        Called as ``parseFunc(filename, parseTask)`` (or ``parseFunc(filename)`` in the
+        workers) to parse each file, e.g. `_parseFile`
+
+    Returns
+    -------
+    results : iterator
+        The result of ``parseFunc`` for each file, in the order of ``filenameList``; the
+        instrumentation statistics recorded by the workers are added to this process's
+    """
+    if numProcesses == 1 or len(filenameList) <= 1:
+        for filename in filenameList:
+            yield parseFunc(filename, parseTask)
+        return
+
+    pool = multiprocessing.Pool(numProcesses, initializer=_initWorker,
+                                initargs=(type(parseTask), parseTask.config, instrument.isEnabled()))
+    try:
+        workerFunc = functools.partial(_parseInWorker, parseFunc)
+        for result, summary in pool.imap(workerFunc, filenameList, chunkSize):
+            if summary is not None:
+                instrument.mergeSummary(summary)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def createRegistryIndexes(conn, table, indexes):
+    """Create indexes on a registry table and refresh the query planner's statistics
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+        Connection to the registry
+    table : `str`
+        Name of the table to index
+    indexes : iterable of `str`
+        Each entry is a comma-separated list of the columns of one (composite) index
+    """
+    for index in indexes:
+        columns = [column.strip() for column in index.split(",")]
+        conn.execute("CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s (%s)" %
+                     (table, "_".join(columns), table, ", ".join(columns)))
+    conn.execute("ANALYZE %s" % table)
+
+
+def _hashFile(filename):
+    """Return the SHA-1 of a file's contents"""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class IngestManifest(object):
+    """The files already ingested into a repository, with their sizes and modification times
+
+    The manifest is an sqlite3 database kept next to the registry, so that an incremental
+    ingest can skip files that have not changed without opening them.
+
+    Parameters
+    ----------
+    filename : `str`
+        The manifest database; created if it doesn't exist
+    useHash : `bool`
+        Also record the SHA-1 of each file, so that a file whose modification time has
+        changed but whose contents have not is still considered unchanged
+    """
+
+    def __init__(self, filename, useHash=False):
+        self.useHash = useHash
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS manifest "
+                          "(path TEXT PRIMARY KEY, size INT, mtime DOUBLE, sha1 TEXT)")
+
+    def isUnchanged(self, filename):
+        """Has the file been ingested, and not modified since?"""
+        path = os.path.abspath(filename)
+        row = self.conn.execute("SELECT size, mtime, sha1 FROM manifest WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return False
+        size, mtime, sha1 = row
+        st = os.stat(path)
+        if st.st_size != size:
+            return False
+        if st.st_mtime == mtime:
+            return True
+        if self.useHash and sha1 is not None and _hashFile(path) == sha1:
+            self.conn.execute("UPDATE manifest SET mtime = ? WHERE path = ?", (st.st_mtime, path))
+            return True
+        return False
+
+    def describe(self, filename):
+        """Return what `record` stores for a file: its size, modification time and (if useHash) SHA-1
+
+        Call this before the file is ingested if the ingest may move it.
+        """
+        st = os.stat(filename)
+        sha1 = _hashFile(filename) if self.useHash else None
+        return st.st_size, st.st_mtime, sha1
+
+    def record(self, filename, description=None):
+        """Record that the file has been ingested
+
+        Parameters
+        ----------
+        filename : `str`
+            The file, at the path from which it was ingested
+        description : `tuple`, optional
+            The file's description from `describe`; if `None`, the file is examined now
+        """
+        path = os.path.abspath(filename)
+        size, mtime, sha1 = description if description is not None else self.describe(path)
+        self.conn.execute("INSERT OR REPLACE INTO manifest (path, size, mtime, sha1) VALUES (?, ?, ?, ?)",
+                          (path, size, mtime, sha1))
+
+    def close(self, commit=True):
+        """Close the manifest, committing any changes if ``commit``"""
+        if commit:
+            self.conn.commit()
+        self.conn.close()
+
+
+class ComCamIngestConfig(IngestConfig):
+    """Configuration for ComCamIngestTask"""
+    numProcesses = Field(dtype=int, default=1,
+                         doc="Number of processes used to parse file headers; 1 parses in this process")
+    chunkSize = Field(dtype=int, default=100,
+                      doc="Number of files handed to a parsing process at a time")
+    incremental = Field(dtype=bool, default=False,
+                        doc="Skip files recorded in the manifest whose size and modification time "
+                        "are unchanged, without opening them")
+    manifestName = Field(dtype=str, default="ingestManifest.sqlite3",
+                         doc="Name of the manifest of ingested files, relative to the repository root")
+    registryIndexes = ListField(dtype=str, default=["run,ccd", "visit,ccd", "imageType,testType", "dateObs"],
+                                doc="Indexes to create on the registry table, each a comma-separated "
+                                "list of columns from register.columns")
+    manifestHash = Field(dtype=bool, default=False,
+                         doc="Record the SHA-1 of each file in the manifest, and treat files with "
+                         "changed modification time but unchanged contents as unchanged")
+    headerSidecar = Field(dtype=bool, default=False,
+                          doc="Write the headers of all the HDUs of the ingested raws to a sidecar file "
+                          "in each run's directory, from which the mapper serves raw_md and raw_visitInfo")
+
+    def validate(self):
+        IngestConfig.validate(self)
+        if self.numProcesses < 1:
+            raise ValueError("numProcesses must be at least 1; saw %d" % self.numProcesses)
+        if self.chunkSize < 1:
+            raise ValueError("chunkSize must be at least 1; saw %d" % self.chunkSize)
+        for index in self.registryIndexes:
+            for column in index.split(","):
+                if column.strip() not in self.register.columns:
+                    raise ValueError("Index %s uses column %s, which is not in register.columns" %
+                                     (index, column.strip()))
+
+
+class ComCamIngestTask(IngestTask):
+    """Ingest comCam data, parsing the files in a pool of processes
+
+    The headers are parsed by ``config.numProcesses`` worker processes while this process
+    is the single writer to the registry, adding rows as the results arrive (in input order)
+    within the one transaction held open by the registry context.
+    """
+    ConfigClass = ComCamIngestConfig
+    _DefaultName = "ingest"
+
+    def parseFiles(self, filenameList):
+        """Parse files, in parallel if so configured
+
+        Parameters
+        ----------
+        filenameList : `list` of `str`
+            The files to parse
+
+        Returns
+        -------
+        results : iterator of `tuple`
+            ``(filename, phuInfo, infoList, error)`` for each file, in the order of
+            ``filenameList``; see `_parseFile`
+        """
+        return parseInPool(self.parse, filenameList, self.config.numProcesses, self.config.chunkSize)
+
+    def registerFile(self, registry, args, filename, phuInfo, infoList, manifest=None):
+        """Ingest a parsed file and add its rows to the registry
+
+        Files that are ingested, or were already present in the registry, are recorded
+        in ``manifest`` if it is provided.
+
+        Returns
+        -------
+        ingested : `bool`
+            Was the file ingested?
+        """
+        if self.isBadId(phuInfo, args.badId.idList):
+            self.log.info("Skipping declared bad file %s: %s" % (filename, phuInfo))
+            return False
+        if self.register.check(registry, phuInfo):
+            if args.ignoreIngested:
+                if manifest is not None:
+                    manifest.record(filename)
+                return False
+            self.log.warn("%s: already ingested: %s" % (filename, phuInfo))
+        outfile = self.parse.getDestination(args.butler, phuInfo, filename)
+        description = manifest.describe(filename) if manifest is not None else None  # before any move
+        if not self.ingest(filename, outfile, mode=args.mode, dryrun=args.dryrun):
+            return False
+        for info in infoList:
+            self.register.addRow(registry, info, dryrun=args.dryrun, create=args.create)
+        if manifest is not None:
+            manifest.record(filename, description)
+        return True
+
+    def addToSidecar(self, sidecars, args, filename, phuInfo):
+        """Add the headers of an ingested file to the sidecar of its run
+
+        Parameters
+        ----------
+        sidecars : `dict`
+            The `HeaderSidecar` of each run seen so far, indexed by sidecar file; any
+            existing sidecar is read when its run is first seen
+        args : `argparse.Namespace`
+            The parsed command-line arguments
+        filename : `str`
+            The file that was ingested; its headers are read from it, or from its copy in the
+            repository if it was moved.  Nothing is added if there is no copy in the repository
+            (e.g. for ``--mode=skip`` of a file outside it).
+        phuInfo : `dict`
+            The file's information, as returned by ``self.parse.getInfo``
+
+        Notes
+        -----
+        The headers of tile-compressed amplifiers are stored as those of the images, not of
+        the BINTABLEs holding them, so they match what afw reads from the file.
+        """
+        destination = self.parse.getDestination(args.butler, phuInfo, filename)
+        if not os.path.exists(destination):
+            return
+        headerFile = filename if os.path.exists(filename) else destination
+        sidecarFile, key = getSidecarLocation(destination)
+        sidecar = sidecars.get(sidecarFile)
+        if sidecar is None:
+            sidecar = HeaderSidecar.read(sidecarFile) if os.path.exists(sidecarFile) else HeaderSidecar()
+            sidecars[sidecarFile] = sidecar
+        sidecar.add(key, [header.getImageHeader() for header in readAllHeaders(headerFile)])
+
+    def run(self, args):
+        """Ingest all specified files and add them to the registry"""
+        filenameList = []
+        for filename in self.expandFiles(args.files):
+            if self.isBadFile(filename, args.badFile):
+                self.log.info("Skipping declared bad file %s" % filename)
+            else:
+                filenameList.append(filename)
+
+        t0 = time.time()
+        manifest = None
+        if self.config.incremental:
+            manifest = IngestManifest(os.path.join(args.input, self.config.manifestName),
+                                      useHash=self.config.manifestHash)
+            nFile = len(filenameList)
+            filenameList = [filename for filename in filenameList if not manifest.isUnchanged(filename)]
+            self.log.info("Skipping %d unchanged files listed in the manifest" % (nFile - len(filenameList)))
+
+        nIngested = 0
+        sidecars = {} if self.config.headerSidecar else None
+        try:
+            with self.register.openRegistry(args.input, create=args.create, dryrun=args.dryrun) as registry:
+                for filename, phuInfo, infoList, error in self.parseFiles(filenameList):
+                    if error is not None:
+                        if not self.config.allowError:
+                            raise RuntimeError("Error parsing %s: %s" % (filename, error))
+                        self.log.warn("Error parsing %s (%s); skipping" % (filename, error))
+                        continue
+                    try:
+                        if self.registerFile(registry, args, filename, phuInfo, infoList, manifest):
+                            nIngested += 1
+                            if sidecars is not None and not args.dryrun:
+                                self.addToSidecar(sidecars, args, filename, phuInfo)
+                    except Exception as e:
+                        if not self.config.allowError:
+                            raise
+                        self.log.warn("Failed to ingest file %s: %s" % (filename, e))
+                self.register.addVisits(registry, dryrun=args.dryrun)
+                if not args.dryrun:
+                    createRegistryIndexes(registry, self.register.config.table, self.config.registryIndexes)
+                    for sidecarFile, sidecar in (sidecars or {}).items():
+                        sidecar.write(sidecarFile)
+        except Exception:
+            if manifest is not None:
+                manifest.close(commit=False)
+            raise
+        if manifest is not None:
+            manifest.close(commit=not args.dryrun)
+
+        dt = time.time() - t0
+        self.log.info("Ingested %d of %d files in %.1f s (%.1f files/s) using %d process(es)" %
+                      (nIngested, len(filenameList), dt, len(filenameList)/dt if dt > 0 else 0.0,
+                       self.config.numProcesses))
+
+
+class ComCamIngestCalibsConfig(IngestCalibsConfig):
+    """Configuration for ComCamIngestCalibsTask"""
+    numProcesses = Field(dtype=int, default=1,
+                         doc="Number of processes used to parse file headers; 1 parses in this process")
+    chunkSize = Field(dtype=int, default=20,
+                      doc="Number of files handed to a parsing process at a time")
+
+    def validate(self):
+        IngestCalibsConfig.validate(self)
+        if self.numProcesses < 1:
+            raise ValueError("numProcesses must be at least 1; saw %d" % self.numProcesses)
+        if self.chunkSize < 1:
+            raise ValueError("chunkSize must be at least 1; saw %d" % self.chunkSize)
+
+
+class ComCamIngestCalibsTask(IngestCalibsTask):
+    """Ingest whole trees of comCam calibs (e.g. ``bias/``, ``dark/``, ``flat/``, ``fringe/``)
+
+    The headers are parsed by ``config.numProcesses`` worker processes; all the rows are
+    added within the registry's single transaction, after which the validity ranges of
+    the calib types seen are computed.
+    """
+    ConfigClass = ComCamIngestCalibsConfig
+    _DefaultName = "ingestCalibs"
+
+    def run(self, args):
+        """Ingest all specified files and add them to the registry"""
+        calibRoot = args.calib if args.calib is not None else args.input
+        filenameList = self.expandFiles(args.files)
+        tables = self.register.config.tables
+
+        t0 = time.time()
+        nIngested = 0
+        nPerType = dict((calibType, 0) for calibType in tables)
+        with self.register.openRegistry(calibRoot, create=args.create, dryrun=args.dryrun) as registry:
+            for filename, calibType, phuInfo, infoList, error in parseInPool(
+                    self.parse, filenameList, self.config.numProcesses, self.config.chunkSize,
+                    _parseCalibFile):
+                if error is not None:
+                    if not self.config.allowError:
+                        raise RuntimeError("Error parsing %s: %s" % (filename, error))
+                    self.log.warn("Error parsing %s (%s); skipping" % (filename, error))
+                    continue
+                if calibType not in tables:
+                    self.log.warn("Skipped adding %s of observation type '%s' to registry "
+                                  "(must be one of %s)" % (filename, calibType, ", ".join(tables)))
+                    continue
+                try:
+                    if args.mode != "skip":
+                        outfile = self.parse.getDestination(args.butler, phuInfo, filename)
+                        if not self.ingest(filename, outfile, mode=args.mode, dryrun=args.dryrun):
+                            self.log.warn("Failed to ingest %s of observation type '%s'" %
+                                          (filename, calibType))
+                            continue
+                    for info in infoList:
+                        self.register.addRow(registry, info, dryrun=args.dryrun, create=args.create,
+                                             table=calibType)
+                except Exception as e:
+                    if not self.config.allowError:
+                        raise
+                    self.log.warn("Failed to ingest file %s: %s" % (filename, e))
+                    continue
+                nIngested += 1
+                nPerType[calibType] += 1
+            if not args.dryrun:
+                self.register.updateValidityRanges(registry, args.validity)
+
+        dt = time.time() - t0
+        self.log.info("Ingested %d of %d calibs (%s) in %.1f s (%.1f files/s) using %d process(es)" %
+                      (nIngested, len(filenameList),
+                       ", ".join("%s: %d" % (calibType, nPerType[calibType]) for calibType in tables),
+                       dt, len(filenameList)/dt if dt > 0 else 0.0, self.config.numProcesses))
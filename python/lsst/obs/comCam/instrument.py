@@ -0,0 +1,278 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Opt-in per-stage timing and I/O counters for obs_comCam.
+
+Instrumentation is enabled by setting $OBS_COMCAM_INSTRUMENT to a non-empty value
+(or by calling `enable`).  Each stage then accumulates its number of calls, wall time,
+and the bytes read and files opened while it is the innermost running stage.  At exit
+the totals are logged to "obs.comCam.instrument", and also written as JSON to
+$OBS_COMCAM_INSTRUMENT_FILE if that is set; as several processes may be instrumented at
+once, "{pid}" in the name is replaced by the process ID, or if it is absent the process
+ID is appended to the name.
+
+Stages are tracked per thread; functions run in a thread pool should be wrapped with
+`inheritStages` so that their work is counted against the stage that submitted them.
+Statistics recorded in worker processes are only counted if the workers return them
+(see `callAndSummarize`) and the parent adds them to its own with `mergeSummary`.
+
+When disabled the only cost of an instrumented call is a test of a module flag.
+"""
+
+from __future__ import division, print_function
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+import lsst.log as lsstLog
+
+__all__ = ["enable", "isEnabled", "timed", "stage", "inheritStages", "addIo", "getSummary", "mergeSummary",
+           "reset", "callAndSummarize", "logSummary", "writeSummary", "getSummaryFile"]
+
+_enabled = False
+_atexitRegistered = False
+_lock = threading.Lock()
+_stats = {}                             # stage: [calls, wallTime, bytesRead, filesOpened]
+_local = threading.local()              # per-thread stack of running stages
+
+
+def _getStack():
+    """Return the calling thread's stack of running stages."""
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _getStats(name):
+    """Return the accumulated statistics of a stage, creating them if needed; call with _lock held."""
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = [0, 0.0, 0, 0]
+    return stats
+
+
+def enable(enabled=True):
+    """Turn instrumentation on or off; when first turned on, arrange for the summary to be emitted at exit."""
+    global _enabled, _atexitRegistered
+    _enabled = enabled
+    if enabled and not _atexitRegistered:
+        atexit.register(_emitAtExit)
+        _atexitRegistered = True
+
+
+def isEnabled():
+    """Is instrumentation enabled?"""
+    return _enabled
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager that records the time spent within it against stage ``name``."""
+    if not _enabled:
+        yield
+        return
+
+    stack = _getStack()
+    stack.append(name)
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        dt = time.time() - t0
+        stack.pop()
+        with _lock:
+            stats = _getStats(name)
+            stats[0] += 1
+            stats[1] += dt
+
+
+def timed(name=None):
+    """Decorator that records each call of a function as a stage.
+
+    Parameters
+    ----------
+    name : `str`, optional
+        The stage name; defaults to the function's name.
+    """
+    def decorate(func):
+        stageName = name if name is not None else func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with stage(stageName):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def inheritStages(func):
+    """Return a version of a function that runs within the calling thread's running stages.
+
+    Wrap functions passed to a thread pool with this, so that the I/O they do (and any
+    stages they run) is counted within the stage that submitted them rather than "other".
+
+    Parameters
+    ----------
+    func : callable
+        The function to run in another thread.
+
+    Returns
+    -------
+    wrapper : callable
+        ``func``, called with the submitting thread's stages pushed on the running
+        thread's stack; ``func`` itself if instrumentation is disabled.
+    """
+    if not _enabled:
+        return func
+    parentStack = list(_getStack())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = _getStack()
+        depth = len(stack)
+        stack.extend(parentStack)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            del stack[depth:]
+
+    return wrapper
+
+
+def addIo(nBytes=0, nFiles=0):
+    """Count bytes read and files opened against the calling thread's innermost stage.
+
+    I/O outside any stage is counted against the stage "other".
+    """
+    if not _enabled:
+        return
+    stack = _getStack()
+    with _lock:
+        stats = _getStats(stack[-1] if stack else "other")
+        stats[2] += nBytes
+        stats[3] += nFiles
+
+
+def getSummary():
+    """Return the statistics of each stage.
+
+    Returns
+    -------
+    summary : `dict`
+        For each stage, a `dict` of ``calls``, ``wallTime`` (seconds, including any nested
+        stages), ``bytesRead`` and ``filesOpened``.
+    """
+    with _lock:
+        return dict((name, dict(calls=calls, wallTime=wallTime, bytesRead=bytesRead, filesOpened=filesOpened))
+                    for name, (calls, wallTime, bytesRead, filesOpened) in _stats.items())
+
+
+def mergeSummary(summary):
+    """Add statistics returned by `getSummary`, e.g. in a worker process, to those of this process."""
+    with _lock:
+        for name, stats in summary.items():
+            total = _getStats(name)
+            total[0] += stats["calls"]
+            total[1] += stats["wallTime"]
+            total[2] += stats["bytesRead"]
+            total[3] += stats["filesOpened"]
+
+
+def reset():
+    """Discard all the statistics gathered so far."""
+    with _lock:
+        _stats.clear()
+
+
+def callAndSummarize(func, *args):
+    """Call a function in a worker process, returning the statistics it recorded with its result.
+
+    The worker's statistics are discarded before and after the call, so each summary
+    is only counted once when passed to `mergeSummary` by the parent process.
+
+    Returns
+    -------
+    result : `tuple`
+        ``(func(*args), summary)``, where ``summary`` is as returned by `getSummary`, or
+        `None` if instrumentation is disabled.
+    """
+    if not _enabled:
+        return func(*args), None
+    reset()
+    try:
+        return func(*args), getSummary()
+    finally:
+        reset()
+
+
+def logSummary(log=None):
+    """Log the statistics of each stage, slowest first."""
+    if log is None:
+        log = lsstLog.Log.getLogger("obs.comCam.instrument")
+    summary = getSummary()
+    for name in sorted(summary, key=lambda name: -summary[name]["wallTime"]):
+        stats = summary[name]
+        log.info("%s: %d calls, %.3f s, %d bytes read, %d files opened" %
+                 (name, stats["calls"], stats["wallTime"], stats["bytesRead"], stats["filesOpened"]))
+
+
+def writeSummary(fileName):
+    """Write the statistics of each stage to a JSON file, along with the process ID."""
+    with open(fileName, "w") as fd:
+        json.dump(dict(pid=os.getpid(), stages=getSummary()), fd, indent=2, sort_keys=True)
+
+
+def getSummaryFile():
+    """Return the file to which this process's summary is written at exit, or `None`.
+
+    This is $OBS_COMCAM_INSTRUMENT_FILE with "{pid}" replaced by the process ID, or with
+    ".<pid>" appended if it doesn't contain "{pid}", so that the processes of e.g. a
+    parallel ingest each write their own file.
+    """
+    fileName = os.environ.get("OBS_COMCAM_INSTRUMENT_FILE")
+    if not fileName:
+        return None
+    pid = os.getpid()
+    return fileName.replace("{pid}", str(pid)) if "{pid}" in fileName else "%s.%d" % (fileName, pid)
+
+
+def _emitAtExit():
+    """Log the summary and write it to `getSummaryFile`, if any stages ran."""
+    if not _stats:
+        return
+    logSummary()
+    fileName = getSummaryFile()
+    if fileName:
+        writeSummary(fileName)
+
+
+if os.environ.get("OBS_COMCAM_INSTRUMENT"):
+    enable()
@@ -0,0 +1,147 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""A MakeBrighterFatterKernelTask that measures all the amplifiers of a CCD at once, with a pool of processes.
+
+Run it with makeComCamBrighterFatterKernel.py; config/makeBrighterFatterKernel.py configures it
+(and cp_pipe's task, for which it is also used).
+"""
+
+from __future__ import division, print_function
+
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.cp.pipe.makeBrighterFatterKernel import (MakeBrighterFatterKernelTask,
+                                                   MakeBrighterFatterKernelTaskConfig)
+from lsst.obs.comCam.brighterFatter import makeKernel, measureCovariances
+
+__all__ = ["ComCamMeasureCovariancesConfig", "ComCamMeasureCovariancesTask",
+           "ComCamMakeBrighterFatterKernelConfig", "ComCamMakeBrighterFatterKernelTask"]
+
+
+class ComCamMeasureCovariancesConfig(pexConfig.Config):
+    maxLag = pexConfig.Field(dtype=int, default=8, doc="Largest lag at which to measure covariances, pixels")
+    nSigma = pexConfig.Field(dtype=float, default=5.0,
+                             doc="Rejection threshold for pixels of each pair's difference image, "
+                             "robust sigma")
+    numProcesses = pexConfig.Field(dtype=int, default=1, doc="Number of processes measuring flat pairs")
+
+
+class ComCamMeasureCovariancesTask(pipeBase.Task):
+    """Measure the pixel covariances of all the amplifiers of a CCD from pairs of raw flats.
+
+    Each pair's amplifiers are overscan-subtracted, differenced and measured with one batched
+    FFT (`lsst.obs.comCam.brighterFatter.measureFlatPair`); the pairs are spread over
+    ``config.numProcesses`` processes, and their results added to a running
+    `~lsst.obs.comCam.brighterFatter.CovarianceAccumulator` as they arrive.
+    """
+    ConfigClass = ComCamMeasureCovariancesConfig
+    _DefaultName = "covariances"
+
+    def run(self, pairs, detector):
+        """Measure the covariances of a CCD.
+
+        Parameters
+        ----------
+        pairs : `list` of `tuple`
+            ``(fileName1, fileName2)`` of each pair of raw flats.
+        detector : `lsst.afw.cameraGeom.Detector`
+            The CCD.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            ``accumulator``: the measurements (`~lsst.obs.comCam.brighterFatter.CovarianceAccumulator`).
+        """
+        accumulator = measureCovariances(pairs, detector, maxLag=self.config.maxLag,
+                                         nSigma=self.config.nSigma, numProcesses=self.config.numProcesses)
+        self.log.info("Measured %d flat pairs of %s" % (accumulator.nPair, detector.getName()))
+        return pipeBase.Struct(accumulator=accumulator)
+
+
+class ComCamMakeBrighterFatterKernelConfig(MakeBrighterFatterKernelTaskConfig):
+    covariances = pexConfig.ConfigurableField(target=ComCamMeasureCovariancesTask,
+                                              doc="Measure the covariances of the flat pairs")
+    kernelRejectLevel = pexConfig.Field(dtype=float, default=0.2,
+                                        doc="Reject an amplifier's source term if its sum is more than this "
+                                        "fraction of the sum of its absolute values")
+    kernelNSigmaClip = pexConfig.Field(dtype=float, default=3.0,
+                                       doc="Clipping threshold when averaging the source terms, sigma")
+    kernelMaxIter = pexConfig.Field(dtype=int, default=10000,
+                                    doc="Maximum number of successive over-relaxation iterations")
+    kernelELevel = pexConfig.Field(dtype=float, default=5.0e-14,
+                                   doc="Fall in the residual at which successive over-relaxation "
+                                   "has converged")
+
+
+class ComCamMakeBrighterFatterKernelTask(MakeBrighterFatterKernelTask):
+    """Make the brighter-fatter kernel and gains of a CCD from its raw flat pairs.
+
+    The covariances of all the pairs are measured by the ``covariances`` subtask (which may
+    be retargeted), and the kernel is solved for from them with
+    `lsst.obs.comCam.brighterFatter.makeKernel`.  The flats aren't processed by ISR: their
+    overscans are subtracted, and the bias and dark current cancel in each pair's difference.
+    """
+    ConfigClass = ComCamMakeBrighterFatterKernelConfig
+
+    def __init__(self, *args, **kwargs):
+        MakeBrighterFatterKernelTask.__init__(self, *args, **kwargs)
+        self.makeSubtask("covariances")
+
+    def run(self, dataRef, visitPairs):
+        """Make and write the kernel and gains of a CCD.
+
+        Parameters
+        ----------
+        dataRef : `lsst.daf.persistence.ButlerDataRef`
+            Data reference for the CCD.
+        visitPairs : `list` of `tuple` of `int`
+            The visits of each pair of flats.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            ``kernel``: the kernel (`numpy.ndarray`); ``gains``: the gain of each amplifier,
+            e-/DN (`dict` of `float`, indexed by amplifier name).
+        """
+        butler = dataRef.getButler()
+        detector = butler.get("camera")[dataRef.dataId["ccd"]]
+
+        def getRawFile(visit):
+            return butler.get("raw_filename", dict(dataRef.dataId, visit=int(visit)))[0]
+
+        pairs = [(getRawFile(visit1), getRawFile(visit2)) for visit1, visit2 in visitPairs]
+        accumulator = self.covariances.run(pairs, detector).accumulator
+
+        gains = accumulator.getGains()
+        kernel, converged, nSource = makeKernel(accumulator, gains, rejectLevel=self.config.kernelRejectLevel,
+                                                nSigma=self.config.kernelNSigmaClip,
+                                                maxIter=self.config.kernelMaxIter,
+                                                eLevel=self.config.kernelELevel)
+        if not converged:
+            self.log.warn("Kernel for %s didn't converge in %d iterations" %
+                          (detector.getName(), self.config.kernelMaxIter))
+        self.log.info("Solved for the kernel of %s from %d of %d amplifier measurements" %
+                      (detector.getName(), nSource, accumulator.nPair*len(accumulator.ampNames)))
+
+        dataRef.put(kernel, "brighterFatterKernel")
+        dataRef.put(gains, "brighterFatterGain")
+        return pipeBase.Struct(kernel=kernel, gains=gains)
@@ -0,0 +1,316 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Binned quick-look images of the whole ComCam focal plane."""
+
+from __future__ import division, print_function
+
+import collections
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+from lsst.obs.comCam import instrument, makeCamera
+from lsst.obs.comCam.overscan import OverscanGeometry, subtractOverscan
+from lsst.obs.comCam.rawReader import findRawFile, readLazyRawCcd
+
+__all__ = ["AmpPlacement", "MosaicLayout", "Mosaic", "makeMosaic", "writeMosaicFits", "writeMosaicPng"]
+
+
+class AmpPlacement(collections.namedtuple("AmpPlacement",
+                                          ["index", "geometry", "flipX", "flipY", "x0", "y0"])):
+    """Where an amplifier's data goes in the focal plane.
+
+    Parameters
+    ----------
+    index : `int`
+        The amplifier's index in its raw (its HDU - 1).
+    geometry : `lsst.obs.comCam.overscan.OverscanGeometry`
+        The amplifier's data and overscan regions in the raw.
+    flipX, flipY : `bool`
+        Whether the data are flipped in x and y when placed in the CCD.
+    x0, y0 : `int`
+        The position in the mosaic of the lower-left corner of the placed data, pixels.
+    """
+    __slots__ = ()
+
+
+def _boxToSlices(box):
+    """Convert an `lsst.afw.geom.Box2I` to numpy ``(rows, cols)`` slices."""
+    return (slice(box.getMinY(), box.getMinY() + box.getHeight()),
+            slice(box.getMinX(), box.getMinX() + box.getWidth()))
+
+
+class MosaicLayout(object):
+    """The positions of all the amplifiers of the focal plane, taken from the camera geometry.
+
+    Each CCD's reference point is placed at its focal plane position divided by its
+    pixel size, rounded to the nearest pixel; within the CCD, the data of each amplifier
+    fill its (assembled) bounding box, flipped as when the CCD is assembled.
+    Rotated CCDs (non-zero yaw) are not supported.
+
+    Parameters
+    ----------
+    cameraFile : `str`, optional
+        The camera description; defaults to obs_comCam's policy/camera.yaml.
+
+    Attributes
+    ----------
+    ccds : `dict` of `list` of `AmpPlacement`
+        The placement of each amplifier, in HDU order, indexed by CCD name (e.g. "S11").
+    ccdNames : `dict` of `str`
+        The CCD names, indexed by CCD serial number (the LSST_NUM keyword of the raws).
+    width, height : `int`
+        The size of the unbinned mosaic, pixels.
+    """
+
+    def __init__(self, cameraFile=None):
+        self.ccds = {}
+        self.ccdNames = {}
+        corners = []
+        for detector in makeCamera(cameraFile):
+            orientation = detector.getOrientation()
+            if orientation.getYaw().asDegrees() != 0.0:
+                raise ValueError("CCD %s is rotated (yaw = %s), which isn't supported" %
+                                 (detector.getName(), orientation.getYaw()))
+            pixelSize = detector.getPixelSize()
+            fpPosition, refPoint = orientation.getFpPosition(), orientation.getReferencePoint()
+            ccdX0 = int(round(fpPosition.getX()/pixelSize.getX() - refPoint.getX()))
+            ccdY0 = int(round(fpPosition.getY()/pixelSize.getY() - refPoint.getY()))
+
+            placements = []
+            for index, amp in enumerate(detector):  # the amplifiers are in HDU order
+                geometry = OverscanGeometry(_boxToSlices(amp.getRawDataBBox()),
+                                            _boxToSlices(amp.getRawHorizontalOverscanBBox()),
+                                            _boxToSlices(amp.getRawVerticalOverscanBBox()))
+                bbox = amp.getBBox()
+                x0, y0 = ccdX0 + bbox.getMinX(), ccdY0 + bbox.getMinY()
+                placements.append(AmpPlacement(index, geometry, amp.getRawFlipX(), amp.getRawFlipY(), x0, y0))
+                corners.append((x0, y0, x0 + bbox.getWidth(), y0 + bbox.getHeight()))
+            self.ccds[detector.getName()] = placements
+            self.ccdNames[detector.getSerial()] = detector.getName()
+
+        xMin, yMin = min(c[0] for c in corners), min(c[1] for c in corners)
+        self.width = max(c[2] for c in corners) - xMin
+        self.height = max(c[3] for c in corners) - yMin
+        for ccdName, placements in self.ccds.items():
+            self.ccds[ccdName] = [p._replace(x0=p.x0 - xMin, y0=p.y0 - yMin) for p in placements]
+
+
+def _getBins(start, n, binning, flip=False):
+    """Split a row or column of ``n`` pixels into the bins of a binned image.
+
+    Parameters
+    ----------
+    start : `int`
+        The position in the unbinned image of the first placed pixel.
+    n : `int`
+        The number of pixels.
+    binning : `int`
+        The number of pixels in each bin.
+    flip : `bool`
+        Are the pixels placed in reverse order?
+
+    Returns
+    -------
+    starts : `numpy.ndarray`
+        The index of the first pixel in each bin, in the order read, as used by
+        `numpy.ufunc.reduceat`.
+    firstBin : `int`
+        The first bin in the binned image; the bins are consecutive.
+    counts : `numpy.ndarray`
+        The number of pixels in each bin, in the order read.
+    """
+    positions = start + (np.arange(n - 1, -1, -1) if flip else np.arange(n))
+    bins = positions//binning
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    counts = np.diff(np.append(starts, n))
+    return starts, bins.min(), counts
+
+
+class Mosaic(object):
+    """A binned image of the focal plane, built up an amplifier at a time.
+
+    Only the binned sums and pixel counts are kept, so the memory used is that of two
+    binned images however many amplifiers are added.  Amplifiers may be added from
+    several threads.
+
+    Parameters
+    ----------
+    layout : `MosaicLayout`
+        The positions of the amplifiers.
+    binning : `int`
+        The number of pixels binned in each direction.
+    """
+
+    def __init__(self, layout, binning):
+        self.layout = layout
+        self.binning = binning
+        shape = (-(-layout.height//binning), -(-layout.width//binning))
+        self._sums = np.zeros(shape, dtype=np.float32)
+        self._counts = np.zeros(shape, dtype=np.int32)
+        self._lock = threading.Lock()
+
+    def addAmp(self, placement, data):
+        """Add the data of an amplifier.
+
+        Parameters
+        ----------
+        placement : `AmpPlacement`
+            Where the amplifier goes.
+        data : `numpy.ndarray`
+            The amplifier's (e.g. overscan-subtracted) data region, as read, i.e. before flipping.
+        """
+        height, width = data.shape
+        rowStarts, row0, rowCounts = _getBins(placement.y0, height, self.binning, placement.flipY)
+        colStarts, col0, colCounts = _getBins(placement.x0, width, self.binning, placement.flipX)
+
+        # Sum along the rows first as they're contiguous, and flip the (small) binned sums
+        sums = np.add.reduceat(np.add.reduceat(data, colStarts, axis=1), rowStarts, axis=0)
+        counts = np.outer(rowCounts, colCounts)
+        if placement.flipX:
+            sums, counts = sums[:, ::-1], counts[:, ::-1]
+        if placement.flipY:
+            sums, counts = sums[::-1], counts[::-1]
+        rows, cols = slice(row0, row0 + len(rowStarts)), slice(col0, col0 + len(colStarts))
+        with self._lock:
+            self._sums[rows, cols] += sums
+            self._counts[rows, cols] += counts
+
+    def getImage(self):
+        """Return the binned image: the mean of the pixels in each bin, and NaN where there are none."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self._counts > 0, self._sums/self._counts, np.nan).astype(np.float32)
+
+
+def _openCcd(layout, fileName):
+    """Read the headers of a raw, returning the name of its CCD and the (lazily read) raw."""
+    nAmp = len(next(iter(layout.ccds.values())))
+    rawCcd = readLazyRawCcd(findRawFile(fileName), nAmp=nAmp)
+
+    serial = rawCcd.metadata.get("LSST_NUM")
+    ccdName = layout.ccdNames.get(serial)
+    if ccdName is None:
+        raise RuntimeError("%s has LSST_NUM = %s, which isn't in the camera" % (fileName, serial))
+    return ccdName, rawCcd
+
+
+def _addAmp(args):
+    """Read an amplifier of a raw and add it to a mosaic; used by `makeMosaic`."""
+    mosaic, rawCcd, placement = args
+    array = rawCcd.getAmpArray(placement.index)
+    data = subtractOverscan(array[np.newaxis], placement.geometry, doParallel=False, trim=True)[0]
+    mosaic.addAmp(placement, data)
+    if hasattr(rawCcd, "unload"):       # gzipped raws are read all at once
+        rawCcd.unload(placement.index)
+
+
+@instrument.timed()
+def makeMosaic(fileNames, binning=8, cameraFile=None, numThreads=1):
+    """Make a binned image of the focal plane from the raws of an exposure.
+
+    Each amplifier is read, has its serial overscan subtracted and is block-averaged
+    into the mosaic in turn, so each thread holds at most one amplifier's pixels at a
+    time (except for gzipped raws, which are read whole) and no CCD is ever assembled
+    at full resolution.  The memory used is thus that of the binned image plus about
+    10 Mbyte per thread.
+
+    Parameters
+    ----------
+    fileNames : iterable of `str`
+        The raws, one per CCD; each is identified by its LSST_NUM keyword.  Missing
+        CCDs are left blank.
+    binning : `int`
+        The number of pixels binned in each direction.
+    cameraFile : `str`, optional
+        The camera description; defaults to obs_comCam's policy/camera.yaml.
+    numThreads : `int`
+        Number of amplifiers (of any CCDs) read at once.
+
+    Returns
+    -------
+    mosaic : `Mosaic`
+        The mosaic; see `Mosaic.getImage`.
+    """
+    mosaic = Mosaic(MosaicLayout(cameraFile), binning)
+    rawCcds = [_openCcd(mosaic.layout, fileName) for fileName in fileNames]
+
+    ccdNames = [ccdName for ccdName, rawCcd in rawCcds]
+    duplicates = sorted(set(name for name in ccdNames if ccdNames.count(name) > 1))
+    if duplicates:
+        raise RuntimeError("More than one raw was given for CCDs %s" % (duplicates,))
+
+    args = [(mosaic, rawCcd, placement) for ccdName, rawCcd in rawCcds
+            for placement in mosaic.layout.ccds[ccdName]]
+    if numThreads == 1:
+        for arg in args:
+            _addAmp(arg)
+    else:
+        pool = ThreadPool(numThreads)
+        try:
+            pool.map(instrument.inheritStages(_addAmp), args, 1)
+        finally:
+            pool.close()
+            pool.join()
+    return mosaic
+
+
+def writeMosaicFits(fileName, mosaic, cards=()):
+    """Write a mosaic's image as a 32-bit floating point FITS file.
+
+    Parameters
+    ----------
+    fileName : `str`
+        The file to write.
+    mosaic : `Mosaic`
+        The mosaic.
+    cards : `list` of `tuple`
+        Extra ``(keyword, value)`` pairs for the header, e.g. from the raws' primary header.
+    """
+    metadata = dafBase.PropertyList()
+    metadata.set("BINNING", mosaic.binning)
+    for key, value in cards:
+        metadata.set(key, value)
+    afwImage.ImageF(mosaic.getImage()).writeFits(fileName, metadata)
+
+
+def writeMosaicPng(fileName, mosaic, limits=(1.0, 99.5)):
+    """Write a mosaic's image as a greyscale PNG, with a linear stretch; requires matplotlib.
+
+    Parameters
+    ----------
+    fileName : `str`
+        The file to write.
+    mosaic : `Mosaic`
+        The mosaic.
+    limits : `tuple` of `float`
+        The percentiles of the pixel values mapped to black and white; blank regions are black.
+    """
+    import matplotlib.image             # only needed here, so not a dependency of obs_comCam
+
+    image = mosaic.getImage()
+    good = np.isfinite(image)
+    lo, hi = np.percentile(image[good], limits) if good.any() else (0.0, 1.0)
+    matplotlib.image.imsave(fileName, np.where(good, image, lo), vmin=lo, vmax=max(hi, lo + 1e-10),
+                            cmap="gray", origin="lower", format="png")
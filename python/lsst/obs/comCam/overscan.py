@@ -0,0 +1,162 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Overscan subtraction for all the amplifiers of a ComCam CCD at once."""
+
+from __future__ import division, print_function
+
+import collections
+
+import numpy as np
+
+__all__ = ["OverscanGeometry", "getOverscanGeometry", "groupAmpsByGeometry", "subtractOverscan",
+           "subtractCcdOverscan"]
+
+
+class OverscanGeometry(collections.namedtuple("OverscanGeometry", ["data", "serial", "parallel"])):
+    """The regions of an amplifier's raw data, each a ``(ySlice, xSlice)`` pair.
+
+    Attributes
+    ----------
+    data : `tuple` of `slice`
+        The imaging region (rawDataBBox).
+    serial : `tuple` of `slice`
+        The serial overscan (rawSerialOverscanBBox).
+    parallel : `tuple` of `slice`
+        The parallel overscan (rawParallelOverscanBBox).
+    """
+    __slots__ = ()
+
+
+def _bboxToSlices(bbox):
+    """Convert a `lsst.afw.geom.Box2I` to a ``(ySlice, xSlice)`` pair."""
+    return (slice(bbox.getMinY(), bbox.getMaxY() + 1), slice(bbox.getMinX(), bbox.getMaxX() + 1))
+
+
+def getOverscanGeometry(amp):
+    """Return the `OverscanGeometry` of an amplifier.
+
+    Parameters
+    ----------
+    amp : `lsst.afw.table.AmpInfoRecord`
+        The amplifier, whose raw bounding boxes are relative to its own raw data
+        (as they are for ComCam, which has ``perAmpData : True``).
+    """
+    return OverscanGeometry(_bboxToSlices(amp.getRawDataBBox()),
+                            _bboxToSlices(amp.getRawHorizontalOverscanBBox()),
+                            _bboxToSlices(amp.getRawVerticalOverscanBBox()))
+
+
+def groupAmpsByGeometry(amps):
+    """Group amplifiers that have identical raw geometry.
+
+    Parameters
+    ----------
+    amps : sequence of `lsst.afw.table.AmpInfoRecord`
+        The amplifiers.
+
+    Returns
+    -------
+    groups : `list` of `tuple`
+        ``(geometry, indices)`` for each distinct `OverscanGeometry`, where ``indices``
+        are the positions in ``amps`` of the amplifiers that have it (for ComCam, a
+        single group of all sixteen).
+    """
+    groups = collections.OrderedDict()  # slices aren't hashable, so key on their limits
+    for i, amp in enumerate(amps):
+        geometry = getOverscanGeometry(amp)
+        key = tuple((s.start, s.stop) for region in geometry for s in region)
+        groups.setdefault(key, (geometry, []))[1].append(i)
+    return list(groups.values())
+
+
+def subtractOverscan(stack, geometry, doParallel=True, trim=False):
+    """Subtract the overscan from a stack of amplifiers that share the same geometry.
+
+    The serial overscan level of each row is the median of the serial overscan columns
+    of that row; the parallel overscan level of each column is then the median of the
+    (serial-corrected) parallel overscan rows of that column.  All the amplifiers are
+    processed together with array operations.
+
+    Parameters
+    ----------
+    stack : `numpy.ndarray`
+        The raw pixels, as ``(nAmp, height, width)``.
+    geometry : `OverscanGeometry`
+        The regions of each amplifier.
+    doParallel : `bool`
+        Also subtract the parallel overscan?
+    trim : `bool`
+        Return only the imaging region?
+
+    Returns
+    -------
+    result : `numpy.ndarray`
+        The overscan-subtracted float32 pixels, as ``(nAmp, height, width)``, or the
+        shape of the imaging region if ``trim``.
+    """
+    result = np.array(stack, dtype=np.float32)
+
+    xs = geometry.serial[1]
+    result -= np.median(result[:, :, xs], axis=2)[:, :, np.newaxis]
+
+    if doParallel:
+        yp, xp = geometry.parallel
+        result[:, :, xp] -= np.median(result[:, yp, xp], axis=1)[:, np.newaxis, :]
+
+    if trim:
+        yd, xd = geometry.data
+        return result[:, yd, xd]
+    return result
+
+
+def subtractCcdOverscan(amps, arrays, doParallel=True, trim=False):
+    """Subtract the overscan from all the amplifiers of a CCD.
+
+    Amplifiers with identical geometry are stacked and processed together by
+    `subtractOverscan` (for ComCam, that is all sixteen).
+
+    Parameters
+    ----------
+    amps : sequence of `lsst.afw.table.AmpInfoRecord`
+        The amplifiers.
+    arrays : sequence of `numpy.ndarray`
+        The raw pixels of each amplifier, in the same order as ``amps``; may be
+        an already-stacked ``(nAmp, height, width)`` array.
+    doParallel : `bool`
+        Also subtract the parallel overscan?
+    trim : `bool`
+        Return only the imaging regions?
+
+    Returns
+    -------
+    results : `list` of `numpy.ndarray`
+        The overscan-subtracted float32 pixels of each amplifier, in the order of ``amps``.
+    """
+    results = [None]*len(arrays)
+    for geometry, indices in groupAmpsByGeometry(amps):
+        if len(indices) == len(arrays) and isinstance(arrays, np.ndarray):
+            stack = arrays              # already stacked, e.g. RawCcd.pixels
+        else:
+            stack = np.stack([arrays[i] for i in indices])
+        for i, result in zip(indices, subtractOverscan(stack, geometry, doParallel=doParallel, trim=trim)):
+            results[i] = result
+    return results
@@ -0,0 +1,345 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Read the raws and calibs of upcoming visits in the background while the current visit is processed."""
+
+from __future__ import division, print_function
+
+import collections
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from lsst.obs.comCam import instrument
+from lsst.obs.comCam.rawReader import findRawFile
+
+__all__ = ["PrefetchStats", "PrefetchedVisit", "VisitPrefetcher"]
+
+
+class PrefetchStats(object):
+    """Statistics of a `VisitPrefetcher`.
+
+    Attributes
+    ----------
+    visits : `int`
+        Number of visits delivered.
+    hits : `int`
+        Number of visits that had been completely read by the time they were wanted.
+    stallTime : `float`
+        Total time spent waiting for visits that hadn't been read, seconds.
+    readTime : `float`
+        Total time spent reading visits (in the background), seconds.
+    bytesRead : `int`
+        Total size of the raw pixels read.
+    """
+
+    def __init__(self):
+        self.visits = 0
+        self.hits = 0
+        self.stallTime = 0.0
+        self.readTime = 0.0
+        self.bytesRead = 0
+
+    @property
+    def hitRate(self):
+        """The fraction of visits that were ready when wanted."""
+        return self.hits/self.visits if self.visits else 0.0
+
+    def __repr__(self):
+        return ("PrefetchStats(visits=%d, hitRate=%.2f, stallTime=%.3f, readTime=%.3f, bytesRead=%d)" %
+                (self.visits, self.hitRate, self.stallTime, self.readTime, self.bytesRead))
+
+
+class PrefetchedVisit(object):
+    """The raws and calibs of a visit, read by a `VisitPrefetcher`.
+
+    Attributes
+    ----------
+    dataId : `dict`
+        The visit's data ID.
+    ccdIds : `list` of `dict`
+        The data ID of each CCD.
+    rawCcds : `dict` of `lsst.obs.comCam.rawReader.RawCcd`
+        The raw of each CCD, as read by ``raw_mef``; its ``metadata`` is the primary
+        header (as for ``raw_hdu``).  Indexed by CCD name.
+    calibs : `dict`
+        The calibs of each CCD, indexed by ``(datasetType, ccd)``; `None` if there is
+        no calib.  Calibs are shared by all the visits that use them, so must not be modified.
+    nBytes : `int`
+        The size of the raws' pixels.
+    """
+
+    def __init__(self, dataId, ccdIds, rawCcds, calibs):
+        self.dataId = dataId
+        self.ccdIds = ccdIds
+        self.rawCcds = rawCcds
+        self.calibs = calibs
+        self.nBytes = sum(_getRawBytes(rawCcd) for rawCcd in rawCcds.values())
+
+    def __len__(self):
+        return len(self.ccdIds)
+
+
+class _CalibEntry(object):
+    """A calib file held by a `VisitPrefetcher`, read by the first CCD thread that wants it."""
+
+    def __init__(self, nBytes):
+        self.event = threading.Event()  # set once the calib has been read, or failed to be
+        self.calib = None
+        self.error = None               # the exception raised while reading the calib
+        self.nBytes = nBytes            # size of the calib's file
+        self.lastVisit = -1             # index of the last visit to use the calib
+
+
+def _getRawBytes(rawCcd):
+    """Return the size of a RawCcd's pixels."""
+    if rawCcd.pixels is not None:
+        return rawCcd.pixels.nbytes
+    return sum(4*header["NAXIS1"]*header["NAXIS2"] for header in rawCcd.ampHeaders)
+
+
+class VisitPrefetcher(object):
+    """Iterate over the visits of a dataId, reading upcoming visits in background threads.
+
+    While the caller processes one visit, up to ``depth`` following visits are read,
+    each with its CCDs read in parallel.  A visit isn't started if the visits read or
+    being read (and their calibs) would then take more than ``maxBytes``, unless it is the
+    next visit wanted; when the caller asks for the next visit it is assumed to have
+    finished with the previous one.  A visit's size is estimated as that of the previous
+    visit's raws (or, for the first, the size of its files), plus the size of the files of
+    any calibs it needs that aren't already held.  Each calib file is read once and
+    held while the visits read or being read use it, and is released once the caller has
+    finished with the last visit that used it; the calibs held (as measured by the size of
+    their files) count against ``maxBytes``.
+
+    Parameters
+    ----------
+    mapper : `lsst.obs.comCam.ComCamMapper`
+        The mapper used to find and read the raws and calibs.
+    dataId : `dict`, optional
+        Selects the visits, e.g. ``dict(run="5000")``; all visits if omitted.
+    depth : `int`
+        Maximum number of visits read ahead.
+    maxBytes : `int`
+        Memory budget for the raws and calibs, bytes.
+    calibTypes : iterable of `str`
+        The calibs read for each CCD, e.g. ("bias", "flat").
+    numThreads : `int`, optional
+        Number of CCDs read at once; defaults to 9.
+
+    Notes
+    -----
+    Use as::
+
+        prefetcher = VisitPrefetcher(butler.mapper, dict(run="5000"), calibTypes=["bias"])
+        for visit in prefetcher:
+            for ccdId in visit.ccdIds:
+                process(visit.rawCcds[ccdId["ccd"]], visit.calibs[("bias", ccdId["ccd"])])
+        print(prefetcher.stats)
+    """
+
+    def __init__(self, mapper, dataId=None, depth=2, maxBytes=2*2**30, calibTypes=(), numThreads=None):
+        self.mapper = mapper
+        self.dataId = dict(dataId) if dataId else {}
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.calibTypes = list(calibTypes)
+        self.numThreads = numThreads if numThreads else 9
+        self.visitIds = [dict(self.dataId, visit=visit)
+                         for visit in sorted(set(row[0] for row in mapper.query_raw(["visit"], self.dataId)))]
+        self.stats = PrefetchStats()
+        self._statsLock = threading.Lock()
+        self._calibs = {}               # fileName: _CalibEntry; shared by visits
+        self._calibLock = threading.Lock()
+
+    def __len__(self):
+        return len(self.visitIds)
+
+    def _findCalib(self, datasetType, ccdId):
+        """Return the location of a calib of a CCD, or `None` if there's none."""
+        try:
+            location = self.mapper.map(datasetType, ccdId)
+        except RuntimeError:            # no calib, e.g. lsst.daf.persistence.NoResults
+            return None
+        return location if os.path.exists(location.getLocationsWithRoot()[0]) else None
+
+    def _readCalib(self, datasetType, ccdId, visitIndex):
+        """Return a calib of a CCD, reading it if it isn't already held, or `None` if there's none.
+
+        If reading the calib fails, the exception is raised in every thread waiting for
+        it, and the calib is read again if a later visit wants it.
+        """
+        location = self._findCalib(datasetType, ccdId)
+        if location is None:
+            return None
+        fileName = location.getLocationsWithRoot()[0]
+
+        with self._calibLock:
+            entry = self._calibs.get(fileName)
+            isReader = entry is None
+            if isReader:
+                entry = self._calibs[fileName] = _CalibEntry(os.path.getsize(fileName))
+            entry.lastVisit = max(entry.lastVisit, visitIndex)
+        if isReader:
+            try:
+                read = getattr(self.mapper, "bypass_" + datasetType)
+                entry.calib = read(datasetType, None, location, ccdId)
+            except Exception as e:
+                entry.error = e
+                with self._calibLock:
+                    if self._calibs.get(fileName) is entry:
+                        del self._calibs[fileName]
+                raise
+            finally:
+                entry.event.set()
+        else:
+            entry.event.wait()          # another CCD's thread is reading it
+            if entry.error is not None:
+                raise entry.error
+        return entry.calib
+
+    def _getCalibBytes(self):
+        """Return the size of the calibs held."""
+        with self._calibLock:
+            return sum(entry.nBytes for entry in self._calibs.values())
+
+    def _releaseCalibs(self, visitIndex):
+        """Release the calibs last used by visits up to and including ``visitIndex``."""
+        with self._calibLock:
+            for fileName, entry in list(self._calibs.items()):
+                if entry.event.is_set() and entry.lastVisit <= visitIndex:
+                    del self._calibs[fileName]
+
+    def _readCcd(self, ccdId, visitIndex):
+        """Read the raw and calibs of a CCD."""
+        location = self.mapper.map("raw_mef", ccdId)
+        rawCcd = self.mapper.bypass_raw_mef("raw_mef", None, location, ccdId)
+        calibs = dict((datasetType, self._readCalib(datasetType, ccdId, visitIndex))
+                      for datasetType in self.calibTypes)
+        return rawCcd, calibs
+
+    def _getCcdIds(self, visitId):
+        """Return the data IDs of the CCDs of a visit."""
+        return [dict(visitId, ccd=ccd, run=run)
+                for ccd, run in self.mapper.query_raw(["ccd", "run"], visitId)]
+
+    def _estimateBytes(self, visitId, rawBytes=None):
+        """Estimate the memory needed to read a visit.
+
+        Parameters
+        ----------
+        visitId : `dict`
+            The visit's data ID.
+        rawBytes : `int`, optional
+            The size of the visit's raws, if known (e.g. from the previous visit);
+            otherwise estimated from the size of their files.
+
+        Returns
+        -------
+        nBytes : `int`
+            The size of the raws, plus that of the files of the calibs they need that
+            aren't already held.
+        """
+        nBytes = 0
+        calibFiles = set()
+        for ccdId in self._getCcdIds(visitId):
+            if rawBytes is None:
+                fileName = findRawFile(self.mapper.map("raw_mef", ccdId).getLocationsWithRoot()[0])
+                if os.path.exists(fileName):
+                    nBytes += os.path.getsize(fileName)
+            for datasetType in self.calibTypes:
+                location = self._findCalib(datasetType, ccdId)
+                if location is not None:
+                    calibFiles.add(location.getLocationsWithRoot()[0])
+        with self._calibLock:
+            calibFiles.difference_update(self._calibs)
+        return (nBytes if rawBytes is None else rawBytes) + sum(os.path.getsize(f) for f in calibFiles)
+
+    @instrument.timed("prefetchVisit")
+    def _readVisit(self, visitId, visitIndex, ccdPool):
+        """Read all the CCDs of a visit (the ``visitIndex``-th to be read); run in a background thread."""
+        t0 = time.time()
+        ccdIds = self._getCcdIds(visitId)
+        readCcd = instrument.inheritStages(self._readCcd)
+        results = ccdPool.map(lambda ccdId: readCcd(ccdId, visitIndex), ccdIds)
+
+        rawCcds = {}
+        calibs = {}
+        for ccdId, (rawCcd, ccdCalibs) in zip(ccdIds, results):
+            rawCcds[ccdId["ccd"]] = rawCcd
+            for datasetType, calib in ccdCalibs.items():
+                calibs[(datasetType, ccdId["ccd"])] = calib
+        visit = PrefetchedVisit(visitId, ccdIds, rawCcds, calibs)
+
+        with self._statsLock:
+            self.stats.readTime += time.time() - t0
+            self.stats.bytesRead += visit.nBytes
+        return visit
+
+    def __iter__(self):
+        queued = collections.deque(self.visitIds)
+        pending = collections.deque()   # [visitId, AsyncResult, bytes reserved, index], in visit order
+        visitPool = ThreadPool(max(1, self.depth))
+        ccdPool = ThreadPool(self.numThreads)
+        estimate = None                 # size of the previous visit's raws
+        nStarted = 0                    # number of visits started
+        try:
+            while queued or pending:
+                while queued and len(pending) < self.depth:
+                    held = self._getCalibBytes()
+                    for item in pending:
+                        if item[1].ready() and item[1].successful():
+                            item[2] = item[1].get().nBytes
+                        held += item[2]
+                    nBytes = self._estimateBytes(queued[0], estimate)
+                    if pending and held + nBytes > self.maxBytes:
+                        break
+                    visitId = queued.popleft()
+                    result = visitPool.apply_async(instrument.inheritStages(self._readVisit),
+                                                   (visitId, nStarted, ccdPool))
+                    pending.append([visitId, result, nBytes, nStarted])
+                    nStarted += 1
+
+                visitId, result, nBytes, visitIndex = pending.popleft()
+                ready = result.ready()
+                if not ready:
+                    t0 = time.time()
+                    result.wait()
+                    stallTime = time.time() - t0
+                visit = result.get()
+                with self._statsLock:
+                    self.stats.visits += 1
+                    if ready:
+                        self.stats.hits += 1
+                    else:
+                        self.stats.stallTime += stallTime
+
+                estimate = visit.nBytes
+                yield visit
+                del visit
+                self._releaseCalibs(visitIndex)  # the calibs that no later visit has asked for
+        finally:
+            for pool in (visitPool, ccdPool):
+                pool.close()
+            visitPool.join()
+            ccdPool.join()
+            self._calibs.clear()
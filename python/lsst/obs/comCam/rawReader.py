@@ -0,0 +1,808 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Single-pass reader for ComCam raw multi-extension FITS files."""
+
+from __future__ import division, print_function
+
+import gzip
+import io
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+import threading
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+from lsst.obs.comCam import instrument
+
+__all__ = ["FitsHeader", "RawCcd", "LazyRawCcd", "MappedRawCcd", "readHeader", "readPrimaryHeader",
+           "readAllHeaders", "readRawCcd", "readLazyRawCcd", "scanHeaders", "readImageRows", "findRawFile",
+           "findRawLocation", "formatHeader"]
+
+BLOCK_SIZE = 2880                       # size of a FITS block, bytes
+CARD_SIZE = 80                          # size of a FITS header card, bytes
+N_AMP = 16                              # number of amplifiers in a ComCam CCD
+
+COMPRESSED_SUFFIXES = (".fz", ".gz")    # suffixes of compressed raws, in order of preference
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_BITPIX_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+_COMMENTARY_KEYS = ("COMMENT", "HISTORY", "")
+_INT_RE = re.compile(r"^[+-]?\d+$")
+_HDU_SUFFIX_RE = re.compile(r"\[\d+\]$")
+#
+# Keywords of a tile-compressed image's BINTABLE header that describe the table, not the image
+#
+_COMPRESSION_KEY_RE = re.compile(r"^(XTENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|CHECKSUM|DATASUM|TFIELDS|THEAP|"
+                                 r"T(TYPE|FORM|UNIT|DIM|NULL|SCAL|ZERO|DISP)\d+|"
+                                 r"Z(IMAGE|SIMPLE|EXTEND|TENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|TILE\d+|"
+                                 r"CMPTYPE|NAME\d+|VAL\d+|QUANTIZ|DITHER0|BLOCKED|HECKSUM|DATASUM))$")
+
+_decompressPools = {}                   # process pools used by _readTileCompressed, indexed by size
+_decompressPoolLock = threading.Lock()
+
+
+class FitsHeader(object):
+    """The cards of a single FITS header.
+
+    Parameters
+    ----------
+    cards : `list` of `tuple`
+        The ``(key, value, comment)`` triplets, in the order they appear in the file.
+    """
+
+    def __init__(self, cards):
+        self.cards = cards
+        self._values = dict((key, value) for key, value, comment in cards if key not in _COMMENTARY_KEYS)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def getDataSize(self):
+        """Return the size of the data unit following this header, excluding padding, in bytes."""
+        naxis = self.get("NAXIS", 0)
+        if naxis == 0:
+            return 0
+        nPixel = 1
+        for i in range(1, naxis + 1):
+            nPixel *= self["NAXIS%d" % i]
+        nPixel += self.get("PCOUNT", 0)
+        return self.get("GCOUNT", 1)*nPixel*abs(self["BITPIX"])//8
+
+    def getImageHeader(self):
+        """Return the header of the image in this HDU.
+
+        For a tile-compressed image this is the header of the uncompressed image (as
+        returned by cfitsio, and so afw), rather than that of the BINTABLE holding it;
+        otherwise it is this header.
+        """
+        if not self.get("ZIMAGE", False):
+            return self
+        naxis = self["ZNAXIS"]
+        cards = [("XTENSION", self.get("ZTENSION", "IMAGE"), "image extension"),
+                 ("BITPIX", self["ZBITPIX"], "data type of original image"),
+                 ("NAXIS", naxis, "dimension of original image")]
+        cards += [("NAXIS%d" % i, self["ZNAXIS%d" % i], "length of original image axis")
+                  for i in range(1, naxis + 1)]
+        cards += [("PCOUNT", self.get("ZPCOUNT", 0), "number of parameters"),
+                  ("GCOUNT", self.get("ZGCOUNT", 1), "number of groups")]
+        cards += [card for card in self.cards if not _COMPRESSION_KEY_RE.match(card[0])]
+        for key, compressedKey in (("CHECKSUM", "ZHECKSUM"), ("DATASUM", "ZDATASUM")):
+            if compressedKey in self:
+                cards.append((key, self[compressedKey], ""))
+        return FitsHeader(cards)
+
+    def toPropertyList(self, keys=None):
+        """Convert the header to a `lsst.daf.base.PropertyList`.
+
+        Parameters
+        ----------
+        keys : iterable of `str`, optional
+            Only copy these keywords; all are copied if `None`.
+
+        Returns
+        -------
+        md : `lsst.daf.base.PropertyList`
+            The header values; undefined values are omitted.
+        """
+        if keys is not None:
+            keys = set(keys)
+        md = dafBase.PropertyList()
+        for key, value, comment in self.cards:
+            if value is None or (keys is not None and key not in keys):
+                continue
+            if key in _COMMENTARY_KEYS:
+                if key:
+                    md.add(key, value)
+            else:
+                md.set(key, value, comment)
+        return md
+
+
+class RawCcd(object):
+    """The headers and pixels of all the amplifiers of a raw CCD.
+
+    Parameters
+    ----------
+    metadata : `FitsHeader`
+        The primary header.
+    ampHeaders : `list` of `FitsHeader`
+        The header of each amplifier's HDU, in HDU order.
+    pixels : `numpy.ndarray`
+        The pixels of all amplifiers, stacked as ``(nAmp, height, width)``.
+    """
+
+    def __init__(self, metadata, ampHeaders, pixels):
+        self.metadata = metadata
+        self.ampHeaders = ampHeaders
+        self.pixels = pixels
+        self.detector = None            # set by the mapper
+        self.mapper = None              # the mapper that read it, if any
+
+    def __len__(self):
+        return len(self.ampHeaders)
+
+    def getAmpArray(self, i):
+        """Return the int32 pixels of the ``i``-th amplifier."""
+        return self.pixels[i]
+
+    def getAmpIndex(self, ampName):
+        """Return the index of the amplifier called ``ampName`` in the detector."""
+        for i, amp in enumerate(self.detector):
+            if amp.getName() == ampName:
+                return i
+        raise KeyError("Detector %s has no amplifier %s" % (self.detector.getName(), ampName))
+
+
+class LazyRawCcd(RawCcd):
+    """A raw CCD whose headers have been read, but each of whose amplifiers is only read on first use.
+
+    Parameters
+    ----------
+    fileName : `str`
+        The raw file, which must not be gzipped.
+    metadata : `FitsHeader`
+        The primary header.
+    ampHeaders : `list` of `FitsHeader`
+        The header of each amplifier's HDU, in HDU order.
+    offsets : `list` of `int`
+        The position in the file of each amplifier's data unit.
+    """
+
+    def __init__(self, fileName, metadata, ampHeaders, offsets):
+        RawCcd.__init__(self, metadata, ampHeaders, None)
+        self.fileName = fileName
+        self.offsets = offsets
+        self._ampArrays = [None]*len(ampHeaders)
+        self._locks = [threading.Lock() for header in ampHeaders]  # so different amplifiers are read at once
+
+    def isLoaded(self, i):
+        """Have the pixels of the ``i``-th amplifier been read?"""
+        return self._ampArrays[i] is not None
+
+    def unload(self, i):
+        """Discard the pixels of the ``i``-th amplifier; they are read again if next used."""
+        with self._locks[i]:
+            self._ampArrays[i] = None
+
+    def getAmpArray(self, i):
+        """Return the int32 pixels of the ``i``-th amplifier, reading them on first use.
+
+        Only the amplifier being read is locked, so several threads may read different
+        amplifiers concurrently.
+        """
+        with self._locks[i]:
+            if self._ampArrays[i] is None:
+                header = self.ampHeaders[i]
+                if header.get("ZIMAGE", False):
+                    width, height = header["ZNAXIS1"], header["ZNAXIS2"]
+                    out = _readCompressedBand((self.fileName, i + 1, width, 0, height))
+                    instrument.addIo(nBytes=_getCompressedSize(header), nFiles=1)
+                else:
+                    out = np.empty((header["NAXIS2"], header["NAXIS1"]), dtype=np.int32)
+                    instrument.addIo(nFiles=1)
+                    with io.open(self.fileName, "rb") as fd:
+                        fd.seek(self.offsets[i])
+                        _readDataInto(fd, header, out)
+                self._ampArrays[i] = out
+            return self._ampArrays[i]
+
+
+class MappedRawCcd(LazyRawCcd):
+    """A raw CCD whose amplifiers' data units are memory-mapped from an uncompressed file.
+
+    Each amplifier's data unit is available at once as a zero-copy view of the file
+    (`getAmpData`); nothing is read until the view is used, and then only the pages of
+    the file that hold the pixels used.  Native int32 pixels are materialized, one
+    amplifier at a time, by `getAmpArray`.
+
+    Parameters
+    ----------
+    fileName : `str`
+        The raw file.
+    metadata : `FitsHeader`
+        The primary header.
+    ampHeaders : `list` of `FitsHeader`
+        The header of each amplifier's HDU, in HDU order.
+    offsets : `list` of `int`
+        The position in the file of each amplifier's data unit.
+    mapped : `mmap.mmap`
+        The file, mapped read-only; the views keep it mapped for as long as they are referenced.
+    """
+
+    def __init__(self, fileName, metadata, ampHeaders, offsets, mapped):
+        LazyRawCcd.__init__(self, fileName, metadata, ampHeaders, offsets)
+        self.ampData = [np.ndarray((header["NAXIS2"], header["NAXIS1"]),
+                                   dtype=_BITPIX_DTYPES[header["BITPIX"]], buffer=mapped, offset=offset)
+                        for header, offset in zip(ampHeaders, offsets)]
+
+    def getAmpData(self, i):
+        """Return the data unit of the ``i``-th amplifier as stored in the file, without copying it.
+
+        The view is read-only and has the file's big-endian dtype (so its values are
+        correct whatever the machine's byte order); BZERO and BSCALE are not applied, so
+        the physical values are ``BSCALE*data + BZERO`` from ``ampHeaders[i]``.
+        """
+        return self.ampData[i]
+
+    def getAmpArray(self, i):
+        """Return the physical int32 pixels of the ``i``-th amplifier, materializing them on first use."""
+        with self._locks[i]:
+            if self._ampArrays[i] is None:
+                data = self.ampData[i]
+                out = np.empty(data.shape, dtype=np.int32)
+                _scaleInto(data, self.ampHeaders[i], out)
+                instrument.addIo(nBytes=data.nbytes)
+                self._ampArrays[i] = out
+            return self._ampArrays[i]
+
+
+def _openRaw(fileName):
+    """Open a possibly gzipped FITS file for sequential binary reading."""
+    instrument.addIo(nFiles=1)
+    fd = io.open(fileName, "rb")
+    if fd.peek(2)[:2] == _GZIP_MAGIC:
+        fd.close()
+        return gzip.open(fileName, "rb")
+    return fd
+
+
+def _readExactly(fd, buf):
+    """Fill the writeable buffer ``buf`` from ``fd``, raising if the file is truncated."""
+    view = memoryview(buf)
+    nRead = 0
+    while nRead < len(view):
+        n = fd.readinto(view[nRead:])
+        if not n:
+            raise RuntimeError("Unexpected end of FITS file after %d of %d bytes" % (nRead, len(view)))
+        nRead += n
+    instrument.addIo(nBytes=nRead)
+
+
+def _skip(fd, nBytes):
+    """Advance ``fd`` by ``nBytes`` bytes."""
+    if nBytes > 0:
+        if fd.seekable():
+            fd.seek(nBytes, io.SEEK_CUR)
+        else:
+            _readExactly(fd, bytearray(nBytes))
+
+
+def _padding(nBytes):
+    """Return the number of bytes needed to pad ``nBytes`` to a whole FITS block."""
+    return -nBytes % BLOCK_SIZE
+
+
+def _parseValue(text):
+    """Parse the value and comment fields of a FITS card."""
+    text = text.strip()
+    if text.startswith("'"):
+        i = 1
+        value = []
+        while i < len(text):
+            c = text[i]
+            if c == "'":
+                if text[i + 1:i + 2] == "'":
+                    value.append("'")
+                    i += 2
+                    continue
+                break
+            value.append(c)
+            i += 1
+        comment = text[i + 1:].partition("/")[2].strip()
+        return "".join(value).rstrip(), comment
+
+    value, _, comment = text.partition("/")
+    value = value.strip()
+    comment = comment.strip()
+    if value == "":
+        return None, comment
+    if value == "T":
+        return True, comment
+    if value == "F":
+        return False, comment
+    if _INT_RE.match(value):
+        return int(value), comment
+    try:
+        return float(value.replace("D", "E")), comment
+    except ValueError:
+        return value, comment
+
+
+def _parseCard(card):
+    """Split an 80-character card into ``(key, value, comment)``."""
+    if card.startswith("HIERARCH ") and "=" in card:
+        key, _, rest = card[9:].partition("=")
+        value, comment = _parseValue(rest)
+        return key.strip(), value, comment
+
+    key = card[:8].strip()
+    if key in _COMMENTARY_KEYS:
+        return key, card[8:].rstrip(), ""
+    if card[8:10] != "= ":
+        return key, None, card[8:].strip()
+    value, comment = _parseValue(card[10:])
+    return key, value, comment
+
+
+def readHeader(fd):
+    """Read the next FITS header from a file.
+
+    Parameters
+    ----------
+    fd : file-like
+        Binary file positioned at the start of a header; left positioned at the start
+        of the following data unit.
+
+    Returns
+    -------
+    header : `FitsHeader` or `None`
+        The parsed header, or `None` if ``fd`` is at the end of the file.
+    """
+    cards = []
+    while True:
+        block = fd.read(BLOCK_SIZE)
+        instrument.addIo(nBytes=len(block))
+        if not block:
+            if cards:
+                raise RuntimeError("Unexpected end of FITS file while reading header")
+            return None
+        if len(block) != BLOCK_SIZE:
+            raise RuntimeError("Truncated FITS header block of %d bytes" % len(block))
+        block = block.decode("ascii", "replace")
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i + CARD_SIZE]
+            if card.startswith("END") and card[3:].strip() == "":
+                return FitsHeader(cards)
+            if card.strip():
+                cards.append(_parseCard(card))
+
+
+def readPrimaryHeader(fileName):
+    """Read the primary header of a FITS file without reading any data.
+
+    Only the header blocks are read, stopping at the END card; gzipped files are
+    decompressed only as far as that.  The primary header of a tile-compressed
+    (``.fz``) file is not itself compressed, so is read in the same way.
+
+    Parameters
+    ----------
+    fileName : `str`
+        Name of the FITS file.
+
+    Returns
+    -------
+    header : `FitsHeader`
+        The primary header.
+    """
+    with _openRaw(fileName) as fd:
+        header = readHeader(fd)
+    if header is None:
+        raise RuntimeError("%s is empty" % fileName)
+    return header
+
+
+def readAllHeaders(fileName):
+    """Read the headers of all the HDUs of a FITS file, skipping the data units.
+
+    Parameters
+    ----------
+    fileName : `str`
+        Name of the FITS file, which may be gzipped.
+
+    Returns
+    -------
+    headers : `list` of `FitsHeader`
+        The header of each HDU, starting with the primary HDU.
+    """
+    headers = []
+    with _openRaw(fileName) as fd:
+        while True:
+            header = readHeader(fd)
+            if header is None:
+                break
+            headers.append(header)
+            nBytes = header.getDataSize()
+            _skip(fd, nBytes + _padding(nBytes))
+    return headers
+
+
+def scanHeaders(fileName):
+    """Read all the headers of an uncompressed FITS file, seeking past the data units.
+
+    Parameters
+    ----------
+    fileName : `str`
+        Name of the FITS file; it may not be gzipped.
+
+    Returns
+    -------
+    hdus : `list` of `tuple`
+        ``(header, dataOffset)`` for each HDU, where ``dataOffset`` is the position in the
+        file of the start of the HDU's data unit.
+    """
+    hdus = []
+    instrument.addIo(nFiles=1)
+    with io.open(fileName, "rb") as fd:
+        if fd.peek(2)[:2] == _GZIP_MAGIC:
+            raise RuntimeError("%s is gzipped; its data units cannot be read in place" % fileName)
+        while True:
+            header = readHeader(fd)
+            if header is None:
+                break
+            hdus.append((header, fd.tell()))
+            nBytes = header.getDataSize()
+            _skip(fd, nBytes + _padding(nBytes))
+    return hdus
+
+
+def readImageRows(fd, header, dataOffset, y0, y1, dtype=np.float32):
+    """Read a band of rows of an image data unit.
+
+    Parameters
+    ----------
+    fd : file-like
+        Seekable binary file.
+    header : `FitsHeader`
+        The header of the image HDU.
+    dataOffset : `int`
+        Position of the HDU's data unit in the file, as returned by `scanHeaders`.
+    y0, y1 : `int`
+        The rows to read are ``y0 <= y < y1``.
+    dtype : `numpy.dtype`
+        Type of the returned pixels.
+
+    Returns
+    -------
+    rows : `numpy.ndarray`
+        The physical (BSCALE/BZERO-corrected) values of the rows, as ``(y1 - y0, NAXIS1)``.
+    """
+    width = header["NAXIS1"]
+    fileDtype = np.dtype(_BITPIX_DTYPES[header["BITPIX"]])
+    fd.seek(dataOffset + y0*width*fileDtype.itemsize)
+    buf = bytearray((y1 - y0)*width*fileDtype.itemsize)
+    _readExactly(fd, buf)
+
+    rows = np.frombuffer(buf, dtype=fileDtype).reshape(y1 - y0, width).astype(dtype)
+    bscale = header.get("BSCALE", 1)
+    bzero = header.get("BZERO", 0)
+    if bscale != 1:
+        rows *= bscale
+    if bzero != 0:
+        rows += bzero
+    return rows
+
+
+def _isDirectInt32(header):
+    """Can the data unit be converted to int32 without scaling (other than an int32 BZERO)?"""
+    bzero = header.get("BZERO", 0)
+    if header["BITPIX"] != 32 or header.get("BSCALE", 1) != 1:
+        return False
+    return bzero == int(bzero) and -2**31 <= bzero < 2**31
+
+
+def _scaleInto(data, header, out):
+    """Convert the data unit ``data`` (as stored in the file) to physical int32 values in ``out``."""
+    bzero = header.get("BZERO", 0)
+    if _isDirectInt32(header):
+        np.copyto(out, data)
+        if bzero != 0:
+            out += np.int32(bzero)
+    else:
+        # Widen first: e.g. BITPIX=16 with BZERO=32768 overflows the file's dtype
+        np.copyto(out, data.astype(np.float64)*header.get("BSCALE", 1) + bzero, casting="unsafe")
+
+
+def _readDataInto(fd, header, out):
+    """Read the data unit described by ``header`` from ``fd`` into the int32 array ``out``.
+
+    When the data are 32-bit integers with no scaling the bytes are read straight into
+    ``out`` and byte-swapped in place, so no temporary copy of the pixels is made.
+    """
+    shape = (header["NAXIS2"], header["NAXIS1"])
+    if out.shape != shape:
+        raise RuntimeError("Amplifier data of shape %s do not match expected %s" % (shape, out.shape))
+
+    nBytes = header.getDataSize()
+    if _isDirectInt32(header):
+        _readExactly(fd, out.view(np.uint8).reshape(-1))
+        if sys.byteorder == "little":
+            out.byteswap(True)
+        bzero = header.get("BZERO", 0)
+        if bzero != 0:
+            out += np.int32(bzero)
+    else:
+        buf = bytearray(nBytes)
+        _readExactly(fd, buf)
+        _scaleInto(np.frombuffer(buf, dtype=_BITPIX_DTYPES[header["BITPIX"]]).reshape(shape), header, out)
+    _skip(fd, _padding(nBytes))
+
+
+def _checkAmpHeader(fileName, header):
+    """Raise if an amplifier HDU cannot be read by this module."""
+    if header.get("ZIMAGE", False):
+        raise RuntimeError("%s contains tile-compressed HDUs, which this reader cannot read" % fileName)
+
+
+def findRawFile(fileName):
+    """Return the name of a raw, or of its compressed version if only that exists.
+
+    Parameters
+    ----------
+    fileName : `str`
+        The uncompressed name, e.g. as given by a template ending in ".fits".
+
+    Returns
+    -------
+    fileName : `str`
+        ``fileName`` if it exists, else the first of ``fileName`` with a suffix from
+        ``COMPRESSED_SUFFIXES`` that exists, else ``fileName``.
+    """
+    if os.path.exists(fileName):
+        return fileName
+    for suffix in COMPRESSED_SUFFIXES:
+        if os.path.exists(fileName + suffix):
+            return fileName + suffix
+    return fileName
+
+
+def findRawLocation(fileName):
+    """As `findRawFile`, for a name that may end in an ``[hdu]`` suffix.
+
+    Parameters
+    ----------
+    fileName : `str`
+        The uncompressed name, e.g. as given by a template ending in ".fits[3]".
+
+    Returns
+    -------
+    fileName : `str`
+        The name returned by `findRawFile` for ``fileName`` without its suffix,
+        followed by the suffix.  The HDUs of a compressed raw are numbered as in
+        the uncompressed raw, so the suffix is still valid.
+    """
+    mat = _HDU_SUFFIX_RE.search(fileName)
+    if mat is None:
+        return findRawFile(fileName)
+    return findRawFile(fileName[:mat.start()]) + mat.group(0)
+
+
+def _readCompressedBand(args):
+    """Read rows ``y0 <= y < y1`` of a tile-compressed image HDU; used by `_readTileCompressed`.
+
+    cfitsio only decompresses the tiles that overlap the requested rows.
+    """
+    fileName, hdu, width, y0, y1 = args
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, y0), afwGeom.Extent2I(width, y1 - y0))
+    return afwImage.ImageI(fileName, hdu=hdu, bbox=bbox).getArray()
+
+
+def _getCompressedSize(header):
+    """Return the size in bytes of the data unit (table and heap) of a tile-compressed HDU."""
+    return header["NAXIS1"]*header["NAXIS2"] + header.get("PCOUNT", 0)
+
+
+def _getDecompressPool(numProcesses):
+    """Return a process pool of the given size, creating it on first use.
+
+    A pool is kept for each size requested, so callers asking for different sizes
+    (e.g. mappers with different ``rawDecompressProcesses``) never terminate a pool
+    that another is still using.
+    """
+    with _decompressPoolLock:
+        pool = _decompressPools.get(numProcesses)
+        if pool is None:
+            pool = _decompressPools[numProcesses] = multiprocessing.Pool(numProcesses)
+        return pool
+
+
+def _readTileCompressed(fileName, nAmp, numProcesses):
+    """Read the tile-compressed amplifier HDUs of a raw, decompressing them in parallel.
+
+    Each amplifier is split into bands of whole tiles so that there are at least two
+    bands per process; the bands are decompressed by afw (i.e. cfitsio) in a pool of
+    ``numProcesses`` processes, or in this process if ``numProcesses == 1``.
+    """
+    ampHeaders = [header for header, offset in scanHeaders(fileName)[1:nAmp + 1]]
+    if len(ampHeaders) != nAmp:
+        raise RuntimeError("Expected %d amplifier HDUs in %s; found %d" % (nAmp, fileName, len(ampHeaders)))
+    for header in ampHeaders:
+        if not header.get("ZIMAGE", False) or header["ZBITPIX"] != 32 or header["ZNAXIS"] != 2:
+            raise RuntimeError("%s does not contain 32-bit tile-compressed images" % fileName)
+
+    height, width = ampHeaders[0]["ZNAXIS2"], ampHeaders[0]["ZNAXIS1"]
+    tileRows = ampHeaders[0].get("ZTILE2", 1)
+    nBand = max(1, -(-2*numProcesses//nAmp))
+    bandRows = tileRows*max(1, -(-height//(nBand*tileRows)))
+    bands = [(fileName, i + 1, width, y0, min(y0 + bandRows, height))
+             for i in range(nAmp) for y0 in range(0, height, bandRows)]
+
+    if numProcesses == 1:
+        results = map(_readCompressedBand, bands)
+    else:
+        results = _getDecompressPool(numProcesses).imap(_readCompressedBand, bands)
+
+    pixels = np.empty((nAmp, height, width), dtype=np.int32)
+    for (_, hdu, _, y0, y1), rows in zip(bands, results):
+        pixels[hdu - 1, y0:y1] = rows
+    #
+    # The headers were counted as they were scanned; count the compressed data once, however it was banded
+    #
+    instrument.addIo(nBytes=sum(_getCompressedSize(header) for header in ampHeaders), nFiles=len(bands))
+    return pixels, ampHeaders
+
+
+def readRawCcd(fileName, nAmp=N_AMP, numProcesses=1):
+    """Read the primary header and all amplifier HDUs of a raw CCD in one pass.
+
+    The file is opened once and read sequentially; the pixels of every amplifier are
+    read directly into a single preallocated ``(nAmp, height, width)`` buffer.  If the
+    amplifiers are tile-compressed (as written by fpack) they are instead decompressed
+    by afw, in bands of tiles spread over ``numProcesses`` processes.
+
+    Parameters
+    ----------
+    fileName : `str`
+        Name of the raw multi-extension FITS file (may be gzipped).
+    nAmp : `int`
+        Number of amplifier HDUs expected after the primary HDU.
+    numProcesses : `int`
+        Number of processes used to decompress tile-compressed amplifiers.
+
+    Returns
+    -------
+    rawCcd : `RawCcd`
+        The headers and pixels of the CCD.
+    """
+    with _openRaw(fileName) as fd:
+        phu = readHeader(fd)
+        if phu is None:
+            raise RuntimeError("%s is empty" % fileName)
+        nBytes = phu.getDataSize()
+        _skip(fd, nBytes + _padding(nBytes))
+
+        compressed = False              # are the amplifiers tile-compressed?
+        ampHeaders = []
+        pixels = None
+        while not compressed and len(ampHeaders) < nAmp:
+            header = readHeader(fd)
+            if header is None:
+                break
+            if header.get("ZIMAGE", False) and len(ampHeaders) == 0 and not isinstance(fd, gzip.GzipFile):
+                compressed = True
+                break
+            _checkAmpHeader(fileName, header)
+            if pixels is None:
+                pixels = np.empty((nAmp, header["NAXIS2"], header["NAXIS1"]), dtype=np.int32)
+            _readDataInto(fd, header, pixels[len(ampHeaders)])
+            ampHeaders.append(header)
+
+    if compressed:
+        pixels, ampHeaders = _readTileCompressed(fileName, nAmp, numProcesses)
+
+    if len(ampHeaders) != nAmp:
+        raise RuntimeError("Expected %d amplifier HDUs in %s; found %d" % (nAmp, fileName, len(ampHeaders)))
+
+    return RawCcd(phu, ampHeaders, pixels)
+
+
+def readLazyRawCcd(fileName, nAmp=N_AMP, useMmap=False):
+    """Read the headers of a raw CCD, deferring reading each amplifier's pixels until it is used.
+
+    Parameters
+    ----------
+    fileName : `str`
+        Name of the raw multi-extension FITS file.
+    nAmp : `int`
+        Number of amplifier HDUs expected after the primary HDU.
+    useMmap : `bool`
+        Memory-map the amplifiers' data units, returning a `MappedRawCcd`, if they
+        are uncompressed.
+
+    Returns
+    -------
+    rawCcd : `MappedRawCcd`, `LazyRawCcd` or `RawCcd`
+        The CCD.  Gzipped files can't be read out of order, so are read at once into a `RawCcd`.
+    """
+    with io.open(fileName, "rb") as fd:
+        gzipped = fd.peek(2)[:2] == _GZIP_MAGIC
+    if gzipped:
+        return readRawCcd(fileName, nAmp=nAmp)
+
+    hdus = scanHeaders(fileName)
+    if len(hdus) < nAmp + 1:
+        raise RuntimeError("Expected %d amplifier HDUs in %s; found %d" % (nAmp, fileName, len(hdus) - 1))
+    ampHdus = hdus[1:nAmp + 1]
+    ampHeaders = [header for header, offset in ampHdus]
+    offsets = [offset for header, offset in ampHdus]
+    if useMmap and not any(header.get("ZIMAGE", False) for header in ampHeaders):
+        with io.open(fileName, "rb") as fd:
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedRawCcd(fileName, hdus[0][0], ampHeaders, offsets, mapped)
+    return LazyRawCcd(fileName, hdus[0][0], ampHeaders, offsets)
+
+
+def _formatValue(value):
+    """Format a header value as it appears in a FITS card."""
+    if isinstance(value, bool):
+        return "%20s" % ("T" if value else "F")
+    if isinstance(value, (int, np.integer)):
+        return "%20d" % value
+    if isinstance(value, (float, np.floating)):
+        return "%20s" % repr(float(value)).upper()
+    return "%-20s" % ("'%-8s'" % str(value).replace("'", "''"))
+
+
+def formatHeader(cards):
+    """Format a header as padded FITS blocks.
+
+    Parameters
+    ----------
+    cards : `list` of `tuple`
+        ``(keyword, value)`` pairs; keywords longer than 8 characters are written as
+        HIERARCH cards.
+
+    Returns
+    -------
+    header : `bytes`
+        The header, including the END card, padded to a multiple of the FITS block size.
+    """
+    lines = []
+    for key, value in cards:
+        if len(key) > 8:
+            key = "HIERARCH %s" % key
+        lines.append(("%-8s= %s" % (key, _formatValue(value)))[:CARD_SIZE])
+    lines.append("END")
+    text = "".join("%-80s" % line for line in lines)
+    text += " "*(-len(text) % BLOCK_SIZE)
+    return text.encode("ascii")
@@ -0,0 +1,386 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Synthetic ComCam raw data, laid out as the camera team's test stands write it."""
+
+from __future__ import division, print_function
+
+import gzip
+import multiprocessing
+import os
+
+import numpy as np
+
+from lsst.obs.comCam.cache import ObjectCache
+from lsst.obs.comCam.comCam import loadCameraDescription
+from lsst.obs.comCam.rawReader import BLOCK_SIZE, formatHeader
+
+__all__ = ["AmpGeometry", "getAmpGeometry", "getCcdSerials", "makeAmpArrays", "makePrimaryCards",
+           "writeRawMef", "getRawPath", "generateRawTree"]
+
+MJD_2010 = 55197                        # MJD of 2010-01-01, relative to which visits are numbered
+COMPRESSIONS = (None, "gz", "fz")       # file compressions supported by generateRawTree
+#
+# The IMGTYPE, TESTTYPE and mean signal (DN) of each acquisition type
+#
+ACQUISITION_TYPES = {
+    "bias": ("BIAS", "BIAS", 0.0),
+    "dark": ("DARK", "DARK", 5.0),
+    "flat": ("FLAT", "FLAT", 20000.0),
+    "fe55": ("FE55", "FE55", 100.0),
+    "lambda": ("FLAT", "LAMBDA", 10000.0),
+    "sflat": ("FLAT", "SFLAT", 1000.0),
+}
+
+#
+# Amplifier HDUs used by _writeRawFile, indexed by CCD and layout.  Each is ~75 MB for a full CCD,
+# so only a couple are kept; generateRawTree writes each CCD's files together and clears it when done
+#
+_payloadCache = ObjectCache("syntheticPayloads", maxSize=2)
+
+
+class AmpGeometry(object):
+    """The raw layout of a ComCam amplifier, as ``(x0, y0, width, height)`` boxes.
+
+    Parameters
+    ----------
+    amp : `dict`
+        The amplifier's entry in camera.yaml.
+    """
+
+    def __init__(self, amp):
+        def box(name):
+            (x0, y0), (width, height) = amp[name]
+            return x0, y0, width, height
+
+        self.raw = box("rawBBox")
+        self.data = box("rawDataBBox")
+        self.serialOverscan = box("rawSerialOverscanBBox")
+        self.parallelOverscan = box("rawParallelOverscanBBox")
+
+    @property
+    def shape(self):
+        """The ``(height, width)`` of the amplifier's raw data."""
+        return self.raw[3], self.raw[2]
+
+
+def getAmpGeometry(cameraFile=None, ccd="S00"):
+    """Read the amplifier geometries of a CCD from camera.yaml.
+
+    Parameters
+    ----------
+    cameraFile : `str`, optional
+        The camera description; defaults to obs_comCam's policy/camera.yaml.
+    ccd : `str`
+        The CCD whose amplifiers are returned.
+
+    Returns
+    -------
+    geometries : `list` of `AmpGeometry`
+        The amplifiers' geometries, in HDU order.
+    """
+    amps = sorted(loadCameraDescription(cameraFile)["CCDs"][ccd]["amplifiers"].values(),
+                  key=lambda amp: amp["hdu"])
+    return [AmpGeometry(amp) for amp in amps]
+
+
+def getCcdSerials(cameraFile=None):
+    """Return the serial number of each CCD in camera.yaml, indexed by CCD name (e.g. "S00")."""
+    return dict((name, ccd["serial"]) for name, ccd in loadCameraDescription(cameraFile)["CCDs"].items())
+
+
+def makeAmpArrays(geometries, bias=1000.0, signal=0.0, readNoise=10.0, seed=None, shape=None):
+    """Make raw pixel values for the amplifiers of a CCD.
+
+    Every pixel has the bias level plus Gaussian read noise; the imaging region also
+    has Poisson-distributed ``signal``.
+
+    Parameters
+    ----------
+    geometries : `list` of `AmpGeometry`
+        The amplifiers' geometries.
+    bias : `float`
+        The bias level, DN.
+    signal : `float`
+        The mean signal in the imaging region, DN.
+    readNoise : `float`
+        The read noise, DN.
+    seed : `int`, optional
+        Seed for the random numbers.
+    shape : `tuple` of `int`, optional
+        If set, only the first ``(height, width)`` pixels of each amplifier are made.
+
+    Returns
+    -------
+    arrays : `list` of `numpy.ndarray`
+        The int32 pixels of each amplifier.
+    """
+    rng = np.random.RandomState(seed)
+    arrays = []
+    for geometry in geometries:
+        array = rng.normal(bias, readNoise, geometry.shape if shape is None else shape)
+        if signal > 0:
+            x0, y0, width, height = geometry.data
+            data = array[y0:y0 + height, x0:x0 + width]
+            data += rng.poisson(signal, data.shape)
+        arrays.append(np.rint(array).astype(np.int32))
+    return arrays
+
+
+def makePrimaryCards(run, mjd, expTime=15.0, imageType="FLAT", testType="FLAT", filterName="NONE",
+                     wavelength=500.0, lsstSerial="E2V-CCD250-220-Dev", raftName="LCA-11021_RTM-005-Dev"):
+    """Make the primary header of a raw, with the keywords read by ingest and the mapper.
+
+    Parameters
+    ----------
+    run : `str`
+        The run number (RUNNUM).
+    mjd : `float`
+        The MJD at the start of the exposure, from which the visit is derived.
+    expTime : `float`
+        The exposure time, seconds.
+    imageType, testType : `str`
+        The IMGTYPE and TESTTYPE.
+    filterName : `str`
+        The filter.
+    wavelength : `float`
+        The monochromator wavelength, nm.
+    lsstSerial : `str`
+        The CCD serial number (LSST_NUM).
+    raftName : `str`
+        The raft serial number (RAFTNAME).
+
+    Returns
+    -------
+    cards : `list` of `tuple`
+        ``(keyword, value)`` pairs.
+    """
+    days = mjd - 40587                  # MJD of the Unix epoch
+    dateObs = np.datetime64(int(round(days*86400e3)), "ms").astype(str)
+    return [("SIMPLE", True), ("BITPIX", 8), ("NAXIS", 0), ("EXTEND", True),
+            ("DATE-OBS", dateObs), ("MJD-OBS", mjd), ("EXPTIME", expTime), ("DARKTIME", expTime),
+            ("IMGTYPE", imageType), ("TESTTYPE", testType), ("FILTER", filterName), ("MONOWL", wavelength),
+            ("LSST_NUM", lsstSerial), ("RAFTNAME", raftName), ("RUNNUM", run), ("OBJECT", "UNKNOWN")]
+
+
+def _formatAmpHdus(ampArrays, bzero=0):
+    """Format the amplifiers of a raw as FITS HDUs."""
+    hdus = []
+    for i, array in enumerate(ampArrays):
+        height, width = array.shape
+        cards = [("XTENSION", "IMAGE"), ("BITPIX", 32), ("NAXIS", 2), ("NAXIS1", width),
+                 ("NAXIS2", height), ("PCOUNT", 0), ("GCOUNT", 1), ("EXTNAME", "Segment%02d" % i)]
+        if bzero:
+            cards += [("BZERO", bzero), ("BSCALE", 1)]
+        data = (array.astype(np.int64) - bzero).astype(">i4").tobytes()
+        hdus.append(formatHeader(cards) + data + b"\0"*(-len(data) % BLOCK_SIZE))
+    return b"".join(hdus)
+
+
+def _makeDirs(fileName):
+    """Create the directory that will hold a file, if it doesn't exist."""
+    dirName = os.path.dirname(fileName)
+    if dirName and not os.path.isdir(dirName):
+        try:
+            os.makedirs(dirName)
+        except OSError:
+            if not os.path.isdir(dirName):  # another writer may have created it
+                raise
+
+
+def writeRawMef(fileName, primaryCards, ampArrays, bzero=0):
+    """Write a raw multi-extension FITS file.
+
+    Parameters
+    ----------
+    fileName : `str`
+        The file to write; any missing directories are created.
+    primaryCards : `list` of `tuple`
+        ``(keyword, value)`` pairs of the (dataless) primary header.
+    ampArrays : `list` of `numpy.ndarray`
+        The pixels of each amplifier, written as 32-bit integers to HDUs 1..n.
+    bzero : `int`
+        Offset subtracted from the pixels as written, and recorded as BZERO.
+    """
+    _makeDirs(fileName)
+    with open(fileName, "wb") as fd:
+        fd.write(formatHeader(primaryCards))
+        fd.write(_formatAmpHdus(ampArrays, bzero=bzero))
+
+
+def getRawPath(root, raftId, run, acquisitionType, testVersion, jobId, ccd, basename):
+    """Return the path of a raw written by a test stand, as parsed by `ComCamParseTask.getInfo`.
+
+    Returns
+    -------
+    path : `str`
+        ``root/raftId/run/acquisitionType/testVersion/jobId/ccd/basename``
+    """
+    return os.path.join(root, raftId, run, acquisitionType, testVersion, str(jobId), ccd, basename)
+
+
+def _writeTileCompressedMef(fileName, primaryCards, ampArrays):
+    """Write a raw with Rice tile-compressed amplifiers (as written by fpack)."""
+    import lsst.afw.fits as afwFits
+    import lsst.afw.image as afwImage
+    import lsst.daf.base as dafBase
+
+    with open(fileName, "wb") as fd:
+        fd.write(formatHeader(primaryCards))
+    options = afwFits.ImageWriteOptions(afwFits.ImageCompressionOptions(afwFits.ImageCompressionOptions.RICE))
+    for i, array in enumerate(ampArrays):
+        md = dafBase.PropertyList()
+        md.set("EXTNAME", "Segment%02d" % i)
+        afwImage.ImageI(array).writeFits(fileName, options, "a", md)
+
+
+def _getAmpPayload(ccd, cameraFile, ampShape, signal, compression):
+    """Return the amplifiers written for a CCD with a given signal, made on first use.
+
+    The pixels are shared by all the files written for the CCD with that signal, so
+    that writing a file costs little more than its I/O.
+    """
+    key = (ccd, cameraFile, ampShape, signal, compression == "fz")
+    return _payloadCache.get(key, lambda: _makeAmpPayload(ccd, cameraFile, ampShape, signal, compression))
+
+
+def _makeAmpPayload(ccd, cameraFile, ampShape, signal, compression):
+    """Make the amplifiers returned by `_getAmpPayload`."""
+    geometries = getAmpGeometry(cameraFile, ccd=ccd)
+    seed = sum(map(ord, ccd)) + int(signal)
+    arrays = makeAmpArrays(geometries, signal=signal, seed=seed, shape=ampShape)
+    return arrays if compression == "fz" else _formatAmpHdus(arrays)
+
+
+def _writeRawFile(args):
+    """Write one raw of a tree; used by `generateRawTree`."""
+    fileName, ccd, primaryCards, signal, compression, cameraFile, ampShape = args
+    payload = _getAmpPayload(ccd, cameraFile, ampShape, signal, compression)
+    _makeDirs(fileName)
+    if compression == "fz":
+        _writeTileCompressedMef(fileName, primaryCards, payload)
+    else:
+        with (gzip.open(fileName, "wb", 1) if compression == "gz" else open(fileName, "wb")) as fd:
+            fd.write(formatHeader(primaryCards))
+            fd.write(payload)
+    return fileName
+
+
+def generateRawTree(root, nRun=1, nVisit=10, ccds=None, acquisitionTypes=("bias", "dark", "flat"),
+                    compression=None, numProcesses=1, firstRun=5000, startMjd=58119.0, cameraFile=None,
+                    ampShape=None, raftId="LCA-11021_RTM-005-Dev", testVersion="v0"):
+    """Write a tree of synthetic raws laid out as the test stands write them.
+
+    The files are written to
+    ``root/<raftId>/<run>/<acqType>/<testVersion>/<jobId>/<ccd>/<ccd>_<acqType>_<visit>.fits[.gz|.fz]``,
+    where ``root`` is typically the ``raw`` directory of the tree being simulated; this is
+    the layout parsed by `ComCamParseTask.getInfo`.  Each run has ``nVisit`` visits of each
+    acquisition type, each visit has a file for each CCD, and every visit has a distinct
+    MJD-OBS (and so visit number).
+
+    Parameters
+    ----------
+    root : `str`
+        Top of the tree.
+    nRun : `int`
+        Number of runs, numbered from ``firstRun``.
+    nVisit : `int`
+        Number of visits of each acquisition type in each run.
+    ccds : iterable of `str`, optional
+        The CCDs read in each visit; defaults to all the CCDs in camera.yaml.
+    acquisitionTypes : iterable of `str`
+        The acquisition types taken in each run; keys of ``ACQUISITION_TYPES``.
+    compression : `str`, optional
+        `None` for plain FITS, "gz" for gzipped FITS, or "fz" for Rice tile-compressed
+        amplifiers (which requires afw).
+    numProcesses : `int`
+        Number of processes writing files.
+    firstRun : `int`
+        Number of the first run.
+    startMjd : `float`
+        MJD of the first visit; visits are 30 s apart.
+    cameraFile : `str`, optional
+        The camera description giving the amplifier layout; defaults to obs_comCam's.
+    ampShape : `tuple` of `int`, optional
+        If set, the ``(height, width)`` to which the amplifiers are cut, making small files for
+        ingest tests (which only read the primary header); the full camera.yaml layout otherwise.
+    raftId : `str`
+        The raft serial number, used in the path and the RAFTNAME keyword.
+    testVersion : `str`
+        The test version component of the path.
+
+    Returns
+    -------
+    fileNames : `list` of `str`
+        The files written.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression %s; expected one of %s" % (compression, COMPRESSIONS))
+    for acquisitionType in acquisitionTypes:
+        if acquisitionType not in ACQUISITION_TYPES:
+            raise ValueError("Unknown acquisition type %s; expected one of %s" %
+                             (acquisitionType, sorted(ACQUISITION_TYPES)))
+    serials = getCcdSerials(cameraFile)
+    if ccds is None:
+        ccds = sorted(serials)
+    if ampShape is not None:
+        ampShape = tuple(ampShape)
+    suffix = {None: ".fits", "gz": ".fits.gz", "fz": ".fits.fz"}[compression]
+
+    specs = []
+    visitIndex = 0
+    jobId = 1000
+    for run in range(firstRun, firstRun + nRun):
+        for acquisitionType in acquisitionTypes:
+            imageType, testType, signal = ACQUISITION_TYPES[acquisitionType]
+            jobId += 1
+            for i in range(nVisit):
+                mjd = startMjd + 30*visitIndex/86400.0
+                visitIndex += 1
+                for ccd in ccds:
+                    cards = makePrimaryCards(str(run), mjd, imageType=imageType, testType=testType,
+                                             lsstSerial=serials[ccd], raftName=raftId,
+                                             expTime=0.0 if acquisitionType == "bias" else 15.0)
+                    basename = "%s_%s_%06d%s" % (ccd, acquisitionType, visitIndex, suffix)
+                    fileName = getRawPath(root, raftId, str(run), acquisitionType, testVersion, jobId, ccd,
+                                          basename)
+                    specs.append((fileName, ccd, cards, signal, compression, cameraFile, ampShape))
+
+    #
+    # Write the files of each CCD and signal together, so that few payloads need be kept
+    #
+    ordered = sorted(specs, key=lambda spec: (spec[1], spec[3]))
+    try:
+        if numProcesses == 1:
+            for spec in ordered:
+                _writeRawFile(spec)
+        else:
+            pool = multiprocessing.Pool(numProcesses)
+            try:
+                for fileName in pool.imap(_writeRawFile, ordered, max(1, len(ordered)//(4*numProcesses))):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _payloadCache.clear()
+
+    return [spec[0] for spec in specs]
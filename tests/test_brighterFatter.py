@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.brighterFatter import (CovarianceAccumulator, computeCovariances, foldCovariances,
+                                            makeKernel, measureFlatPair, solveKernel, tileQuadrant)
+from lsst.obs.comCam.overscan import OverscanGeometry
+from lsst.obs.comCam.synthetic import makePrimaryCards, writeRawMef
+
+
+def directCovariance(image, weights, dx, dy):
+    """Compute the covariance at lag (dx, dy) by shifting the image, for dy >= 0."""
+    mean = (image*weights).sum()/weights.sum()
+    residual = (image - mean)*weights
+    height, width = image.shape
+    x0, x1 = max(0, -dx), min(width, width - dx)
+    a = residual[:height - dy, x0:x1]
+    b = residual[dy:, x0 + dx:x1 + dx]
+    nPair = (weights[:height - dy, x0:x1]*weights[dy:, x0 + dx:x1 + dx]).sum()
+    return (a*b).sum()/nPair
+
+
+def laplacian(kernel):
+    """Return the five-point Laplacian of a kernel that vanishes outside the array."""
+    padded = np.pad(kernel, 1, mode="constant")
+    return padded[1:-1, :-2] + padded[1:-1, 2:] + padded[:-2, 1:-1] + padded[2:, 1:-1] - 4.0*kernel
+
+
+class BrighterFatterTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testDirect(self):
+        """The batched FFT agrees with shifting each image, with and without masked pixels."""
+        maxLag = 3
+        images = self.rng.normal(100.0, 5.0, (3, 20, 17))
+        images[:, 1:, :] += 0.3*images[:, :-1, :]      # correlated along y
+        weights = (self.rng.uniform(size=images.shape) > 0.1).astype(np.float64)
+
+        for w in (None, weights):
+            cov = computeCovariances(images, maxLag, w)
+            self.assertEqual(cov.shape, (3, maxLag + 1, 2*maxLag + 1))
+            for amp in range(3):
+                ampWeights = np.ones(images.shape[1:]) if w is None else w[amp]
+                for dy in range(maxLag + 1):
+                    for dx in range(-maxLag, maxLag + 1):
+                        self.assertAlmostEqual(cov[amp, dy, maxLag + dx],
+                                               directCovariance(images[amp], ampWeights, dx, dy))
+
+    def testWhiteNoise(self):
+        maxLag = 2
+        images = self.rng.normal(0.0, 3.0, (2, 200, 200))
+        folded = foldCovariances(computeCovariances(images, maxLag))
+        self.assertEqual(folded.shape, (2, maxLag + 1, maxLag + 1))
+        np.testing.assert_allclose(folded[:, 0, 0], 9.0, rtol=0.03)
+        folded[:, 0, 0] = 0
+        self.assertLess(np.abs(folded).max(), 0.3)
+
+    def testFlatPair(self):
+        geometry = OverscanGeometry(data=(slice(0, 60), slice(2, 62)),
+                                    serial=(slice(0, 60), slice(62, 70)),
+                                    parallel=(slice(60, 64), slice(2, 62)))
+        nAmp, signal = 4, 10000.0
+        fileNames = []
+        for i in range(2):
+            arrays = [self.rng.normal(1000.0, 5.0, (64, 70)) for amp in range(nAmp)]
+            for amp, array in enumerate(arrays):
+                array[:60, 2:62] += self.rng.poisson((1 + 0.01*i)*signal*(1 + 0.1*amp), (60, 60))
+            fileName = os.path.join(self.dir, "flat%d.fits" % i)
+            writeRawMef(fileName, makePrimaryCards("1234", 58000.0), [np.rint(a) for a in arrays])
+            fileNames.append(fileName)
+
+        maxLag = 2
+        groups = [(geometry, list(range(nAmp)))]
+        mean, cov = measureFlatPair((fileNames[0], fileNames[1], groups, maxLag, 5.0))
+        expected = signal*(1 + 0.1*np.arange(nAmp))*1.005
+        np.testing.assert_allclose(mean, expected, rtol=0.01)
+        np.testing.assert_allclose(cov[:, 0, maxLag], expected, rtol=0.1)     # Poisson: variance = mean
+
+        accumulator = CovarianceAccumulator(["C%02d" % amp for amp in range(nAmp)], maxLag)
+        accumulator.add(mean, cov)
+        accumulator.add(mean, cov)
+        self.assertEqual(accumulator.nPair, 2)
+        xcorr = accumulator.getNormalizedCovariances()
+        self.assertEqual(sorted(xcorr), ["C00", "C01", "C02", "C03"])
+        self.assertAlmostEqual(xcorr["C01"][0, 0], cov[1, 0, maxLag]/mean[1])
+        means, variances = accumulator.getPhotonTransfer()["C02"]
+        np.testing.assert_array_equal(means, [mean[2], mean[2]])
+
+    def testTileQuadrant(self):
+        quadrant = np.arange(9.0).reshape(3, 3)
+        full = tileQuadrant(quadrant)
+        self.assertEqual(full.shape, (5, 5))
+        np.testing.assert_array_equal(full[2:, 2:], quadrant)
+        np.testing.assert_array_equal(full, full[::-1, :])
+        np.testing.assert_array_equal(full, full[:, ::-1])
+
+    def makeKernel(self, maxLag):
+        """Return a symmetric kernel that falls to ~0 at the edge of the array."""
+        y, x = np.mgrid[-maxLag:maxLag + 1, -maxLag:maxLag + 1]
+        return 1e-6*np.exp(-0.5*(x**2 + y**2))
+
+    def testSolveKernel(self):
+        kernel = self.makeKernel(5)
+        solved, converged = solveKernel(laplacian(kernel))
+        self.assertTrue(converged)
+        np.testing.assert_allclose(solved, kernel, atol=1e-12*np.abs(kernel).max())
+
+        solved, converged = solveKernel(laplacian(kernel), maxIter=2)
+        self.assertFalse(converged)
+
+    def testMakeKernel(self):
+        """The kernel and gains are recovered from the covariances that they predict"""
+        maxLag, nAmp = 4, 3
+        kernel = self.makeKernel(maxLag)
+        source = laplacian(kernel)[maxLag:, maxLag:]     # the quadrant 0 <= dx, dy <= maxLag
+        ampNames = ["C%02d" % amp for amp in range(nAmp)]
+        gains = np.array([1.0, 1.5, 2.0])
+        accumulator = CovarianceAccumulator(ampNames, maxLag)
+        for signal in (5000.0, 10000.0, 20000.0):
+            mean = signal*np.ones(nAmp)
+            # folded = mean*delta/gain - source*mean**2, unfolded into -maxLag <= dx <= maxLag
+            folded = -source*(mean**2)[:, np.newaxis, np.newaxis]
+            folded[:, 0, 0] += mean/gains
+            cov = np.concatenate([folded[:, :, :0:-1], folded], axis=2)
+            accumulator.add(mean, cov)
+
+        solved, converged, nSource = makeKernel(accumulator, dict(zip(ampNames, gains)))
+        self.assertTrue(converged)
+        self.assertEqual(nSource, 3*nAmp)
+        np.testing.assert_allclose(solved, kernel, atol=1e-9*np.abs(kernel).max())
+
+        # Sources that don't conserve charge are rejected
+        with self.assertRaises(RuntimeError):
+            makeKernel(accumulator, dict(zip(ampNames, 2*gains)))
+
+        # Without correlations, the photon transfer curve gives the gains
+        poisson = CovarianceAccumulator(ampNames, maxLag)
+        for signal in (5000.0, 10000.0):
+            mean = signal*np.ones(nAmp)
+            cov = np.zeros((nAmp, maxLag + 1, 2*maxLag + 1))
+            cov[:, 0, maxLag] = mean/gains
+            poisson.add(mean, cov)
+        measured = poisson.getGains()
+        np.testing.assert_allclose([measured[name] for name in ampNames], gains)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import lsst.utils.tests
+from lsst.obs.comCam.cache import ObjectCache, fileSignature, getCacheStats
+
+
+class ObjectCacheTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testHitsAndMisses(self):
+        cache = ObjectCache("testHitsAndMisses")
+        built = []
+
+        def factory():
+            built.append(1)
+            return len(built)
+
+        self.assertEqual(cache.get("a", factory), 1)
+        self.assertEqual(cache.get("a", factory), 1)
+        self.assertEqual(cache.get("b", factory), 2)
+        self.assertEqual(cache.getStats(), dict(hits=1, misses=2, evictions=0, size=2))
+        self.assertEqual(getCacheStats()["testHitsAndMisses"], cache.getStats())
+
+        cache.clear()
+        self.assertEqual(cache.get("a", factory), 3)
+
+    def testLru(self):
+        cache = ObjectCache("testLru", maxSize=2)
+        cache.get("a", lambda: "a")
+        cache.get("b", lambda: "b")
+        cache.get("a", lambda: "A")     # a is now the most recently used
+        cache.get("c", lambda: "c")     # evicts b
+        self.assertEqual(cache.get("a", lambda: "A"), "a")
+        self.assertEqual(cache.get("b", lambda: "B"), "B")
+        self.assertEqual(cache.getStats()["evictions"], 2)
+
+        cache.invalidate("b")
+        self.assertEqual(cache.get("b", lambda: "b2"), "b2")
+        cache.setMaxSize(1)
+        self.assertEqual(cache.getStats()["size"], 1)
+
+    def testSignature(self):
+        cache = ObjectCache("testSignature")
+        fileName = os.path.join(self.dir, "camera.yaml")
+        with open(fileName, "w") as fd:
+            fd.write("a")
+        first = cache.get(fileName, object, signature=fileSignature(fileName))
+        self.assertIs(cache.get(fileName, object, signature=fileSignature(fileName)), first)
+
+        with open(fileName, "w") as fd:
+            fd.write("ab")
+        self.assertIsNot(cache.get(fileName, object, signature=fileSignature(fileName)), first)
+        self.assertEqual(cache.getStats()["size"], 1)
+
+    def testConcurrentBuilds(self):
+        """Different keys are built concurrently, and a key being built is built only once."""
+        cache = ObjectCache("testConcurrentBuilds")
+        built = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def factory(key):
+            if key == "a":
+                started.set()
+                self.assertTrue(release.wait(10))  # held until "b" has been built
+            built.append(key)
+            return key
+
+        results = []
+
+        def get(key):
+            results.append(cache.get(key, lambda: factory(key)))
+
+        threads = [threading.Thread(target=get, args=(key,)) for key in ("a", "b", "a")]
+        threads[0].start()
+        self.assertTrue(started.wait(10))
+        threads[1].start()
+        threads[1].join(10)
+        self.assertEqual(built, ["b"])  # while "a" was still being built
+        threads[2].start()
+        release.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(sorted(results), ["a", "a", "b"])
+        self.assertEqual(sorted(built), ["a", "b"])
+        self.assertEqual(cache.getStats(), dict(hits=1, misses=2, evictions=0, size=2))
+
+    def testFactoryError(self):
+        cache = ObjectCache("testFactoryError")
+
+        def fail():
+            raise RuntimeError("no such file")
+
+        with self.assertRaises(RuntimeError):
+            cache.get("a", fail)
+        self.assertEqual(cache.get("a", lambda: 1), 1)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
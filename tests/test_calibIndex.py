@@ -0,0 +1,99 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.obs.comCam.calibIndex import CalibIntervalIndex, registrySignature
+
+
+class CalibIntervalIndexTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        for table in ("bias", "flat"):
+            self.conn.execute("CREATE TABLE %s (ccd TEXT, filter TEXT, calibDate TEXT, "
+                              "validStart TEXT, validEnd TEXT)" % table)
+        self.conn.executemany("INSERT INTO bias VALUES (?, ?, ?, ?, ?)",
+                              [("S00", "NONE", "2018-01-10", "2018-01-05", "2018-01-14"),
+                               ("S00", "NONE", "2018-01-20", "2018-01-15", "2018-01-25"),
+                               ("S01", "NONE", "2018-01-10", "2018-01-05", "2018-01-14")])
+        self.conn.executemany("INSERT INTO flat VALUES (?, ?, ?, ?, ?)",
+                              [("S00", "g", "2018-01-10", "2018-01-05", "2018-01-14"),
+                               ("S00", "r", "2018-01-12", "2018-01-10", "2018-01-20")])
+        self.index = CalibIntervalIndex.fromRegistry(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def testLookup(self):
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.lookup("bias", "S00", "2018-01-05"), "2018-01-10")
+        self.assertEqual(self.index.lookup("bias", "S00", "2018-01-14T23:59:59"), "2018-01-10")
+        self.assertEqual(self.index.lookup("bias", "S00", "2018-01-15T00:00:00"), "2018-01-20")
+        self.assertEqual(self.index.lookup("bias", "S01", "2018-01-12"), "2018-01-10")
+
+    def testOutOfRange(self):
+        self.assertIsNone(self.index.lookup("bias", "S00", "2018-01-04"))
+        self.assertIsNone(self.index.lookup("bias", "S00", "2018-01-26"))
+        self.assertIsNone(self.index.lookup("bias", "S02", "2018-01-10"))
+        self.assertIsNone(self.index.lookup("dark", "S00", "2018-01-10"))  # no such table
+
+    def testFilter(self):
+        self.assertEqual(self.index.lookup("flat", "S00", "2018-01-12", "g"), "2018-01-10")
+        self.assertEqual(self.index.lookup("flat", "S00", "2018-01-12", "r"), "2018-01-12")
+        self.assertEqual(self.index.lookup("flat", "S00", "2018-01-18", "r"), "2018-01-12")
+        self.assertIsNone(self.index.lookup("flat", "S00", "2018-01-18", "g"))
+        self.assertIsNone(self.index.lookup("flat", "S00", "2018-01-12", "i"))
+
+    def testAnyFilter(self):
+        """Without a filter, the calib valid for any filter is accepted; the latest if several are"""
+        self.assertEqual(self.index.lookup("flat", "S00", "2018-01-06"), "2018-01-10")
+        self.assertEqual(self.index.lookup("flat", "S00", "2018-01-12"), "2018-01-12")
+        self.assertEqual(self.index.lookup("flat", "S00", "2018-01-18"), "2018-01-12")
+        self.assertIsNone(self.index.lookup("flat", "S00", "2018-01-21"))
+
+
+class RegistrySignatureTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSignature(self):
+        conn = sqlite3.connect(":memory:")
+        self.assertIsNone(registrySignature(conn))
+        conn.close()
+
+        fileName = os.path.join(self.dir, "calibRegistry.sqlite3")
+        conn = sqlite3.connect(fileName)
+        conn.execute("CREATE TABLE bias (ccd TEXT, filter TEXT, calibDate TEXT, "
+                     "validStart TEXT, validEnd TEXT)")
+        conn.commit()
+        signature = registrySignature(conn)
+        self.assertEqual(signature[0][0], os.path.realpath(fileName))
+        self.assertEqual(registrySignature(conn), signature)
+
+        other = sqlite3.connect(fileName)  # e.g. ingestCalibs, writing new calibs
+        other.executemany("INSERT INTO bias VALUES (?, ?, ?, ?, ?)",
+                          [("S00", "NONE", "2018-01-%02d" % day, "2018-01-%02d" % day, "2018-01-%02d" % day)
+                           for day in range(1, 29)])
+        other.commit()
+        other.close()
+        self.assertNotEqual(registrySignature(conn), signature)
+        self.assertEqual(len(CalibIntervalIndex.fromRegistry(conn)), 28)
+        conn.close()
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
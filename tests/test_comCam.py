@@ -0,0 +1,87 @@
+import glob
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+import lsst.utils.tests
+from lsst.obs.comCam.comCam import (_cameraCache, _descriptionCache, getCameraCacheDir, loadCameraDescription,
+                                    makeCamera)
+
+cameraFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "policy", "camera.yaml")
+
+
+class CompiledCameraTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.oldCacheDir = os.environ.get("OBS_COMCAM_CACHE_DIR")
+        os.environ["OBS_COMCAM_CACHE_DIR"] = self.dir
+        _cameraCache.clear()
+        _descriptionCache.clear()
+
+    def tearDown(self):
+        if self.oldCacheDir is None:
+            os.environ.pop("OBS_COMCAM_CACHE_DIR", None)
+        else:
+            os.environ["OBS_COMCAM_CACHE_DIR"] = self.oldCacheDir
+        _cameraCache.clear()
+        _descriptionCache.clear()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testRoundTrip(self):
+        camera = makeCamera(cameraFile)
+        compiled = glob.glob(os.path.join(self.dir, "camera-*.pickle"))
+        self.assertEqual(len(compiled), 1)
+        with open(compiled[0], "rb") as fd:
+            description = pickle.load(fd)
+        with open(cameraFile) as fd:
+            self.assertEqual(repr(description), repr(yaml.safe_load(fd)))  # repr, as NaN != NaN
+        #
+        # The camera built from the compiled description is the one built from the YAML
+        #
+        del os.environ["OBS_COMCAM_CACHE_DIR"]
+        _cameraCache.clear()
+        uncompiled = makeCamera(cameraFile)
+        self.assertEqual([(det.getName(), det.getSerial()) for det in camera],
+                         [(det.getName(), det.getSerial()) for det in uncompiled])
+        os.environ["OBS_COMCAM_CACHE_DIR"] = self.dir
+        #
+        # A new process (here, empty in-process caches) loads the compiled description, not the YAML
+        #
+        description["name"] = "compiled"
+        with open(compiled[0], "wb") as fd:
+            pickle.dump(description, fd)
+        _descriptionCache.clear()
+        self.assertEqual(loadCameraDescription(cameraFile)["name"], "compiled")
+
+    def testDisabled(self):
+        """Without $OBS_COMCAM_CACHE_DIR nothing is written"""
+        del os.environ["OBS_COMCAM_CACHE_DIR"]
+        self.assertIsNone(getCameraCacheDir())
+        makeCamera(cameraFile)
+        loadCameraDescription(cameraFile)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+class CameraDescriptionTestCase(lsst.utils.tests.TestCase):
+    def testDescription(self):
+        description = loadCameraDescription(cameraFile)
+        self.assertEqual(sorted(description["CCDs"]), ["S%d%d" % (i, j) for i in range(3) for j in range(3)])
+        self.assertEqual(len(description["CCDs"]["S11"]["amplifiers"]), 16)
+        self.assertIs(loadCameraDescription(cameraFile), description)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
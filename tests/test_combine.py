@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.combine import combineFiles, combineMaskedFiles, combineStack, getBandRows
+
+
+def writeImage(fileName, *arrays, **kwargs):
+    """Write float32 (or int32) images to the extensions of a minimal FITS file.
+
+    The cards in the ``extraCards`` keyword argument are added to every extension's header.
+    """
+    def header(cards):
+        text = "".join("%-80s" % ("%-8s= %20s" % card if len(card[0]) <= 8 else "HIERARCH %s = %s" % card)
+                       for card in cards) + "%-80s" % "END"
+        return (text + " "*(-len(text) % 2880)).encode("ascii")
+
+    with open(fileName, "wb") as fd:
+        fd.write(header([("SIMPLE", "T"), ("BITPIX", 8), ("NAXIS", 0), ("EXTEND", "T")]))
+        for array in arrays:
+            bitpix = 32 if array.dtype.kind == "i" else -32
+            fd.write(header([("XTENSION", "'IMAGE   '"), ("BITPIX", bitpix), ("NAXIS", 2),
+                             ("NAXIS1", array.shape[1]), ("NAXIS2", array.shape[0]),
+                             ("PCOUNT", 0), ("GCOUNT", 1)] + kwargs.get("extraCards", [])))
+            data = array.astype(">i4" if bitpix == 32 else ">f4").tobytes()
+            fd.write(data + b"\0"*(-len(data) % 2880))
+
+
+class CombineTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(12345)
+        self.images = rng.normal(100.0, 5.0, size=(7, 23, 17)).astype(np.float32)
+        self.images[3, 5, 6] = 1e6        # a cosmic ray
+        self.fileNames = []
+        for i, image in enumerate(self.images):
+            fileName = os.path.join(self.dir, "image%d.fits" % i)
+            writeImage(fileName, image)
+            self.fileNames.append(fileName)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testBandRows(self):
+        self.assertEqual(getBandRows(10, 100, 0), 1)
+        self.assertEqual(getBandRows(10, 100, 10*100*12*5), 5)
+
+    def testMethods(self):
+        memoryBudget = 2*len(self.images)*self.images.shape[2]*12    # two rows per band
+        for method, expected in (("mean", self.images.mean(axis=0)),
+                                 ("median", np.median(self.images, axis=0))):
+            combined = combineFiles(self.fileNames, method=method, memoryBudget=memoryBudget)
+            self.assertFloatsAlmostEqual(combined, expected, rtol=1e-6)
+
+    def testClippedMean(self):
+        combined = combineFiles(self.fileNames, method="clippedMean")
+        self.assertLess(abs(combined[5, 6] - 100.0), 10.0)    # the cosmic ray was rejected
+        self.assertLess(abs(combined.mean() - 100.0), 1.0)
+
+    def testConstantPixels(self):
+        """A pixel whose quartiles coincide keeps values close to its median"""
+        stack = self.images.copy()
+        stack[:, 2, 3] = 100.0
+        stack[0, 2, 3] = 101.0
+        stack[:, 4, 3] = 100.0
+        stack[0, 4, 3] = 1e6            # but still rejects a cosmic ray
+        combined = combineStack(stack.copy(), method="clippedMean")
+        self.assertAlmostEqual(combined[2, 3], 100.0 + 1.0/len(stack), places=4)
+        self.assertAlmostEqual(combined[4, 3], 100.0, places=4)
+        combined = combineStack(stack.copy(), method="clippedMean", minSigma=0.0)
+        self.assertAlmostEqual(combined[2, 3], 100.0, places=4)
+
+    def testScales(self):
+        scales = [2.0]*len(self.images)
+        combined = combineFiles(self.fileNames, method="median", scales=scales)
+        self.assertFloatsAlmostEqual(combined, np.median(self.images, axis=0)/2.0, rtol=1e-6)
+
+    def testMasked(self):
+        """Masked pixels are ignored, and the variance is that of the statistic"""
+        masks = np.zeros(self.images.shape, dtype=np.int32)
+        masks[3, 5, 6] = 1 << 1           # the cosmic ray is flagged CR
+        masks[:, 7, 8] = 1 << 0           # a pixel saturated in every input
+        masks[2, 9, 10] = 1 << 2          # a plane that isn't rejected
+        variance = np.full(self.images.shape[1:], 4.0, dtype=np.float32)
+        fileNames = []
+        for i, (image, mask) in enumerate(zip(self.images, masks)):
+            fileName = os.path.join(self.dir, "masked%d.fits" % i)
+            writeImage(fileName, image, mask, variance,
+                       extraCards=[("MP_SAT", 0), ("MP_CR", 1), ("MP_DETECTED", 2)])
+            fileNames.append(fileName)
+        nImage = len(fileNames)
+        memoryBudget = 2*nImage*self.images.shape[2]*20    # two rows per band
+
+        for method in ("mean", "median", "clippedMean"):
+            combined, var, nGood = combineMaskedFiles(fileNames, method=method, memoryBudget=memoryBudget,
+                                                      maskPlanes=["SAT", "CR", "BAD"])
+            self.assertEqual(nGood[7, 8], 0)
+            self.assertTrue(np.isnan(combined[7, 8]))
+            self.assertLess(abs(combined[5, 6] - 100.0), 10.0)
+            factor = np.pi/2 if method == "median" else 1.0
+            self.assertFloatsAlmostEqual(var[nGood > 0], factor*4.0/nGood[nGood > 0], rtol=1e-6)
+            if method != "clippedMean":   # which may also clip good pixels
+                self.assertEqual(nGood[5, 6], nImage - 1)
+                self.assertEqual(nGood[9, 10], nImage)
+                self.assertEqual(nGood[0, 0], nImage)
+
+        expected = np.delete(self.images[:, 5, 6], 3).mean()
+        combined, var, nGood = combineMaskedFiles(fileNames, method="mean", maskPlanes=["SAT", "CR"])
+        self.assertAlmostEqual(combined[5, 6], expected, places=3)
+        self.assertFloatsAlmostEqual(combined[:5], self.images[:, :5].mean(axis=0), rtol=1e-6)
+
+        combined, var, nGood = combineMaskedFiles(fileNames, method="mean", scales=[2.0]*nImage)
+        self.assertEqual(nGood.min(), nImage)  # no planes rejected
+        self.assertAlmostEqual(var[0, 0], 1.0/nImage, places=5)
+
+    def testStack(self):
+        with self.assertRaises(ValueError):
+            combineStack(self.images.copy(), method="mode")
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.crosstalk import applyCrosstalk, applyCrosstalkPairwise, getReadoutFlips, loadCrosstalk
+
+policyDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "policy")
+cameraFile = os.path.join(policyDir, "camera.yaml")
+
+
+class CrosstalkTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.nAmp = 4
+        self.coeffs = rng.uniform(-1e-3, 1e-3, size=(self.nAmp, self.nAmp)).astype(np.float32)
+        self.stack = rng.normal(1000.0, 100.0, size=(self.nAmp, 6, 5)).astype(np.float32)
+
+    def checkPairwise(self, flips):
+        expected = applyCrosstalkPairwise(list(self.stack.copy()), self.coeffs, flips)
+        for stack in (self.stack.copy(), list(self.stack.copy())):
+            applyCrosstalk(stack, self.coeffs, flips)
+            for array, expectedArray in zip(stack, expected):
+                self.assertFloatsAlmostEqual(array, expectedArray, rtol=1e-6)
+
+    def testPairwise(self):
+        self.checkPairwise(None)
+        self.checkPairwise([(False, False), (True, False), (False, True), (True, True)])
+
+    def testBrightSource(self):
+        stack = np.zeros_like(self.stack)
+        stack[2, 1, 3] = 60000.0
+        applyCrosstalk(stack, self.coeffs)
+        expected = -60000.0*self.coeffs[:, 2]
+        expected[2] = 60000.0           # the source itself is unchanged
+        self.assertFloatsAlmostEqual(stack[:, 1, 3], expected, rtol=1e-6)
+        self.assertEqual(np.count_nonzero(stack), self.nAmp)  # only the pixels under the star
+        self.assertFloatsAlmostEqual(applyCrosstalk(self.stack.copy(), np.diag(self.coeffs.diagonal())),
+                                     self.stack)  # the diagonal is ignored
+
+    def testPolicy(self):
+        self.assertEqual(getReadoutFlips("S11", cameraFile), [(False, False)]*16)
+        fileName = os.path.join(policyDir, "crosstalk.yaml")
+        models = loadCrosstalk(fileName, cameraFile)
+        self.assertEqual(len(models), 9)
+        for model in models.values():
+            self.assertEqual(model.coeffs.shape, (16, 16))
+            self.assertEqual(len(model.flips), 16)
+        self.assertIs(loadCrosstalk(fileName, cameraFile), models)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.defects import DefectIndex, DefectSet, decodeRuns, encodeRuns, maskDefects
+
+
+class DefectsTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shape = (40, 30)
+        rng = np.random.RandomState(1)
+        self.hot = rng.uniform(size=self.shape) < 0.02
+        self.hot[5, 28:] = True                         # a run that wraps onto the next row
+        self.hot[6, :3] = True
+        self.boxes = [(3, 10, 2, 25), (-2, 38, 5, 5)]   # a bad column pair, and a box off the corner
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def makeExpectedMask(self):
+        mask = self.hot.copy()
+        mask[10:35, 3:5] = True
+        mask[38:, :3] = True
+        return mask
+
+    def testRuns(self):
+        starts, lengths = encodeRuns(self.hot)
+        self.assertEqual(lengths.sum(), self.hot.sum())
+        np.testing.assert_array_equal(decodeRuns(starts, lengths, self.shape), self.hot)
+        self.assertFalse(decodeRuns([], [], self.shape).any())
+
+    def testMask(self):
+        defects = DefectSet.fromMask("S11", self.hot, boxes=self.boxes)
+        expected = self.makeExpectedMask()
+        np.testing.assert_array_equal(defects.getMask(), expected)
+
+        segments = defects.getRowSegments()
+        nRowRuns = np.count_nonzero(np.diff(self.hot.astype(int), axis=1) > 0) + self.hot[:, 0].sum()
+        self.assertEqual(len(segments), len(self.boxes) + nRowRuns)
+        fromSegments = np.zeros(self.shape, dtype=bool)
+        for x0, y0, width, height in segments:
+            fromSegments[max(y0, 0):y0 + height, max(x0, 0):x0 + width] = True
+        np.testing.assert_array_equal(fromSegments, expected)
+
+    def testIo(self):
+        defects = DefectSet.fromMask("S11", self.hot, boxes=self.boxes, validStart="2018-01-01",
+                                     validEnd="2018-06-30")
+        fileName = os.path.join(self.dir, "defects.json.gz")
+        defects.write(fileName)
+        copy = DefectSet.read(fileName)
+        self.assertEqual((copy.ccd, copy.shape, copy.validStart, copy.validEnd),
+                         ("S11", self.shape, "2018-01-01", "2018-06-30"))
+        self.assertEqual(len(copy), len(defects))
+        np.testing.assert_array_equal(copy.getMask(), defects.getMask())
+
+    def testIndex(self):
+        for ccd in ("S00", "S11"):
+            os.makedirs(os.path.join(self.dir, ccd))
+            for validStart, validEnd in (("2018-01-01", "2018-06-30"), ("2018-07-01", "2018-12-31")):
+                fileName = os.path.join(self.dir, ccd, "defects_%s.json.gz" % validStart)
+                DefectSet(ccd, self.shape, validStart=validStart, validEnd=validEnd).write(fileName)
+
+        index = DefectIndex(self.dir)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index._index._intervals[("defects", "S00", None)][0],
+                         ["2018-01-01", "2018-07-01"])  # each range is stored once
+        self.assertEqual(index.lookup("S11", "2018-08-02T12:00:00.0"),
+                         os.path.join(self.dir, "S11", "defects_2018-07-01.json.gz"))
+        self.assertEqual(index.lookup("S00", "2018-06-30"),
+                         os.path.join(self.dir, "S00", "defects_2018-01-01.json.gz"))
+        self.assertIsNone(index.lookup("S00", "2017-12-31"))
+        self.assertIsNone(index.lookup("S22", "2018-03-01"))
+
+    def testMaskDefects(self):
+        defectMask = self.makeExpectedMask()
+        maskArray = np.zeros(self.shape, dtype=np.int32)
+        maskArray[0, :] = 1
+        maskDefects(maskArray, defectMask, 4)
+        np.testing.assert_array_equal(maskArray & 4 != 0, defectMask)
+        np.testing.assert_array_equal(maskArray[0] & 1, 1)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
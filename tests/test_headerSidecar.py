@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.headerSidecar import HeaderSidecar, getSidecarLocation
+from lsst.obs.comCam.rawReader import readAllHeaders
+from lsst.obs.comCam.synthetic import makePrimaryCards, writeRawMef
+
+
+class HeaderSidecarTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.arrays = [np.zeros((3, 4), dtype=np.int32)]*2
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def writeRaw(self, ccd, visit, expTime):
+        fileName = os.path.join(self.dir, "raw", "5000", ccd, "%s-%06d.fits" % (ccd, visit))
+        writeRawMef(fileName, makePrimaryCards("5000", 58119.0 + visit/86400.0, expTime=expTime), self.arrays)
+        return fileName
+
+    def testLocation(self):
+        fileName = os.path.join(self.dir, "raw", "5000", "S00", "S00-000001.fits")
+        sidecarFile, key = getSidecarLocation(fileName)
+        self.assertEqual(sidecarFile, os.path.join(self.dir, "raw", "5000", "rawHeaders.json.gz"))
+        self.assertEqual(key, os.path.join("S00", "S00-000001.fits"))
+        self.assertEqual(getSidecarLocation(fileName + ".fz"), (sidecarFile, key))
+
+    def testRoundTrip(self):
+        sidecar = HeaderSidecar()
+        for ccd, visit, expTime in (("S00", 1, 15.0), ("S11", 1, 15.0), ("S00", 2, 30.0)):
+            fileName = self.writeRaw(ccd, visit, expTime)
+            sidecarFile, key = getSidecarLocation(fileName)
+            sidecar.add(key, readAllHeaders(fileName))
+        sidecar.add(key, readAllHeaders(fileName))  # replacing an entry doesn't add a row
+        self.assertEqual(len(sidecar), 3)
+        sidecar.write(sidecarFile)
+
+        sidecar = HeaderSidecar.read(sidecarFile)
+        self.assertEqual(len(sidecar), 3)
+        self.assertIn(key, sidecar)
+        phu = sidecar.getHeader(key)
+        self.assertEqual(phu["EXPTIME"], 30.0)
+        self.assertEqual(phu["RUNNUM"], "5000")
+        self.assertEqual(sidecar.getHeader(key, 2)["EXTNAME"], "Segment01")
+        md = sidecar.getMetadata(os.path.join("S11", "S11-000001.fits"))
+        self.assertEqual(md.getScalar("EXPTIME"), 15.0)
+        self.assertIsNone(sidecar.getHeader("S22/S22-000001.fits"))
+        self.assertIsNone(sidecar.getHeader(key, 3))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,253 @@
+import contextlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.obs.comCam import instrument
+from lsst.obs.comCam.headerSidecar import SIDECAR_NAME
+from lsst.obs.comCam.ingest import (ComCamIngestTask, ComCamParseConfig, ComCamParseTask, IngestManifest,
+                                    _calibIdCache, parseCalibId, parseInPool)
+from lsst.obs.comCam.synthetic import generateRawTree, makePrimaryCards, writeRawMef
+
+cameraFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "policy", "camera.yaml")
+
+
+class FakeParseTask(object):
+    """A picklable stand-in for ComCamParseTask that "parses" a file's name"""
+
+    def __init__(self, config, name=None):
+        self.config = config
+
+    @instrument.timed("fakeGetInfo")
+    def getInfo(self, filename):
+        if filename.endswith(".bad"):
+            raise RuntimeError("unreadable")
+        return dict(basename=os.path.basename(filename), prefix=self.config), []
+
+
+class IngestManifestTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.manifestFile = os.path.join(self.dir, "ingestManifest.sqlite3")
+        self.rawFile = os.path.join(self.dir, "raw.fits")
+        with open(self.rawFile, "w") as fd:
+            fd.write("raw")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def touch(self, mtime):
+        os.utime(self.rawFile, (mtime, mtime))
+
+    def testManifest(self):
+        self.touch(1000)
+        manifest = IngestManifest(self.manifestFile)
+        self.assertFalse(manifest.isUnchanged(self.rawFile))
+        manifest.record(self.rawFile)
+        self.assertTrue(manifest.isUnchanged(self.rawFile))
+        manifest.close()
+
+        manifest = IngestManifest(self.manifestFile)
+        self.assertTrue(manifest.isUnchanged(self.rawFile))
+        self.touch(2000)
+        self.assertFalse(manifest.isUnchanged(self.rawFile))
+        manifest.close(commit=False)
+
+    def testHash(self):
+        self.touch(1000)
+        manifest = IngestManifest(self.manifestFile, useHash=True)
+        manifest.record(self.rawFile)
+        self.touch(2000)
+        self.assertTrue(manifest.isUnchanged(self.rawFile))
+
+        with open(self.rawFile, "w") as fd:
+            fd.write("RAW")
+        self.touch(3000)
+        self.assertFalse(manifest.isUnchanged(self.rawFile))
+        manifest.close()
+
+    def testMove(self):
+        """A file ingested with mode=move is recorded as it was before it moved"""
+        self.touch(1000)
+        outDir = os.path.join(self.dir, "repo")
+        os.makedirs(outDir)
+        manifest = IngestManifest(self.manifestFile, useHash=True)
+        task = FakeIngestTask(outDir)
+        args = Namespace(badId=Namespace(idList=[]), ignoreIngested=False, mode="move", dryrun=False,
+                         create=False, butler=None)
+        info = dict(visit=1)
+        self.assertTrue(task.registerFile(None, args, self.rawFile, info, [info], manifest))
+        self.assertFalse(os.path.exists(self.rawFile))
+        self.assertEqual(task.rows, [info])
+
+        with open(self.rawFile, "w") as fd:     # the same file delivered again
+            fd.write("raw")
+        self.touch(1000)
+        self.assertTrue(manifest.isUnchanged(self.rawFile))
+        manifest.close()
+
+    def testMoveSidecar(self):
+        """The headers of a file ingested with mode=move are read from the repository"""
+        writeRawMef(self.rawFile, makePrimaryCards("5000", 58119.0), [])
+        outDir = os.path.join(self.dir, "repo", "5000", "S00")
+        os.makedirs(outDir)
+        task = FakeIngestTask(outDir)
+        args = Namespace(badId=Namespace(idList=[]), ignoreIngested=False, mode="move", dryrun=False,
+                         create=False, butler=None)
+        info = dict(visit=1)
+        sidecars = {}
+        self.assertTrue(task.registerFile(None, args, self.rawFile, info, [info]))
+        task.addToSidecar(sidecars, args, self.rawFile, info)
+        sidecar = sidecars[os.path.join(self.dir, "repo", "5000", SIDECAR_NAME)]
+        self.assertEqual(sidecar.getHeader(os.path.join("S00", "raw.fits"))["RUNNUM"], "5000")
+
+    def testSkipSidecar(self):
+        """Nothing is added to the sidecar for a file that wasn't written to the repository"""
+        writeRawMef(self.rawFile, makePrimaryCards("5000", 58119.0), [])
+        outDir = os.path.join(self.dir, "repo", "5000", "S00")
+        task = FakeIngestTask(outDir)
+        args = Namespace(mode="skip", butler=None)
+        sidecars = {}
+        task.addToSidecar(sidecars, args, self.rawFile, dict(visit=1))
+        self.assertEqual(sidecars, {})
+
+    def testAllowError(self):
+        """A file that fails to ingest is skipped if allowError is set, and otherwise stops the run"""
+        outDir = os.path.join(self.dir, "repo")
+        os.makedirs(outDir)
+        args = Namespace(badId=Namespace(idList=[]), badFile=[], ignoreIngested=False, mode="copy",
+                         dryrun=False, create=False, butler=None, input=self.dir,
+                         files=[os.path.join(self.dir, "missing.fits"), self.rawFile])
+        task = FakeIngestTask(outDir, allowError=True)
+        task.run(args)
+        self.assertEqual(task.rows, [dict(visit=1)])
+        self.assertTrue(os.path.exists(os.path.join(outDir, "raw.fits")))
+
+        with self.assertRaises(EnvironmentError):
+            FakeIngestTask(outDir).run(args)
+
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeIngestTask(object):
+    """Just enough of an IngestTask for ComCamIngestTask's run, registerFile and addToSidecar"""
+
+    run = ComCamIngestTask.__dict__["run"]
+    registerFile = ComCamIngestTask.__dict__["registerFile"]
+    addToSidecar = ComCamIngestTask.__dict__["addToSidecar"]
+
+    def __init__(self, outDir, allowError=False):
+        self.rows = []
+        self.config = Namespace(incremental=False, headerSidecar=False, allowError=allowError,
+                                registryIndexes=[], numProcesses=1)
+        self.log = Namespace(info=lambda msg: None, warn=lambda msg: None)
+        self.register = Namespace(check=lambda registry, info: False,
+                                  addRow=lambda registry, info, **kwargs: self.rows.append(info),
+                                  openRegistry=self.openRegistry, addVisits=lambda registry, dryrun: None,
+                                  config=Namespace(table="raw"))
+        self.parse = Namespace(getDestination=lambda butler, info, filename:
+                               os.path.join(outDir, os.path.basename(filename)))
+
+    @contextlib.contextmanager
+    def openRegistry(self, directory, create=False, dryrun=False):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE raw (visit INT)")
+        yield conn
+        conn.close()
+
+    def expandFiles(self, fileNameList):
+        return fileNameList
+
+    def isBadFile(self, filename, badFileList):
+        return False
+
+    def parseFiles(self, filenameList):
+        return [(filename, dict(visit=i), [dict(visit=i)], None) for i, filename in enumerate(filenameList)]
+
+    def isBadId(self, info, idList):
+        return False
+
+    def ingest(self, infile, outfile, mode="move", dryrun=False):
+        if mode == "move":
+            os.rename(infile, outfile)
+        else:
+            shutil.copyfile(infile, outfile)
+        return True
+
+
+class ParseInPoolTestCase(lsst.utils.tests.TestCase):
+    def testPool(self):
+        """The workers build their own parser from the task's class and config"""
+        filenameList = ["a.fits", "b.bad", "c.fits"]
+        for numProcesses in (1, 2):
+            results = list(parseInPool(FakeParseTask("raw"), filenameList, numProcesses, 1))
+            self.assertEqual([result[0] for result in results], filenameList)
+            self.assertEqual(results[0][1], dict(basename="a.fits", prefix="raw"))
+            self.assertIsNone(results[0][3])
+            self.assertEqual(results[1][3], "RuntimeError: unreadable")
+
+    def testComCamParseTask(self):
+        """The workers can construct and run the real ComCamParseTask"""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fileNames = generateRawTree(tmpDir, nVisit=2, ccds=["S00", "S11"], acquisitionTypes=["flat"],
+                                        cameraFile=cameraFile, ampShape=(4, 4))
+            config = ComCamParseConfig()
+            config.translation = {"run": "RUNNUM", "lsstSerial": "LSST_NUM", "imageType": "IMGTYPE"}
+            config.translators = {"visit": "translate_visit"}
+            config.fastHeaderScan = True
+            parseTask = ComCamParseTask(config=config, name="parse")
+            expected = list(parseInPool(parseTask, fileNames, 1, 1))
+            results = list(parseInPool(parseTask, fileNames, 2, 1))
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self.assertEqual(results, expected)
+        for fileName, phuInfo, infoList, error in results:
+            self.assertIsNone(error)
+            self.assertEqual(phuInfo["ccd"], os.path.basename(os.path.dirname(fileName)))
+            self.assertEqual(phuInfo["imageType"], "FLAT")
+        self.assertEqual(len(set(phuInfo["visit"] for fileName, phuInfo, infoList, error in results)), 2)
+
+    def testPoolInstrumented(self):
+        """The statistics recorded by the workers are merged into the parent's"""
+        wasEnabled = instrument.isEnabled()
+        instrument.reset()
+        instrument.enable()
+        try:
+            list(parseInPool(FakeParseTask("raw"), ["a.fits", "b.bad", "c.fits"], 2, 1))
+            self.assertEqual(instrument.getSummary()["fakeGetInfo"]["calls"], 3)
+        finally:
+            instrument.enable(wasEnabled)
+            instrument.reset()
+
+
+class CalibIdTestCase(lsst.utils.tests.TestCase):
+    def testParse(self):
+        fields = parseCalibId("ccd=S00 filter=NONE calibDate=2018-01-01")
+        self.assertEqual(fields, dict(ccd="S00", filter="NONE", calibDate="2018-01-01"))
+        self.assertIs(parseCalibId("ccd=S00 filter=NONE calibDate=2018-01-01"), fields)
+        self.assertEqual(parseCalibId("ccd=S00 ccd=S01")["ccd"], "S01")
+
+    def testParseCalibIdBounded(self):
+        for i in range(_calibIdCache.maxSize + 10):
+            parseCalibId("ccd=S00 calibDate=%d" % i)
+        self.assertLessEqual(_calibIdCache.getStats()["size"], _calibIdCache.maxSize)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import lsst.utils.tests
+from lsst.obs.comCam import instrument
+from lsst.obs.comCam.rawReader import readPrimaryHeader
+from lsst.obs.comCam.synthetic import makePrimaryCards, writeRawMef
+
+
+@instrument.timed()
+def readHeaders(fileName, n):
+    for i in range(n):
+        readPrimaryHeader(fileName)
+
+
+class InstrumentTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.dir, "raw.fits")
+        writeRawMef(self.fileName, makePrimaryCards("5000", 58119.0), [])
+        self.wasEnabled = instrument.isEnabled()
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.enable(self.wasEnabled)
+        instrument.reset()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testDisabled(self):
+        instrument.enable(False)
+        readHeaders(self.fileName, 2)
+        self.assertEqual(instrument.getSummary(), {})
+
+    def testStages(self):
+        instrument.enable()
+        with instrument.stage("outer"):
+            readHeaders(self.fileName, 3)
+            instrument.addIo(nBytes=10)
+        summary = instrument.getSummary()
+        self.assertEqual(summary["readHeaders"]["calls"], 1)
+        self.assertEqual(summary["readHeaders"]["filesOpened"], 3)
+        self.assertEqual(summary["readHeaders"]["bytesRead"], 3*2880)
+        self.assertEqual(summary["outer"], dict(calls=1, wallTime=summary["outer"]["wallTime"],
+                                                bytesRead=10, filesOpened=0))
+        self.assertGreaterEqual(summary["outer"]["wallTime"], summary["readHeaders"]["wallTime"])
+
+        jsonFile = os.path.join(self.dir, "summary.json")
+        instrument.writeSummary(jsonFile)
+        with open(jsonFile) as fd:
+            self.assertEqual(json.load(fd)["stages"]["readHeaders"]["calls"], 1)
+
+    def testInheritStages(self):
+        """Work done in a thread pool is counted against the stage that submitted it"""
+        instrument.enable()
+        pool = ThreadPool(2)
+        try:
+            with instrument.stage("readVisit"):
+                pool.map(instrument.inheritStages(lambda n: instrument.addIo(nBytes=n, nFiles=1)), [1, 2, 3])
+            pool.map(lambda n: instrument.addIo(nBytes=n), [100])  # the stages aren't left behind
+        finally:
+            pool.close()
+            pool.join()
+        summary = instrument.getSummary()
+        self.assertEqual(summary["readVisit"]["bytesRead"], 6)
+        self.assertEqual(summary["readVisit"]["filesOpened"], 3)
+        self.assertEqual(summary["other"]["bytesRead"], 100)
+
+    def testSummaryFile(self):
+        """Each process writes its own summary file"""
+        old = os.environ.get("OBS_COMCAM_INSTRUMENT_FILE")
+        try:
+            os.environ.pop("OBS_COMCAM_INSTRUMENT_FILE", None)
+            self.assertIsNone(instrument.getSummaryFile())
+            os.environ["OBS_COMCAM_INSTRUMENT_FILE"] = "/tmp/summary-{pid}.json"
+            self.assertEqual(instrument.getSummaryFile(), "/tmp/summary-%d.json" % os.getpid())
+            os.environ["OBS_COMCAM_INSTRUMENT_FILE"] = "/tmp/summary.json"
+            self.assertEqual(instrument.getSummaryFile(), "/tmp/summary.json.%d" % os.getpid())
+        finally:
+            if old is None:
+                os.environ.pop("OBS_COMCAM_INSTRUMENT_FILE", None)
+            else:
+                os.environ["OBS_COMCAM_INSTRUMENT_FILE"] = old
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
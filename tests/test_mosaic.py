@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
+import lsst.utils.tests
+from lsst.obs.comCam.mosaic import (AmpPlacement, Mosaic, MosaicLayout, makeMosaic, writeMosaicFits,
+                                    writeMosaicPng)
+from lsst.obs.comCam.rawReader import readPrimaryHeader
+from lsst.obs.comCam.synthetic import ACQUISITION_TYPES, generateRawTree
+
+cameraFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "policy", "camera.yaml")
+
+
+class MosaicTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.layout = MosaicLayout(cameraFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testLayout(self):
+        self.assertEqual(sorted(self.layout.ccds), ["S%d%d" % (i, j) for i in range(3) for j in range(3)])
+        self.assertEqual(self.layout.ccdNames["E2V-CCD250-130-Dev"], "S11")
+        s00, s01 = self.layout.ccds["S00"], self.layout.ccds["S01"]
+        self.assertEqual(len(s00), 16)
+        self.assertEqual(min(p.x0 for p in s00), 0)
+        self.assertEqual(min(p.y0 for p in s00), 0)
+        self.assertEqual(min(p.x0 for p in s01), 4150)     # 41.5 mm at 10 um/pixel
+        self.assertEqual(self.layout.width, 2*4150 + 8*512)
+        self.assertEqual((s00[0].flipX, s00[0].flipY), (True, False))
+
+    def testBinning(self):
+        """Binning each amplifier as it's added is the same as binning the assembled image."""
+        class Layout(object):
+            width, height = 23, 17
+
+        rng = np.random.RandomState(1)
+        placements = [AmpPlacement(0, None, False, False, 0, 0), AmpPlacement(1, None, True, False, 6, 0),
+                      AmpPlacement(2, None, False, True, 0, 9), AmpPlacement(3, None, True, True, 13, 9)]
+        binning = 4
+        mosaic = Mosaic(Layout(), binning)
+        full = np.full((Layout.height, Layout.width), np.nan)
+        for placement in placements:
+            data = rng.uniform(size=(7, 6)).astype(np.float32)
+            mosaic.addAmp(placement, data)
+            placed = data[::-1 if placement.flipY else 1, ::-1 if placement.flipX else 1]
+            full[placement.y0:placement.y0 + 7, placement.x0:placement.x0 + 6] = placed
+
+        image = mosaic.getImage()
+        self.assertEqual(image.shape, (5, 6))
+        for i in range(image.shape[0]):
+            for j in range(image.shape[1]):
+                block = full[i*binning:(i + 1)*binning, j*binning:(j + 1)*binning]
+                block = block[np.isfinite(block)]
+                if len(block) == 0:
+                    self.assertTrue(np.isnan(image[i, j]))
+                else:
+                    self.assertAlmostEqual(image[i, j], block.mean(), places=5)
+
+    def makeMosaic(self, binning, numThreads=1):
+        fileNames = generateRawTree(self.dir, nVisit=1, ccds=["S11"], acquisitionTypes=["flat"],
+                                    cameraFile=cameraFile)
+        return makeMosaic(fileNames, binning=binning, cameraFile=cameraFile, numThreads=numThreads)
+
+    def testMakeMosaic(self):
+        binning = 32
+        mosaic = self.makeMosaic(binning, numThreads=4)
+        image = mosaic.getImage()
+        placements = self.layout.ccds["S11"]
+        x0, y0 = min(p.x0 for p in placements)//binning + 1, min(p.y0 for p in placements)//binning + 1
+        x1, y1 = x0 + 8*512//binning - 2, y0 + 2*2002//binning - 2
+        signal = ACQUISITION_TYPES["flat"][2]
+        self.assertAlmostEqual(np.mean(image[y0:y1, x0:x1]), signal, delta=0.01*signal)
+        self.assertTrue(np.isnan(image[0, 0]))
+
+        fitsFile = os.path.join(self.dir, "mosaic.fits")
+        writeMosaicFits(fitsFile, mosaic, [("RUNNUM", "5000")])
+        header = readPrimaryHeader(fitsFile)
+        self.assertEqual((header["NAXIS1"], header["NAXIS2"]), image.shape[::-1])
+        self.assertEqual(header["BINNING"], binning)
+        self.assertEqual(os.path.getsize(fitsFile) % 2880, 0)
+
+    @unittest.skipIf(matplotlib is None, "matplotlib is not available")
+    def testPng(self):
+        pngFile = os.path.join(self.dir, "mosaic.png")
+        writeMosaicPng(pngFile, self.makeMosaic(32))
+        with open(pngFile, "rb") as fd:
+            self.assertEqual(fd.read(8), b"\x89PNG\r\n\x1a\n")
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.overscan import OverscanGeometry, subtractOverscan
+
+
+class OverscanTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        # A small E2V-like amplifier: prescan x < 2, data 2 <= x < 8, serial overscan x >= 8;
+        # data y < 10, parallel overscan y >= 10
+        self.geometry = OverscanGeometry(data=(slice(0, 10), slice(2, 8)),
+                                         serial=(slice(0, 10), slice(8, 11)),
+                                         parallel=(slice(10, 13), slice(2, 8)))
+        nAmp, height, width = 3, 13, 11
+        self.signal = np.zeros((nAmp, height, width), dtype=np.int32)
+        self.signal[:, :10, 2:8] = np.arange(60).reshape(10, 6)
+        rowBias = 1000 + 10*np.arange(nAmp)[:, np.newaxis] + np.arange(height)[np.newaxis, :]
+        colBias = np.arange(width)
+        self.raw = self.signal + rowBias[:, :, np.newaxis]
+        self.raw[:, :, 2:8] += colBias[np.newaxis, np.newaxis, 2:8]
+
+    def testSubtract(self):
+        result = subtractOverscan(self.raw, self.geometry)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_array_equal(result[:, :10, 2:8], self.signal[:, :10, 2:8])
+
+    def testSerialOnly(self):
+        result = subtractOverscan(self.raw, self.geometry, doParallel=False)
+        np.testing.assert_array_equal(result[:, :10, 2:8] - np.arange(2, 8),
+                                      self.signal[:, :10, 2:8])
+
+    def testTrim(self):
+        result = subtractOverscan(self.raw, self.geometry, trim=True)
+        self.assertEqual(result.shape, (3, 10, 6))
+        np.testing.assert_array_equal(result, self.signal[:, :10, 2:8])
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.prefetch import VisitPrefetcher
+from lsst.obs.comCam.rawReader import readRawCcd
+from lsst.obs.comCam.synthetic import makePrimaryCards, writeRawMef
+
+
+class Location(object):
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+    def getLocationsWithRoot(self):
+        return [self.fileName]
+
+
+class FakeMapper(object):
+    """Just enough of ComCamMapper to find and read raws and biases, recording the reads."""
+
+    def __init__(self, root, visits, ccds, readDelay=0.0):
+        self.root = root
+        self.visits = visits
+        self.ccds = ccds
+        self.readDelay = readDelay
+        self.lock = threading.Lock()
+        self.visitsRead = set()         # visits of which a raw has been read
+        self.calibReads = 0
+        arrays = [np.full((4, 5), amp, dtype=np.int32) for amp in range(2)]
+        for visit in visits:
+            for ccd in ccds:
+                writeRawMef(self.getRawFile(visit, ccd), makePrimaryCards("5000", 58000.0), arrays)
+        with open(os.path.join(root, "bias-S00.fits"), "w"):
+            pass
+
+    def getRawFile(self, visit, ccd):
+        return os.path.join(self.root, "%s-%d.fits" % (ccd, visit))
+
+    def query_raw(self, format, dataId):
+        rows = []
+        for visit in self.visits:
+            if dataId.get("visit", visit) == visit:
+                rows += [dict(visit=visit, ccd=ccd, run="5000") for ccd in self.ccds]
+        return [tuple(row[key] for key in format) for row in rows]
+
+    def map(self, datasetType, dataId):
+        if datasetType == "raw_mef":
+            return Location(self.getRawFile(dataId["visit"], dataId["ccd"]))
+        if dataId["ccd"] != "S00":
+            raise RuntimeError("No %s for %s" % (datasetType, dataId))
+        return Location(os.path.join(self.root, "%s-%s.fits" % (datasetType, dataId["ccd"])))
+
+    def bypass_raw_mef(self, datasetType, pythonType, location, dataId):
+        time.sleep(self.readDelay)
+        with self.lock:
+            self.visitsRead.add(dataId["visit"])
+        return readRawCcd(location.getLocationsWithRoot()[0], nAmp=2)
+
+    def bypass_bias(self, datasetType, pythonType, location, dataId):
+        with self.lock:
+            self.calibReads += 1
+        return "bias"
+
+
+class PrefetchTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testIterate(self):
+        mapper = FakeMapper(self.dir, [12, 10, 11], ["S00", "S11"], readDelay=0.02)
+        prefetcher = VisitPrefetcher(mapper, depth=2, calibTypes=["bias"])
+        self.assertEqual(len(prefetcher), 3)
+
+        visits = []
+        for visit in prefetcher:
+            visits.append(visit.dataId["visit"])
+            self.assertEqual(sorted(visit.rawCcds), ["S00", "S11"])
+            self.assertEqual(visit.rawCcds["S11"].pixels[1, 0, 0], 1)
+            self.assertEqual(visit.calibs, {("bias", "S00"): "bias", ("bias", "S11"): None})
+            self.assertEqual(visit.nBytes, 2*2*4*5*4)
+            time.sleep(0.2)             # "process" the visit, while the next is read
+        self.assertEqual(visits, [10, 11, 12])
+        self.assertEqual(mapper.calibReads, 1)
+
+        stats = prefetcher.stats
+        self.assertEqual(stats.visits, 3)
+        self.assertEqual(stats.hits, 2)  # only the first visit had to be waited for
+        self.assertAlmostEqual(stats.hitRate, 2/3)
+        self.assertGreater(stats.stallTime, 0.0)
+        self.assertEqual(stats.bytesRead, 3*2*2*4*5*4)
+
+    def testBudget(self):
+        """With room for only one visit, no visit is read until the previous one is finished with."""
+        mapper = FakeMapper(self.dir, [1, 2, 3], ["S00"])
+        prefetcher = VisitPrefetcher(mapper, depth=2, maxBytes=100)
+        for visit in prefetcher:
+            time.sleep(0.05)
+            self.assertEqual(max(mapper.visitsRead), visit.dataId["visit"])
+        self.assertEqual(prefetcher.stats.hits, 0)
+
+    def testCalibError(self):
+        """If reading a calib fails, every CCD waiting for it sees the error"""
+        mapper = FakeMapper(self.dir, [1], ["S00"])
+        started = threading.Event()
+
+        def failToRead(datasetType, pythonType, location, dataId):
+            started.set()
+            time.sleep(0.1)             # while the other thread waits
+            raise IOError("Corrupt bias")
+
+        mapper.bypass_bias = failToRead
+        prefetcher = VisitPrefetcher(mapper, calibTypes=["bias"])
+        errors = []
+
+        def readCalib():
+            try:
+                prefetcher._readCalib("bias", dict(visit=1, ccd="S00"), 0)
+            except IOError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=readCalib)]
+        threads[0].start()
+        started.wait()
+        threads.append(threading.Thread(target=readCalib))
+        threads[1].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(prefetcher._calibs, {})  # so a later visit tries again
+
+    def testCalibRelease(self):
+        """Calibs are released once no visit uses them, and count against the budget"""
+        mapper = FakeMapper(self.dir, [1, 2, 3], ["S00"])
+        for visit in mapper.visits:
+            with open(os.path.join(self.dir, "bias-%d.fits" % visit), "wb") as fd:
+                fd.write(b"\0"*1000)
+        mapper.map = lambda datasetType, dataId: (
+            Location(mapper.getRawFile(dataId["visit"], dataId["ccd"])) if datasetType == "raw_mef" else
+            Location(os.path.join(self.dir, "bias-%d.fits" % dataId["visit"])))
+
+        prefetcher = VisitPrefetcher(mapper, depth=1, calibTypes=["bias"])
+        for visit in prefetcher:
+            time.sleep(0.05)
+            self.assertEqual(len(prefetcher._calibs), 1)  # only this visit's
+        self.assertEqual(mapper.calibReads, 3)
+
+        mapper.visitsRead.clear()
+        prefetcher = VisitPrefetcher(mapper, depth=2, maxBytes=1500, calibTypes=["bias"])
+        for visit in prefetcher:
+            time.sleep(0.05)
+            self.assertEqual(max(mapper.visitsRead), visit.dataId["visit"])  # no room for the next
+        self.assertEqual(prefetcher.stats.hits, 0)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
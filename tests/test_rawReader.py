@@ -0,0 +1,201 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam import rawReader
+from lsst.obs.comCam.rawReader import (FitsHeader, LazyRawCcd, MappedRawCcd, RawCcd, findRawFile,
+                                       findRawLocation, readLazyRawCcd, readPrimaryHeader, readRawCcd)
+
+
+def makeHeader(cards):
+    """Format a list of (key, value) pairs as a padded FITS header."""
+    lines = []
+    for key, value in cards:
+        if isinstance(value, bool):
+            value = "T" if value else "F"
+        elif isinstance(value, str):
+            value = "'%-8s'" % value
+        lines.append("%-8s= %20s" % (key, value))
+    lines.append("END")
+    text = "".join("%-80s" % line for line in lines)
+    text += " "*(-len(text) % 2880)
+    return text.encode("ascii")
+
+
+def writeMef(fileName, ampArrays, bzero=0, bitpix=32):
+    """Write a minimal raw-like MEF with an empty primary HDU."""
+    with open(fileName, "wb") as fd:
+        fd.write(makeHeader([("SIMPLE", True), ("BITPIX", 8), ("NAXIS", 0), ("EXTEND", True),
+                             ("RUNNUM", "1234"), ("EXPTIME", 15.0)]))
+        for i, array in enumerate(ampArrays):
+            cards = [("XTENSION", "IMAGE"), ("BITPIX", bitpix), ("NAXIS", 2),
+                     ("NAXIS1", array.shape[1]), ("NAXIS2", array.shape[0]),
+                     ("PCOUNT", 0), ("GCOUNT", 1), ("EXTNAME", "Segment%02d" % i)]
+            if bzero:
+                cards.append(("BZERO", bzero))
+            fd.write(makeHeader(cards))
+            data = (array - bzero).astype(">i%d" % (bitpix//8)).tobytes()
+            fd.write(data + b"\0"*(-len(data) % 2880))
+
+
+class RawReaderTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.nAmp = 4
+        self.arrays = [np.arange(30, dtype=np.int32).reshape(5, 6) + 100*i for i in range(self.nAmp)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testRead(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        writeMef(fileName, self.arrays)
+        rawCcd = readRawCcd(fileName, nAmp=self.nAmp)
+        self.assertEqual(len(rawCcd), self.nAmp)
+        self.assertEqual(rawCcd.metadata["RUNNUM"], "1234")
+        self.assertEqual(rawCcd.metadata["EXPTIME"], 15.0)
+        self.assertEqual(rawCcd.ampHeaders[2]["EXTNAME"], "Segment02")
+        self.assertEqual(rawCcd.pixels.shape, (self.nAmp, 5, 6))
+        for i, array in enumerate(self.arrays):
+            np.testing.assert_array_equal(rawCcd.pixels[i], array)
+
+    def testBzeroAndGzip(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        writeMef(fileName, self.arrays, bzero=50)
+        with open(fileName, "rb") as fin, gzip.open(fileName + ".gz", "wb") as fout:
+            fout.write(fin.read())
+        rawCcd = readRawCcd(fileName + ".gz", nAmp=self.nAmp)
+        for i, array in enumerate(self.arrays):
+            np.testing.assert_array_equal(rawCcd.pixels[i], array)
+
+    def testPrimaryHeader(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        writeMef(fileName, self.arrays)
+        header = readPrimaryHeader(fileName)
+        self.assertEqual(header["RUNNUM"], "1234")
+        self.assertNotIn("XTENSION", header)
+        md = header.toPropertyList(["EXPTIME"])
+        self.assertEqual(md.getScalar("EXPTIME"), 15.0)
+        self.assertFalse(md.exists("RUNNUM"))
+
+    def testMissingAmps(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        writeMef(fileName, self.arrays)
+        with self.assertRaises(RuntimeError):
+            readRawCcd(fileName, nAmp=self.nAmp + 1)
+
+    def testLazy(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        writeMef(fileName, self.arrays, bzero=50)
+        rawCcd = readLazyRawCcd(fileName, nAmp=self.nAmp)
+        self.assertIsInstance(rawCcd, LazyRawCcd)
+        self.assertEqual(len(rawCcd), self.nAmp)
+        self.assertEqual(rawCcd.metadata["RUNNUM"], "1234")
+        self.assertFalse(any(rawCcd.isLoaded(i) for i in range(self.nAmp)))
+        np.testing.assert_array_equal(rawCcd.getAmpArray(2), self.arrays[2])
+        self.assertEqual([rawCcd.isLoaded(i) for i in range(self.nAmp)], [False, False, True, False])
+        for i, array in enumerate(self.arrays):
+            np.testing.assert_array_equal(rawCcd.getAmpArray(i), array)
+
+        with open(fileName, "rb") as fin, gzip.open(fileName + ".gz", "wb") as fout:
+            fout.write(fin.read())
+        rawCcd = readLazyRawCcd(fileName + ".gz", nAmp=self.nAmp)
+        self.assertIsInstance(rawCcd, RawCcd)
+        np.testing.assert_array_equal(rawCcd.getAmpArray(3), self.arrays[3])
+
+    def testMmap(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        writeMef(fileName, self.arrays, bzero=50)
+        rawCcd = readLazyRawCcd(fileName, nAmp=self.nAmp, useMmap=True)
+        self.assertIsInstance(rawCcd, MappedRawCcd)
+        self.assertIsInstance(rawCcd, LazyRawCcd)
+        # The views are of the file as stored: big-endian, without BZERO
+        data = rawCcd.getAmpData(1)
+        self.assertEqual(data.dtype, np.dtype(">i4"))
+        self.assertFalse(data.flags.writeable)
+        np.testing.assert_array_equal(data, self.arrays[1] - 50)
+        self.assertFalse(any(rawCcd.isLoaded(i) for i in range(self.nAmp)))
+
+        array = rawCcd.getAmpArray(1)
+        self.assertEqual(array.dtype, np.dtype(np.int32))
+        self.assertTrue(array.dtype.isnative)
+        np.testing.assert_array_equal(array, self.arrays[1])
+        self.assertIs(rawCcd.getAmpArray(1), array)
+        self.assertEqual([rawCcd.isLoaded(i) for i in range(self.nAmp)], [False, True, False, False])
+        for i, array in enumerate(self.arrays):
+            np.testing.assert_array_equal(rawCcd.getAmpArray(i), array)
+
+        # 16-bit data with the unsigned offset are widened before BZERO is applied
+        writeMef(fileName, self.arrays, bzero=32768, bitpix=16)
+        rawCcd = readLazyRawCcd(fileName, nAmp=self.nAmp, useMmap=True)
+        self.assertEqual(rawCcd.getAmpData(2).dtype, np.dtype(">i2"))
+        np.testing.assert_array_equal(rawCcd.getAmpArray(2), self.arrays[2])
+
+        with open(fileName, "rb") as fin, gzip.open(fileName + ".gz", "wb") as fout:
+            fout.write(fin.read())
+        rawCcd = readLazyRawCcd(fileName + ".gz", nAmp=self.nAmp, useMmap=True)
+        self.assertNotIsInstance(rawCcd, LazyRawCcd)
+        np.testing.assert_array_equal(rawCcd.getAmpArray(3), self.arrays[3])
+
+    def testFindRawFile(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        self.assertEqual(findRawFile(fileName), fileName)
+        writeMef(fileName + ".gz", self.arrays)
+        self.assertEqual(findRawFile(fileName), fileName + ".gz")
+        writeMef(fileName + ".fz", self.arrays)
+        self.assertEqual(findRawFile(fileName), fileName + ".fz")
+        writeMef(fileName, self.arrays)
+        self.assertEqual(findRawFile(fileName), fileName)
+
+    def testFindRawLocation(self):
+        fileName = os.path.join(self.dir, "raw.fits")
+        self.assertEqual(findRawLocation(fileName + "[3]"), fileName + "[3]")
+        writeMef(fileName + ".fz", self.arrays)
+        self.assertEqual(findRawLocation(fileName + "[3]"), fileName + ".fz[3]")
+        self.assertEqual(findRawLocation(fileName), fileName + ".fz")
+
+    def testDecompressPools(self):
+        """Asking for a pool of another size doesn't terminate one in use"""
+        pool = rawReader._getDecompressPool(1)
+        self.assertIs(rawReader._getDecompressPool(1), pool)
+        self.assertIsNot(rawReader._getDecompressPool(2), pool)
+        self.assertEqual(pool.map(abs, [-1, -2]), [1, 2])
+
+
+class FitsHeaderTestCase(lsst.utils.tests.TestCase):
+    def testImageHeader(self):
+        """The header of a tile-compressed image is that of the image, not of its BINTABLE"""
+        cards = [("XTENSION", "BINTABLE", ""), ("BITPIX", 8, ""), ("NAXIS", 2, ""), ("NAXIS1", 8, ""),
+                 ("NAXIS2", 2002, ""), ("PCOUNT", 123456, ""), ("GCOUNT", 1, ""), ("TFIELDS", 1, ""),
+                 ("TTYPE1", "COMPRESSED_DATA", ""), ("TFORM1", "1PB(300)", ""), ("ZIMAGE", True, ""),
+                 ("ZTILE1", 576, ""), ("ZTILE2", 1, ""), ("ZCMPTYPE", "RICE_1", ""),
+                 ("ZNAME1", "BLOCKSIZE", ""), ("ZVAL1", 32, ""), ("ZBITPIX", 32, ""), ("ZNAXIS", 2, ""),
+                 ("ZNAXIS1", 576, ""), ("ZNAXIS2", 2002, ""), ("EXTNAME", "Segment10", ""),
+                 ("DATASEC", "[11:522,1:2002]", ""), ("ZDATASUM", "12345", "")]
+        header = FitsHeader(cards).getImageHeader()
+        self.assertEqual([card[0] for card in header.cards],
+                         ["XTENSION", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "PCOUNT", "GCOUNT", "EXTNAME",
+                          "DATASEC", "DATASUM"])
+        self.assertEqual((header["XTENSION"], header["BITPIX"], header["NAXIS1"], header["PCOUNT"]),
+                         ("IMAGE", 32, 576, 0))
+        self.assertEqual(header.getDataSize(), 576*2002*4)
+        uncompressed = FitsHeader(cards[:7])
+        self.assertIs(uncompressed.getImageHeader(), uncompressed)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
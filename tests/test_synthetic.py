@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.comCam.rawReader import readPrimaryHeader, readRawCcd
+from lsst.obs.comCam.cache import getCacheStats
+from lsst.obs.comCam.synthetic import (generateRawTree, getAmpGeometry, getRawPath, makeAmpArrays,
+                                       makePrimaryCards, writeRawMef)
+
+cameraFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "policy", "camera.yaml")
+
+
+class SyntheticTestCase(lsst.utils.tests.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testGeometry(self):
+        geometries = getAmpGeometry(cameraFile)
+        self.assertEqual(len(geometries), 16)
+        self.assertEqual(geometries[0].shape, (2048, 576))
+        self.assertEqual(geometries[0].data, (10, 0, 512, 2002))
+
+    def testWriteRaw(self):
+        geometries = getAmpGeometry(cameraFile)[:2]
+        arrays = makeAmpArrays(geometries, bias=1000, signal=500, seed=1)
+        x0, y0, width, height = geometries[0].serialOverscan
+        self.assertAlmostEqual(arrays[0][y0:y0 + height, x0:x0 + width].mean(), 1000, delta=1)
+        x0, y0, width, height = geometries[0].data
+        self.assertAlmostEqual(arrays[0][y0:y0 + height, x0:x0 + width].mean(), 1500, delta=1)
+
+        fileName = getRawPath(self.dir, "RTM-005", "5000", "flat", "v0", 12, "S00", "S00_flat.fits")
+        writeRawMef(fileName, makePrimaryCards("5000", 58119.5, expTime=30.0), arrays, bzero=32768)
+        self.assertTrue(fileName.startswith(os.path.join(self.dir, "RTM-005", "5000", "flat", "v0", "12",
+                                                         "S00")))
+        header = readPrimaryHeader(fileName)
+        self.assertEqual(header["RUNNUM"], "5000")
+        self.assertEqual(header["EXPTIME"], 30.0)
+        self.assertEqual(header["DATE-OBS"], "2018-01-01T12:00:00.000")
+        rawCcd = readRawCcd(fileName, nAmp=2)
+        for i, array in enumerate(arrays):
+            np.testing.assert_array_equal(rawCcd.pixels[i], array)
+
+    def testTree(self):
+        for compression, numProcesses in ((None, 1), ("gz", 2)):
+            root = os.path.join(self.dir, str(compression))
+            fileNames = generateRawTree(root, nRun=2, nVisit=3, ccds=["S00", "S22"],
+                                        acquisitionTypes=["bias", "flat"], compression=compression,
+                                        numProcesses=numProcesses, cameraFile=cameraFile, ampShape=(20, 30))
+            self.assertEqual(len(fileNames), 2*3*2*2)
+            self.assertEqual(sorted(fileNames), sorted(set(fileNames)))
+            mjds = set()
+            for fileName in fileNames:
+                raftId, run, acqType, testVersion, jobId, ccd, basename = \
+                    os.path.relpath(fileName, root).split(os.path.sep)
+                self.assertTrue(basename.startswith("%s_%s_" % (ccd, acqType)))
+                header = readPrimaryHeader(fileName)
+                self.assertEqual(header["RUNNUM"], run)
+                self.assertEqual(header["IMGTYPE"], acqType.upper())
+                mjds.add(header["MJD-OBS"])
+            self.assertEqual(len(mjds), 2*3*2)
+            rawCcd = readRawCcd(fileNames[-1])
+            self.assertEqual(rawCcd.pixels.shape, (16, 20, 30))
+            self.assertGreater(rawCcd.pixels[0][:, 10:].mean(), 20000)  # beyond the prescan
+            self.assertEqual(getCacheStats()["syntheticPayloads"]["size"], 0)  # not kept after the tree
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()